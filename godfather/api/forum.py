@@ -1,17 +1,73 @@
+import click
+
 from godfather.api.message import Message
+from godfather.roster import Roster
+
+class ForumError(click.ClickException):
+  """A forum operation failed, possibly temporarily."""
 
 class Forum(object):
   """A service used to send and receive messages to players."""
 
+  metrics = None  # The game's Metrics, set by the Moderator while it runs.
+  roster  = None  # The game's Roster, likewise.
+
   @property
   def receipt_lag(self):
     """Time before we can reliably assume a message has been received."""
     raise NotImplementedError()
 
+  def roster_for(self, game):
+    """Return the Moderator's Roster, or outside a running game, a new one for <game>."""
+    return self.roster or Roster(game)
+
   def send_message(self, game, message):
     """Send a message or raise an exception if unable."""
     raise NotImplementedError()
 
+  def send_messages(self, game, messages):
+    """Send several messages, and return (message, error) for each failure."""
+    failures = []
+    for message in messages:
+      try:
+        self.send_message(game, message)
+      except ForumError as e:
+        failures.append((message, e))
+    return failures
+
   def get_messages(self, game, cutoff):
-    """Return all messages received during the specified period."""
+    """Return (or yield) all messages received since the last check."""
+    raise NotImplementedError()
+
+  def watch(self, wake):
+    """Call <wake> (from any thread) whenever new messages may have arrived.
+
+    The Moderator calls this when it starts running, so that forums which
+    can tell when mail arrives needn't wait for the next poll, and calls
+    unwatch() when it stops. Most forums can't tell, and do nothing.
+    """
+    pass
+
+  def unwatch(self):
+    pass
+
+  @property
+  def cursor(self):
+    """A small, picklable marker of how far get_messages has read."""
+    return None
+
+  @cursor.setter
+  def cursor(self, cursor):
+    pass
+
+  def verify_push(self, form):
+    """Return the email in a pushed (webhook) request's <form>.
+
+    Raises ForumError if the request can't be verified as coming from the
+    forum. Called from the web server's threads, so it mustn't touch the game.
+    """
+    raise ForumError("%s does not accept pushed messages." % type(self).__name__)
+
+  def parse_push(self, game, email):
+    """Return the Message for an email from verify_push, or None to ignore it."""
     raise NotImplementedError()
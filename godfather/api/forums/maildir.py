@@ -0,0 +1,238 @@
+import datetime
+import email.message
+import email.parser
+import email.policy
+import email.utils
+import logging
+import os
+import re
+import smtplib
+import threading
+
+import mafia
+
+from godfather.api.forum import Forum, ForumError
+from godfather.api.message import Message
+from godfather.api.text import html_to_text
+from godfather.watch import DirectoryWatcher
+
+# The line a mail client puts above the message it's quoting in a reply.
+QUOTE_HEADER = re.compile(r"^On .*wrote:\s*$")
+
+def strip_reply(text):
+  """Return the text of a reply without the quoted message or signature."""
+  lines = []
+  for line in text.splitlines():
+    if line.startswith(">") or QUOTE_HEADER.match(line) or line.rstrip() == "--":
+      break
+    lines.append(line)
+  return "\n".join(lines).strip()
+
+class Maildir(Forum):
+  """Receives mail from a local Maildir, and sends it through an SMTP relay.
+
+  For a game run on its own mail server: the MTA delivers players' mail to
+  the Maildir at <path> (say with a .forward or procmail rule), and messages
+  are sent through the relay at <smtp_host>. There's no API in between, so
+  a message is ready as soon as it's delivered, and the forum can tell the
+  Moderator the moment that happens.
+
+  Messages are claimed by moving them from new/ to cur/ (which is atomic,
+  so nothing else reading the Maildir gets them too), and flagged seen once
+  the Moderator has handled them. Messages claimed but never flagged, say
+  because the Moderator crashed, are handed out again.
+  """
+
+  def __init__(self, *, path, sender, address, smtp_host="localhost", smtp_port=25,
+               smtp_user=None, smtp_password=None, starttls=False, private_cc=None,
+               public_cc=None, timeout=30):
+    self.path          = path
+    self.sender        = sender
+    self.address       = address
+    self.smtp_host     = smtp_host
+    self.smtp_port     = smtp_port
+    self.smtp_user     = smtp_user
+    self.smtp_password = smtp_password
+    self.starttls      = starttls
+    self.private_cc    = private_cc or []
+    self.public_cc     = public_cc or []
+    self.timeout       = timeout
+    self._init_runtime_state()
+
+    for subdirectory in ("tmp", "new", "cur"):
+      os.makedirs(os.path.join(path, subdirectory), exist_ok=True)
+
+  def _init_runtime_state(self):
+    self.lock    = threading.Lock()  # Held while using the SMTP connection.
+    self.smtp    = None              # Connected on first use.
+    self.watcher = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    for key in ("lock", "smtp", "watcher", "metrics", "roster"):
+      state.pop(key, None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_runtime_state()
+
+  @property
+  def receipt_lag(self):
+    # Delivery renames a finished message into new/, so it's visible at once.
+    return datetime.timedelta()
+
+  def watch(self, wake):
+    self.unwatch()
+    self.watcher = DirectoryWatcher(os.path.join(self.path, "new"), wake)
+    self.watcher.start()
+
+  def unwatch(self):
+    if self.watcher:
+      self.watcher.stop()
+      self.watcher = None
+
+  def send_message(self, game, message):
+    """Send a message or raise an exception if unable."""
+    to = message.to
+    cc = self.private_cc
+    if to == mafia.events.PUBLIC:
+      # Players are only envelope recipients, so that replying to all
+      # replies to the game rather than every player.
+      headers = [self.from_address]
+      recipients = [address for name, address in self.roster_for(game).recipients("all")]
+      cc = cc + self.public_cc
+    else:
+      if not isinstance(to, list):
+        to = [to]
+      headers = ["%s <%s>" % (p.name, p.info["email"]) for p in to]
+      recipients = [p.info["email"] for p in to]
+
+    logging.info("Sending email:")
+    logging.info("  To:      %s" % ", ".join(headers))
+    logging.info("  Subject: %s" % message.subject)
+    logging.info("  Body:\n%s" % message.text)
+    self._send(message, to=headers, cc=cc, recipients=recipients + cc)
+
+  @property
+  def from_address(self):
+    return "%s <%s>" % (self.sender, self.address)
+
+  def _send(self, message, *, to, cc, recipients):
+    """Send <message> to the envelope <recipients> over the shared SMTP connection."""
+    mail = email.message.EmailMessage()
+    mail["From"]       = self.from_address
+    mail["To"]         = ", ".join(to)
+    if cc:
+      mail["Cc"]       = ", ".join(cc)
+    mail["Subject"]    = message.subject
+    mail["Date"]       = email.utils.formatdate(localtime=True)
+    mail["Message-ID"] = email.utils.make_msgid()
+    mail.set_content(message.text)
+    mail.add_alternative(message.body, subtype="html")
+
+    with self.lock:
+      try:
+        try:
+          self._connection().send_message(mail, self.address, recipients)
+        except smtplib.SMTPServerDisconnected:
+          # The relay closed the connection while it was idle.
+          self.smtp = None
+          self._connection().send_message(mail, self.address, recipients)
+      except (smtplib.SMTPException, OSError) as e:
+        if isinstance(e, smtplib.SMTPServerDisconnected) or not isinstance(e, smtplib.SMTPException):
+          self.smtp = None  # Refusals leave the connection usable, but this didn't.
+        raise ForumError("Failed to send email: %s" % e)
+
+  def _connection(self):
+    """Return the connection to the SMTP relay, connecting if necessary."""
+    if self.smtp is None:
+      smtp = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.timeout)
+      if self.starttls:
+        smtp.starttls()
+      if self.smtp_user:
+        smtp.login(self.smtp_user, self.smtp_password)
+      self.smtp = smtp
+    return self.smtp
+
+  def get_messages(self, game, cutoff):
+    """Yield the messages delivered up to <cutoff>, oldest first.
+
+    Each message is claimed before it's yielded, and flagged seen when the
+    Moderator asks for the next one, so an interrupted check hands out the
+    unflagged message again (and the Moderator drops the repeat).
+    """
+    roster = self.roster_for(game)
+    for name, claimed in self._claim(cutoff.timestamp()):
+      with open(claimed, "rb") as f:
+        mail = email.parser.BytesParser(policy=email.policy.default).parse(f)
+      message = self._parse_message(roster, mail, name)
+      if message:
+        yield message
+      os.rename(claimed, claimed + "S")
+
+  def _claim(self, cutoff):
+    """Claim the messages delivered up to <cutoff>, and return their (name, path).
+
+    Messages already claimed but not yet seen come first.
+    """
+    new = os.path.join(self.path, "new")
+    cur = os.path.join(self.path, "cur")
+    found = []
+    for directory in (cur, new):
+      with os.scandir(directory) as entries:
+        for entry in entries:
+          if entry.name.startswith("."):
+            continue
+          name, _, flags = entry.name.partition(":2,")
+          if directory == cur and (not entry.name.endswith(":2,") or "S" in flags):
+            continue
+          try:
+            modified = entry.stat().st_mtime
+          except FileNotFoundError:
+            continue  # Claimed by someone else.
+          if modified <= cutoff:
+            found.append((directory == new, modified, name, entry.path))
+
+    claimed = []
+    for is_new, modified, name, path in sorted(found):
+      if is_new:
+        claimed_path = os.path.join(cur, name + ":2,")
+        try:
+          os.rename(path, claimed_path)
+        except FileNotFoundError:
+          continue  # Claimed by someone else.
+        path = claimed_path
+      claimed.append((name, path))
+    return claimed
+
+  def _parse_message(self, roster, mail, name):
+    """Return the Message for a delivered email, or None if it isn't from a player."""
+    sender  = email.utils.parseaddr(mail.get("From", ""))[1]
+    subject = str(mail.get("Subject", ""))
+
+    player = roster.with_email(sender)
+    if not player:
+      logging.warning("Discarding message from non-player '%s'." % sender)
+      self._reply_to_stranger(sender, subject)
+      return None
+
+    logging.info("Received message from '%s'." % sender)
+    part = mail.get_body(("plain", "html"))
+    body = ""
+    if part is not None:
+      body = part.get_content()
+      if part.get_content_subtype() == "html":
+        body = html_to_text(body)
+    return Message(sender=player, subject=subject, body=strip_reply(body),
+                   id=str(mail.get("Message-ID") or name))
+
+  def _reply_to_stranger(self, address, subject):
+    """Tell someone who isn't playing that their message was ignored."""
+    if not address:
+      return
+    message = Message(to=None, subject=subject, body="Unrecognized player: '%s'." % address)
+    try:
+      self._send(message, to=[address], cc=[], recipients=[address])
+    except ForumError as e:
+      logging.warning("Failed to reply to non-player '%s': %s" % (address, e.message))
@@ -1,29 +1,162 @@
-import click
+import collections
+import concurrent.futures
 import datetime
+import hashlib
+import hmac
 import json
 import logging
-import re
 import requests
+import requests.adapters
 import requests.packages.urllib3
+import time
 
 import mafia
 
-from godfather.api.forum import Forum
+from godfather.api.forum import Forum, ForumError
 from godfather.api.message import Message
 
 # Disable "Starting new HTTPS connection" message.
 requests.packages.urllib3.connectionpool.log.setLevel(logging.WARNING)
 
 
+# The most recipients Mailgun accepts in one batch request.
+BATCH_LIMIT = 1000
+
+# The statuses with which Mailgun refuses a message without accepting it, so
+# that sending it again can't deliver it twice.
+POST_RETRY_STATUSES = (429, 503)
+
+# How old a signed webhook request can be before it's rejected as a replay.
+SIGNATURE_MAX_AGE = datetime.timedelta(minutes=15)
+
+class Batch(object):
+  """Messages with the same subject to be sent in one request.
+
+  A batch of several messages is sent with recipient-variables, which makes
+  Mailgun send each recipient their own copy addressed only to them. So only
+  messages to a single player are merged: a message to several players (like
+  a public announcement) goes in a batch of its own, sent as one email that
+  everyone can reply to all of. A message to more than BATCH_LIMIT players
+  is split across several batches.
+  """
+
+  def __init__(self, key, *, subject, cc):
+    self.key        = key
+    self.subject    = subject
+    self.cc         = cc
+    self.messages   = []
+    self.addresses  = []  # ["name <email>"] for each message
+    self.recipients = collections.OrderedDict()  # email -> (name, message)
+    self.to         = []  # "name <email>" of every recipient
+
+  def fits(self, recipients):
+    """Return whether the batch has room for a message to <recipients>."""
+    if len(self.recipients) + len(recipients) > BATCH_LIMIT:
+      return False
+    return not any(email in self.recipients for name, email in recipients)
+
+  def add(self, message, recipients, addresses):
+    """Add a message to <recipients> ((name, email)), formatted as <addresses>."""
+    self.messages.append(message)
+    self.addresses.append(addresses)
+    self.to += addresses
+    for name, email in recipients:
+      self.recipients[email] = (name, message)
+
+class MailgunRetry(requests.packages.urllib3.util.retry.Retry):
+  """Retries reads on any temporary failure, but sends only when they were refused.
+
+  After a 500 or a timeout, Mailgun may already have accepted a message, so
+  sending it again could email everyone twice.
+  """
+
+  def is_retry(self, method, status_code, has_retry_after=False):
+    if method == "POST":
+      return status_code in POST_RETRY_STATUSES
+    return super().is_retry(method, status_code, has_retry_after)
+
 class Mailgun(Forum):
-  def __init__(self, *, api_key, sender, address, domain, private_cc=None, public_cc=None):
-    self.api_key    = api_key
-    self.sender     = sender
-    self.address    = address
-    self.domain     = domain
-    self.private_cc = private_cc or []
-    self.public_cc  = public_cc or []
-    self.last_fetch = datetime.datetime.now()
+  poller = None  # A MailgunPoller polling on this forum's behalf, if any.
+
+  def __init__(self, *, api_key, sender, address, domain, private_cc=None, public_cc=None,
+               api_url="https://api.mailgun.net/v3", pool_size=10, timeout=30,
+               retries=5, backoff=0.5, max_backoff=30, fetch_workers=8, webhook_key=None):
+    self.api_key       = api_key
+    self.webhook_key   = webhook_key or api_key
+    self.sender        = sender
+    self.address       = address
+    self.domain        = domain
+    self.private_cc    = private_cc or []
+    self.public_cc     = public_cc or []
+    self.last_fetch    = datetime.datetime.now()
+    self.window        = None  # The check in progress: its end and last event.
+    self.recent        = {}    # event ID -> timestamp of events handed out lately
+
+    self.api_url       = api_url
+    self.pool_size     = pool_size
+    self.timeout       = timeout
+    self.retries       = retries
+    self.backoff       = backoff
+    self.max_backoff   = max_backoff
+    self.fetch_workers = fetch_workers
+    self._session      = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_session"] = None
+    state.pop("poller", None)
+    state.pop("metrics", None)
+    state.pop("roster", None)
+    return state
+
+  def __setstate__(self, state):
+    """Load a saved forum, filling in settings added since it was saved."""
+    defaults = {
+      "webhook_key":   state["api_key"],
+      "window":        None,
+      "recent":        {},
+      "api_url":       "https://api.mailgun.net/v3",
+      "pool_size":     10,
+      "timeout":       30,
+      "retries":       5,
+      "backoff":       0.5,
+      "max_backoff":   30,
+      "fetch_workers": 8,
+      "_session":      None,
+    }
+    self.__dict__.update(defaults)
+    self.__dict__.update(state)
+
+  @property
+  def session(self):
+    """A pooled HTTP session, created on first use (including after unpickling)."""
+    if self._session is None:
+      retry = MailgunRetry(
+        total=self.retries,
+        backoff_factor=self.backoff,
+        backoff_max=self.max_backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+      )
+      adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                              pool_maxsize=self.pool_size,
+                                              max_retries=retry)
+      self._session = requests.Session()
+      self._session.auth = ("api", self.api_key)
+      self._session.mount("https://", adapter)
+      self._session.mount("http://", adapter)
+    return self._session
+
+  def request(self, method, url, **kwargs):
+    """Make an API request, retrying temporary failures with backoff."""
+    try:
+      response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+    except requests.RequestException as e:
+      raise ForumError("Mailgun request failed: %s" % e)
+    retries = getattr(response.raw, "retries", None)
+    if self.metrics and retries:
+      self.metrics.increment("forum_retries_total", len(retries.history))
+    return response
 
   @property
   def email(self):
@@ -33,112 +166,342 @@ class Mailgun(Forum):
   def receipt_lag(self):
     # Mailgun does not guarantee that received messages will be immediately
     # visible via their API. If we check at 12:00:30, we should only assume
-    # that messages up to 12:00:00 are already available.
+    # that messages up to 12:00:00 are already available. Each check starts
+    # this far before the last one ended, to catch the ones that were late.
     return datetime.timedelta(seconds=30)
 
+  @property
+  def cursor(self):
+    window = self.window and dict(self.window)
+    return (self.last_fetch, window)
 
-  def strip_html(self, body):
-    body = re.sub(r"\n +", "\n", body)
-    body = re.sub(r"&lt;", "<", body)
-    body = re.sub(r"&gt;", ">", body)
-    body = re.sub(r"</h2>", ":", body)
-    body = re.sub(r"<li>", "  - ", body)
-    body = re.sub(r"\n</?ul>\n", "\n", body)
-    body = re.sub(r"<\w+?>|</\w+?>", "", body)
-    return body
+  @cursor.setter
+  def cursor(self, cursor):
+    self.last_fetch, self.window = cursor
 
   def send_message(self, game, message):
     """Send a message or raise an exception if unable."""
+    failures = self.send_messages(game, [message])
+    if failures:
+      raise failures[0][1]
+
+  def send_messages(self, game, messages):
+    """Send messages in as few batch requests as possible.
+
+    Messages with the same subject and CCs are merged into one request, with
+    each recipient's body passed in recipient-variables. Returns (message,
+    error) for each message that couldn't be sent.
+    """
+    failures = []
+    failed = set()  # IDs of the messages in failures, which may span several batches.
+    for batch in self._batches(game, messages):
+      try:
+        self._send_batch(batch)
+      except ForumError as e:
+        logging.error("Failed to send %d message(s): %s" % (len(batch.messages), e.message))
+        for message in batch.messages:
+          if id(message) not in failed:
+            failed.add(id(message))
+            failures.append((message, e))
+    return failures
+
+  def _batches(self, game, messages):
+    """Group messages into batches that can each be sent in one request."""
+    roster = self.roster_for(game)
+    batches = []
+    for message in messages:
+      to = message.to
+      cc = self.private_cc
+      if to == mafia.events.PUBLIC:
+        recipients = roster.recipients("all")
+        addresses = roster.addresses("all")
+        cc = cc + self.public_cc
+      else:
+        if not isinstance(to, list):
+          to = [to]
+        recipients = [(p.name, p.info["email"]) for p in to]
+        addresses = ["%s <%s>" % recipient for recipient in recipients]
+
+      # CC'd addresses get one copy of the request's body, so messages with
+      # CCs can only be merged with identical messages.
+      key = (message.subject, tuple(cc), message.body if cc else None)
+      if len(recipients) > 1:
+        for start in range(0, len(recipients), BATCH_LIMIT):
+          # Never merged, and CC'd addresses only need one copy.
+          batch = Batch(None, subject=message.subject, cc=cc if start == 0 else [])
+          batch.add(message, recipients[start:start + BATCH_LIMIT],
+                    addresses[start:start + BATCH_LIMIT])
+          batches.append(batch)
+        continue
+      for batch in batches:
+        if batch.key == key and batch.fits(recipients):
+          break
+      else:
+        batch = Batch(key, subject=message.subject, cc=cc)
+        batches.append(batch)
+      batch.add(message, recipients, addresses)
+    return batches
+
+  def _send_batch(self, batch):
+    """Send a batch of messages in one request."""
+    for message, addresses in zip(batch.messages, batch.addresses):
+      logging.info("Sending email:")
+      logging.info("  To:      %s" % ", ".join(addresses))
+      logging.info("  Subject: %s" % message.subject)
+      logging.info("  Body:\n%s" % message.text)
+
+    data = {
+      "from":    "%s <%s>" % (self.sender, self.email),
+      "to":      batch.to,
+      "cc":      batch.cc,
+      "subject": batch.subject,
+    }
+    if len(batch.messages) == 1:
+      data["text"] = batch.messages[0].text
+      data["html"] = batch.messages[0].body
+    else:
+      variables = {}
+      for email, (name, message) in batch.recipients.items():
+        variables[email] = {"name": name,
+                            "text": message.text,
+                            "html": message.body}
+      data["recipient-variables"] = json.dumps(variables)
+      if batch.cc:
+        # The messages are identical, and CC'd addresses have no variables.
+        data["text"] = batch.messages[0].text
+        data["html"] = batch.messages[0].body
+      else:
+        data["text"] = "%recipient.text%"
+        data["html"] = "%recipient.html%"
 
-    to = message.to
-    cc = self.private_cc
-    if to == mafia.events.PUBLIC:
-      to = game.all_players
-      cc = cc + self.public_cc
-    if not isinstance(to, list):
-      to = [to]
-
-    to = ["%s <%s>" % (p.name, p.info["email"]) for p in to]
-
-    logging.info("Sending email:")
-    logging.info("  To:      %s" % ", ".join(to))
-    logging.info("  Subject: %s" % message.subject)
-    logging.info("  Body:\n%s" % self.strip_html(message.body))
-
-    result = requests.post(
-        "https://api.mailgun.net/v3/%s/messages" % self.domain,
-        auth=("api", self.api_key),
-        data={
-          "from":    "%s <%s>" % (self.sender, self.email),
-          "to":      to,
-          "cc":      cc,
-          "subject": message.subject,
-          "text":    self.strip_html(message.body),
-          "html":    message.body,
-        })
+    result = self.request("POST", "%s/%s/messages" % (self.api_url, self.domain), data=data)
 
     if result.status_code != 200:
-      raise click.ClickException("Failed to send email (status code: %d): %s" %
-                                 (result.status_code, result.text))
+      raise ForumError("Failed to send email (status code: %d): %s" %
+                       (result.status_code, result.text))
 
-    logging.info("Message sent.")
+    logging.info("Sent %d message(s) to %d recipient(s)." %
+                 (len(batch.messages), len(batch.recipients)))
 
   def get_messages(self, game, cutoff):
-    """Return a list of messages received since the last check."""
-    cutoff = min(cutoff, datetime.datetime.now(cutoff.tzinfo) - self.receipt_lag)
-    messages = self._get_messages_from(game, self.last_fetch, cutoff)
-    self.last_fetch = cutoff
-    return messages
-
-  def _get_messages_from(self, game, start, end):
-    """Return all messages received during the specified period."""
-    logging.debug("Retrieving emails from %s to %s." % (start, end))
-
-    # Fetch message list
-    response = requests.get(
-      "https://api.mailgun.net/v3/%s/events" % self.domain,
-      auth=("api", self.api_key),
-      params={
-        "event": "stored",
-        "begin": start.timestamp(),
-        "end":   end.timestamp(),
-      }
-    )
-    if response.status_code != 200:
-      raise click.ClickException(
-        "%d error (%s) getting events from Mailgun: %s" %
-        (response.status_code, response.reason, response.text))
+    """Yield messages received since the last check, as they are retrieved.
+
+    Each check covers everything up to now (or <cutoff>), and overlaps the
+    last by the receipt lag to pick up messages that only became visible
+    since. Events already handed out aren't fetched again, and any repeats
+    that slip through (say after a restart) carry the same Message-Id, which
+    the Moderator ignores.
 
-    # Parse messages
-    messages = []
-    events = response.json()
-    players = {p.info["email"]: p for p in game.all_players}
-    for event in events["items"]:
+    The next page of events is listed while the current one is being
+    processed, and the cursor advances past each message as it's yielded, so
+    an interrupted check resumes right after the last message handed out.
+    If a MailgunPoller polls for this forum, messages come from it instead.
+    """
+    roster = self.roster_for(game)
+    if self.poller:
+      for email in self.poller.take(self, cutoff):
+        message = self._parse_message(roster, email)
+        if message:
+          yield message
+      return
+
+    if self.window is None:
+      cutoff = min(cutoff, datetime.datetime.now(cutoff.tzinfo))
+      self.window = {"end": cutoff, "after": None}
+
+    start = self.last_fetch - self.receipt_lag
+    logging.debug("Retrieving emails from %s to %s." % (start, self.window["end"]))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers) as pool:
+      pages = self.iter_events(start, self.window["end"])
+      next_page = pool.submit(next, pages, None)
+      while True:
+        events = next_page.result()
+        if events is None:
+          break
+
+        # Start fetching message bodies (in parallel) and the next page.
+        events = self._filter_events(events)
+        emails = [pool.submit(self._fetch_message, event) for event in events]
+        next_page = pool.submit(next, pages, None)
+
+        for event, email in zip(events, emails):
+          message = self._parse_message(roster, email.result())
+          self.window["after"] = (event["timestamp"], event["id"])
+          self.recent[event["id"]] = event["timestamp"]
+          if message:
+            yield message
+
+    self.last_fetch = self.window["end"]
+    self.window = None
+    self.recent = forget_before(self.recent, self.last_fetch - self.receipt_lag)
+
+  def iter_events(self, start, end):
+    """Yield pages of "stored" events from the specified period."""
+    url = "%s/%s/events" % (self.api_url, self.domain)
+    params = {
+      "event": "stored",
+      "begin": start.timestamp(),
+      "end":   end.timestamp(),
+    }
+    while True:
+      response = self.request("GET", url, params=params)
+      if response.status_code != 200:
+        raise ForumError(
+          "%d error (%s) getting events from Mailgun: %s" %
+          (response.status_code, response.reason, response.text))
+
+      page = response.json()
+      if len(page["items"]) == 0:
+        return
+      yield page["items"]
+
+      # The next page's URL includes all the query parameters.
+      url, params = page["paging"]["next"], None
+
+  def _filter_events(self, events):
+    """Return the events for messages to us that we haven't handled, in order."""
+    after = self.window["after"]
+    kept = []
+    for event in events:
       if self.email not in event["message"]["recipients"]:
         logging.debug("Discarding message addressed to '%s'." % event["message"]["recipients"])
         continue
+      if event["id"] in self.recent:
+        continue
+      if after and (event["timestamp"], event["id"]) <= tuple(after):
+        continue
+      kept.append(event)
+    return sorted(kept, key=lambda event: (event["timestamp"], event["id"]))
 
-      logging.debug("Retrieving email")
-      response = requests.get(event["storage"]["url"],
-                              auth=("api", self.api_key))
-      if response.status_code != 200:
-        raise click.ClickException(
-          "%d error (%s) getting message from Mailgun: %s" %
-          (response.status_code, response.reason, response.text))
+  def _parse_message(self, roster, email):
+    """Return the Message for a retrieved email, or None if it isn't from a player."""
+    sender  = email["sender"]
+    subject = email["subject"]
+    body    = email["stripped-text"]
 
-      email = response.json()
-      sender  = email["sender"]
-      subject = email["subject"]
-      body    = email["stripped-text"]
+    player = roster.with_email(sender)
+    if player:
+      logging.info("Received message from '%s'." % sender)
+      return Message(sender=player, subject=subject, body=body, id=email.get("Message-Id"))
 
-      if sender in players:
-        logging.info("Received message from '%s'." % sender)
-        messages.append(Message(sender=players[sender], subject=subject, body=body))
-      else:
-        logging.warning("Discarding message from non-player '%s'." % sender)
-        send_message(Message(
-          recipients=[sender],
-          subject=subject,
-          body="Unrecognized player: '%s'." % sender))
+    logging.warning("Discarding message from non-player '%s'." % sender)
+    self._reply_to_stranger(sender, subject)
+
+  def _reply_to_stranger(self, address, subject):
+    """Tell someone who isn't playing that their message was ignored.
+
+    The outbox only sends to players, so the reply is sent straight away.
+    """
+    batch = Batch(None, subject=subject, cc=[])
+    batch.add(Message(to=None, subject=subject, body="Unrecognized player: '%s'." % address),
+              [(address, address)], [address])
+    try:
+      self._send_batch(batch)
+    except ForumError as e:
+      logging.warning("Failed to reply to non-player '%s': %s" % (address, e.message))
+
+  def verify_push(self, form):
+    """Return the email forwarded to us by a Mailgun route.
+
+    Mailgun signs each request by HMACing its timestamp and a random token
+    with the webhook signing key. A replayed request is rejected once it's
+    older than SIGNATURE_MAX_AGE, and before that it only repeats a message
+    ID, which the Moderator ignores.
+    """
+    try:
+      timestamp, token, signature = form["timestamp"], form["token"], form["signature"]
+    except KeyError as e:
+      raise ForumError("Pushed message is missing %s." % e)
+
+    expected = hmac.new(self.webhook_key.encode(), (timestamp + token).encode(),
+                        hashlib.sha256).hexdigest()
+    # Compared as bytes, since compare_digest rejects non-ASCII strings.
+    if not hmac.compare_digest(expected.encode(), signature.encode()):
+      raise ForumError("Pushed message has a bad signature.")
+    try:
+      age = abs(time.time() - float(timestamp))
+    except ValueError:
+      raise ForumError("Pushed message has a bad timestamp: %r" % timestamp)
+    if not age <= SIGNATURE_MAX_AGE.total_seconds():  # Also catches a "nan" timestamp.
+      raise ForumError("Pushed message signature has expired.")
+    return form
+
+  def parse_push(self, game, email):
+    """Return the Message for an email forwarded to us by a Mailgun route."""
+    recipients = [r.strip() for r in email.get("recipient", "").split(",")]
+    if self.email not in recipients:
+      logging.debug("Discarding pushed message addressed to '%s'." % email.get("recipient"))
+      return None
+    return self._parse_message(self.roster_for(game), email)
+
+  def _fetch_message(self, event):
+    """Retrieve the stored message for an event."""
+    logging.debug("Retrieving email")
+    response = self.request("GET", event["storage"]["url"])
+    if response.status_code != 200:
+      raise ForumError(
+        "%d error (%s) getting message from Mailgun: %s" %
+        (response.status_code, response.reason, response.text))
+    return response.json()
+
+class MailgunPoller(object):
+  """Polls one Mailgun domain on behalf of several games' forums.
+
+  Every game on a domain sees the same event stream, so rather than each
+  forum listing all of it and discarding other games' messages, the poller
+  lists and fetches each message once and sets it aside for the forum it was
+  sent to. Those forums' get_messages() then take messages from here.
+  """
+
+  def __init__(self, forums):
+    self.forums = {}
+    for forum in forums:
+      if forum.email in self.forums:
+        raise ForumError("Two games use the address %s." % forum.email)
+      self.forums[forum.email] = forum
+      forum.poller = self
+    self.api        = forums[0]  # All the forums share a domain and API key.
+    self.last_fetch = min((f.last_fetch for f in forums), key=lambda d: d.timestamp())
+    self.emails     = {address: [] for address in self.forums}  # address -> [(event, email)]
+    self.recent     = {}  # event ID -> timestamp of events fetched lately
+
+  def poll(self, now):
+    """Fetch the messages received up to <now>.
+
+    Like Mailgun.get_messages, each poll overlaps the last by the receipt
+    lag, and skips the events it has already fetched.
+    """
+    start = self.last_fetch - self.api.receipt_lag
+    logging.debug("Retrieving emails for %d games from %s to %s." %
+                  (len(self.forums), start, now))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.api.fetch_workers) as pool:
+      fetches = []
+      for events in self.api.iter_events(start, now):
+        for event in events:
+          if event["id"] in self.recent:
+            continue
+          for address in event["message"]["recipients"]:
+            if address in self.forums:
+              fetches.append((address, event, pool.submit(self.api._fetch_message, event)))
+      for address, event, email in fetches:
+        self.emails[address].append((event, email.result()))
+        self.recent[event["id"]] = event["timestamp"]
+    self.last_fetch = now
+    self.recent = forget_before(self.recent, now - self.api.receipt_lag)
+
+  def take(self, forum, cutoff):
+    """Remove and return <forum>'s emails received up to <cutoff>, oldest first."""
+    ready, waiting = [], []
+    for event, email in self.emails[forum.email]:
+      (ready if event["timestamp"] <= cutoff.timestamp() else waiting).append((event, email))
+    self.emails[forum.email] = waiting
+
+    # Emails past the cutoff are only held in memory, so the forum's own
+    # record of what it has seen mustn't move past them.
+    forum.last_fetch = min(cutoff, self.last_fetch, key=lambda d: d.timestamp())
+    ready.sort(key=lambda item: (item[0]["timestamp"], item[0]["id"]))
+    return [email for event, email in ready]
 
-    return messages
+def forget_before(recent, start):
+  """Return the <recent> events (ID -> timestamp) that a check from <start> could list again."""
+  return {id: timestamp for id, timestamp in recent.items() if timestamp >= start.timestamp()}
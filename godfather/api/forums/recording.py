@@ -0,0 +1,209 @@
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import mafia
+
+from godfather.api.forum import Forum, ForumError
+from godfather.api.forums.simulated import Measured, current_phase
+from godfather.api.message import Message
+from godfather.clock import VirtualClock
+
+class Recording(Forum):
+  """Wraps a forum, recording the messages it receives and sends.
+
+  Each message is appended to <path> as a line of JSON, with the time, so
+  that 'godfather replay' can play the game again offline with a Replay.
+  Received messages are kept whole. Sent ones only by recipients, subject and
+  a digest of the body, which is enough to tell whether a replay sent the
+  same. Times come from <clock> if given, as with the Moderator.
+  """
+
+  def __init__(self, forum, path="game.recording", *, clock=None):
+    self.forum   = forum
+    self.path    = os.path.abspath(path)
+    self.clock   = clock
+    self.created = self.now()  # When the game was set up, which fixes its phase ends.
+    self.lock    = threading.Lock()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop("lock")
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  def now(self):
+    if self.clock:
+      return self.clock.now(datetime.timezone.utc)
+    return datetime.datetime.now(datetime.timezone.utc)
+
+  def write(self, **record):
+    """Append a record, starting the file with a header if it's new."""
+    with self.lock, open(self.path, "a") as f:
+      if f.tell() == 0:
+        f.write(json.dumps({"start": self.created.isoformat(),
+                            "receipt_lag": self.receipt_lag.total_seconds()}) + "\n")
+      f.write(json.dumps(dict(t=self.now().isoformat(), **record)) + "\n")
+
+  def write_received(self, game, message):
+    self.write(phase=str(current_phase(game)), sender=message.sender.unique_name,
+               subject=message.subject, body=message.body, id=message.get("id"))
+
+  @property
+  def metrics(self):
+    return self.forum.metrics
+
+  @metrics.setter
+  def metrics(self, metrics):
+    self.forum.metrics = metrics
+
+  @property
+  def roster(self):
+    return self.forum.roster
+
+  @roster.setter
+  def roster(self, roster):
+    self.forum.roster = roster
+
+  @property
+  def receipt_lag(self):
+    return self.forum.receipt_lag
+
+  @property
+  def cursor(self):
+    return self.forum.cursor
+
+  @cursor.setter
+  def cursor(self, cursor):
+    self.forum.cursor = cursor
+
+  def send_messages(self, game, messages):
+    failures = self.forum.send_messages(game, messages)
+    failed = {id(message) for message, error in failures}
+    for message in messages:
+      if id(message) not in failed:
+        self.write(to=recipients(message), subject=message.subject, digest=digest(message.body))
+    return failures
+
+  def get_messages(self, game, cutoff):
+    for message in self.forum.get_messages(game, cutoff):
+      self.write_received(game, message)
+      yield message
+
+  def watch(self, wake):
+    self.forum.watch(wake)
+
+  def unwatch(self):
+    self.forum.unwatch()
+
+  def verify_push(self, form):
+    return self.forum.verify_push(form)
+
+  def parse_push(self, game, email):
+    message = self.forum.parse_push(game, email)
+    if message:
+      self.write_received(game, message)
+    return message
+
+class Replay(Measured):
+  """Plays a Recording's messages back to a Moderator, and checks its replies.
+
+  The Moderator should run on this forum's clock, which starts when the
+  recorded game was set up. Each message is handed out on the first poll
+  after the time it was received, or at the latest when its phase ends, so
+  it lands in the same phase as it did originally. The clock runs out just
+  after the last recorded message, received or sent.
+  """
+
+  def __init__(self, path="game.recording"):
+    super().__init__()
+    header, received, sent, last = read_recording(path)
+    self.lag      = datetime.timedelta(seconds=header["receipt_lag"])
+    self.waiting  = collections.deque(received)
+    self.expected = collections.Counter(sent)  # What the recorded game sent
+    self.replayed = collections.Counter()      # and what this one has.
+    self.clock = VirtualClock(header["start"], until=last + datetime.timedelta(minutes=1))
+
+  @property
+  def receipt_lag(self):
+    return self.lag
+
+  def send_messages(self, game, messages):
+    with self.lock:
+      self.replayed.update(sent_key(recipients(m), m.subject, digest(m.body)) for m in messages)
+    return super().send_messages(game, messages)
+
+  def get_messages(self, game, cutoff):
+    self.note_phase(game)
+    phase = str(self.phase)
+    played = {name for name, snapshot in self.phases[:-1]}
+    now = self.clock.now(datetime.timezone.utc)
+
+    messages = []
+    while self.waiting:
+      record = self.waiting[0]
+      if record["phase"] in played:
+        logging.warning("Replaying a message from %s late, in %s." % (record["phase"], phase))
+      elif record["phase"] != phase or (record["t"] > now and now <= cutoff):
+        break
+      self.waiting.popleft()
+      messages.append(Message(sender=game.player_named(record["sender"]),
+                              subject=record["subject"], body=record["body"], id=record["id"]))
+    return messages
+
+  def differences(self):
+    """Return the messages only the recorded game sent, and those only the replay did.
+
+    Each is (recipients, subject, body digest), where the recipients are
+    "public" or a tuple of unique names.
+    """
+    return (sorted((self.expected - self.replayed).elements(), key=str),
+            sorted((self.replayed - self.expected).elements(), key=str))
+
+def read_recording(path):
+  """Return a recording's header, received messages, sent message keys and last time.
+
+  A partly written last line, say from a crash, is skipped.
+  """
+  header, received, sent, last = None, [], [], None
+  with open(path) as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        logging.warning("Skipping a corrupt line in %s." % path)
+        continue
+      if header is None:
+        header = record
+        header["start"] = last = datetime.datetime.fromisoformat(record["start"])
+        continue
+      record["t"] = last = datetime.datetime.fromisoformat(record["t"])
+      if "sender" in record:
+        received.append(record)
+      else:
+        sent.append(sent_key(record["to"], record["subject"], record["digest"]))
+  if header is None:
+    raise ForumError("%s is empty." % path)
+  return header, received, sent, last
+
+def recipients(message):
+  """Return who a message is to: "public", or a list of unique names."""
+  to = message.to
+  if to == mafia.events.PUBLIC:
+    return "public"
+  if not isinstance(to, list):
+    to = [to]
+  return [player.unique_name for player in to]
+
+def sent_key(to, subject, digest):
+  return ("public" if to == "public" else tuple(to), subject, digest)
+
+def digest(body):
+  return hashlib.sha1(body.encode()).hexdigest()[:16]
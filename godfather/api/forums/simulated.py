@@ -0,0 +1,116 @@
+import collections
+import datetime
+import random
+import threading
+
+import mafia
+
+from godfather.api.forum import Forum
+from godfather.api.message import Message
+
+# Bodies of messages that players send by mistake.
+TYPOS = ["I don't know what to do", "vtoe", "Who's the Cop?", ""]
+
+class Measured(Forum):
+  """A local forum that notes the game's progress, for reports on a run.
+
+  When the Moderator gives the forum its Metrics, their values are noted as
+  each phase starts, so a run can be broken down by phase. Sent messages are
+  converted to text and counted, as a real forum would.
+  """
+
+  def __init__(self):
+    self.phase  = None
+    self.phases = []  # (phase, metrics snapshot) at the start of each phase
+    self.sent   = 0
+    self.lock   = threading.Lock()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop("lock")
+    state.pop("metrics", None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  @property
+  def receipt_lag(self):
+    return datetime.timedelta()
+
+  def send_messages(self, game, messages):
+    for message in messages:
+      message.text  # Mailgun sends a text version of every message.
+    with self.lock:
+      self.sent += len(messages)
+    return []
+
+  def note_phase(self, game):
+    """Note the phase being played, and return whether it has just started."""
+    phase = current_phase(game)
+    if phase == self.phase:
+      return False
+    self.phase = phase
+    if self.metrics:
+      self.phases.append((str(phase), self.metrics.snapshot()))
+    return True
+
+class Simulated(Measured):
+  """A local forum whose players send random but plausible messages.
+
+  At the start of each phase, every living player gets a share of
+  <messages_per_phase> messages (ten each by default): day votes, mostly for
+  the phase's prime suspect, or at night their actions (or a new will if they
+  have none), all targeting random living players, plus the odd typo. The
+  messages are handed out <per_poll> at a time, like a busy mailbox.
+  """
+
+  def __init__(self, *, seed=0, messages_per_phase=None, per_poll=100, typo_rate=0.02):
+    super().__init__()
+    self.random             = random.Random(seed)
+    self.messages_per_phase = messages_per_phase
+    self.per_poll           = per_poll
+    self.typo_rate          = typo_rate
+    self.waiting            = collections.deque()
+    self.next_id            = 0
+
+  def get_messages(self, game, cutoff):
+    if self.note_phase(game):
+      self.waiting.extend(self.generate(game, self.phase))
+    return [self.waiting.popleft() for i in range(min(self.per_poll, len(self.waiting)))]
+
+  def generate(self, game, phase):
+    """Return a phase's worth of messages from the living players."""
+    parser = mafia.Parser(game)
+    players = game.players
+    suspect = self.random.choice(players)
+    count = self.messages_per_phase or 10 * len(players)
+    night_commands = {}  # player -> their night commands, which are slow to list
+    for i in range(count):
+      sender = self.random.choice(players)
+      if self.random.random() < self.typo_rate:
+        body = self.random.choice(TYPOS)
+      elif isinstance(phase, mafia.Day):
+        target = suspect if self.random.random() < 0.7 else self.random.choice(players)
+        body = "vote %s" % target.name
+      else:
+        if sender not in night_commands:
+          night_commands[sender] = [c for c in parser.get_commands(sender)
+                                    if c.phase is mafia.Night]
+        commands = night_commands[sender]
+        if commands:
+          body = self.random.choice(commands).help
+          while "PLAYER" in body:
+            body = body.replace("PLAYER", self.random.choice(players).name, 1)
+        else:
+          body = "set will: I was %s." % sender.name
+      self.next_id += 1
+      yield Message(sender=sender, subject="Simulated", body=body, id="sim-%d" % self.next_id)
+
+def current_phase(game):
+  """Return the phase being played: the one after the last phase resolved."""
+  phase = game.log.current_phase
+  if isinstance(phase, (mafia.Day, mafia.Night)):
+    return phase.next_phase()
+  return mafia.Night(0)
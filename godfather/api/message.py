@@ -1,7 +1,22 @@
+from .text import html_to_text
+
 class Message(dict):
   def __getattr__(self, attr):
-    return self[attr]
+    try:
+      return self[attr]
+    except KeyError:
+      raise AttributeError(attr)
+
+  def __getstate__(self):
+    return {}  # Just the items: the cached text is worked out again when needed.
 
   def __repr__(self):
     items = ["%s=%r" % (k, v) for k, v in self.items() if v]
     return "Message(%s)" % ", ".join(items)
+
+  @property
+  def text(self):
+    """The body as plain text, converted once and cached."""
+    if "_text" not in self.__dict__:
+      self.__dict__["_text"] = html_to_text(self["body"])
+    return self.__dict__["_text"]
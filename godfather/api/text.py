@@ -0,0 +1,43 @@
+import html
+import re
+
+# Every token the converter rewrites, in one pattern:
+#   - <ul> and </ul> on lines of their own (the line is dropped),
+#   - indentation at the start of a line,
+#   - tags without attributes,
+#   - character references like &lt; &amp; &#39; and &#x2014;.
+TOKEN = re.compile(r"(\n(?: *</?ul>(?=\n)| +)|</?\w+>|&#?\w+;)")
+
+# Text that replaces particular tags. Other tags are removed.
+TAG_TEXT = {
+  "</h2>": ":",
+  "<li>":  "  - ",
+}
+
+class TokenTable(dict):
+  """Maps each token to its replacement, working out new tokens on first use."""
+
+  MAX_SIZE = 4096  # Stop remembering new tokens after this many.
+
+  def __missing__(self, token):
+    if token[0] == "\n":
+      text = "" if token[-1] == ">" else "\n"
+    elif token[0] == "<":
+      text = TAG_TEXT.get(token, "")
+    else:
+      text = html.unescape(token)
+    if len(self) < self.MAX_SIZE:
+      self[token] = text
+    return text
+
+_tokens = TokenTable()
+
+def html_to_text(body):
+  """Convert a message body from our simple HTML to plain text in one pass.
+
+  Splitting on TOKEN leaves plain text at even indices and tokens at odd ones,
+  so only the tokens need replacing.
+  """
+  parts = TOKEN.split(body)
+  parts[1::2] = map(_tokens.__getitem__, parts[1::2])
+  return "".join(parts)
@@ -0,0 +1,176 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+
+import mafia
+
+from godfather.storage import atomic_write
+
+# The number of log events stored in each log chunk. Every chunk but the last
+# is full, so it is identical in every later checkpoint and only stored once.
+LOG_CHUNK_SIZE = 64
+
+class CheckpointPickler(pickle.Pickler):
+  """A Pickler that stores references to shared objects instead of copies."""
+
+  def __init__(self, file, refs):
+    super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+    self.refs = refs
+
+  def persistent_id(self, obj):
+    return self.refs.get(id(obj))
+
+class CheckpointUnpickler(pickle.Unpickler):
+  """An Unpickler that resolves references stored by CheckpointPickler."""
+
+  def __init__(self, file, objects):
+    super().__init__(file)
+    self.objects = objects
+
+  def persistent_load(self, pid):
+    return self.objects[pid]
+
+class CheckpointStore(object):
+  """A deduplicating store of Moderator checkpoints.
+
+  Each checkpoint is split into chunks: the player roster, the game log in
+  runs of LOG_CHUNK_SIZE events, and the remaining phase state. Chunks are
+  stored once under their SHA-256 hash, and each checkpoint is a small JSON
+  manifest listing the chunks it's made of.
+
+  Layout:
+    backups/chunks/ab/ab12...   Pickled chunks.
+    backups/manifests/NAME.json Checkpoint manifests.
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  @property
+  def chunk_dir(self):
+    return os.path.join(self.path, "chunks")
+
+  @property
+  def manifest_dir(self):
+    return os.path.join(self.path, "manifests")
+
+  def chunk_path(self, digest):
+    return os.path.join(self.chunk_dir, digest[:2], digest)
+
+  def manifest_path(self, name):
+    return os.path.join(self.manifest_dir, "%s.json" % name)
+
+  def names(self):
+    """Return the names of all checkpoints, oldest first."""
+    if not os.path.isdir(self.manifest_dir):
+      return []
+    names = [f[:-len(".json")] for f in os.listdir(self.manifest_dir) if f.endswith(".json")]
+    return sorted(names, key=lambda name: self.read_manifest(name)["created"])
+
+  def __contains__(self, name):
+    return os.path.isfile(self.manifest_path(name))
+
+  def save(self, name, moderator):
+    """Save a checkpoint of <moderator> under <name>."""
+    game = moderator.game
+    log = game.log
+    shared = {id(game): "game", id(log): "log"}
+    refs = dict(shared)
+    for i, player in enumerate(game.player_list):
+      refs[id(player)] = ("player", i)
+      refs[id(player._role)] = ("role", i)
+    for i, faction in enumerate(game.faction_list):
+      refs[id(faction)] = ("faction", i)
+
+    manifest = {
+      "name":    name,
+      "created": datetime.datetime.now().isoformat(),
+      "roster":  self.put((game.player_list, game.faction_list), shared),
+      "log":     [self.put(list(log[i:i + LOG_CHUNK_SIZE]), refs)
+                  for i in range(0, len(log), LOG_CHUNK_SIZE)],
+      "state":   self.put({"moderator": moderator,
+                           "game":      game.__dict__,
+                           "log":       log.__dict__}, refs),
+    }
+    os.makedirs(self.manifest_dir, exist_ok=True)
+    atomic_write(self.manifest_path(name), json.dumps(manifest, indent=2).encode())
+    logging.debug("Saved checkpoint %s (%d chunks)." % (name, len(manifest["log"]) + 2))
+
+  def load(self, name):
+    """Rebuild the Moderator saved in checkpoint <name>."""
+    manifest = self.read_manifest(name)
+
+    # The game and log are created empty so that chunks can refer to them
+    # before their contents (which refer back to the chunks) are loaded.
+    game = mafia.Game.__new__(mafia.Game)
+    log = mafia.Log.__new__(mafia.Log)
+    objects = {"game": game, "log": log}
+
+    players, factions = self.get(manifest["roster"], objects)
+    for i, player in enumerate(players):
+      objects[("player", i)] = player
+      objects[("role", i)] = player._role
+    for i, faction in enumerate(factions):
+      objects[("faction", i)] = faction
+
+    for digest in manifest["log"]:
+      list.extend(log, self.get(digest, objects))
+
+    state = self.get(manifest["state"], objects)
+    game.__dict__.update(state["game"])
+    log.__dict__.update(state["log"])
+    return state["moderator"]
+
+  def read_manifest(self, name):
+    with open(self.manifest_path(name)) as f:
+      return json.load(f)
+
+  def put(self, obj, refs):
+    """Store a chunk if it isn't already stored, and return its hash."""
+    buffer = io.BytesIO()
+    CheckpointPickler(buffer, refs).dump(obj)
+    data = buffer.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+
+    path = self.chunk_path(digest)
+    if not os.path.isfile(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      atomic_write(path, data)
+    return digest
+
+  def get(self, digest, objects):
+    with open(self.chunk_path(digest), "rb") as f:
+      return CheckpointUnpickler(f, objects).load()
+
+  def prune(self, keep, *, pinned=("_setup", "_start")):
+    """Delete all but the <keep> newest checkpoints, and return the deleted names.
+
+    Checkpoints whose names end with one of <pinned> are always kept.
+    """
+    names = [n for n in self.names() if not n.endswith(pinned)]
+    deleted = names[:max(len(names) - keep, 0)]
+    for name in deleted:
+      os.remove(self.manifest_path(name))
+    return deleted
+
+  def compact(self):
+    """Delete chunks no checkpoint refers to, and return the bytes freed."""
+    live = set()
+    for name in self.names():
+      manifest = self.read_manifest(name)
+      live.update([manifest["roster"], manifest["state"]] + manifest["log"])
+
+    freed = 0
+    if not os.path.isdir(self.chunk_dir):
+      return freed
+    for prefix in os.listdir(self.chunk_dir):
+      for digest in os.listdir(os.path.join(self.chunk_dir, prefix)):
+        if digest not in live:
+          path = self.chunk_path(digest)
+          freed += os.path.getsize(path)
+          os.remove(path)
+    return freed
@@ -0,0 +1,24 @@
+import datetime
+
+# The least time a sleep takes. Deadlines are only due once they've passed,
+# so sleeping until one must move the clock past it, as real time would.
+TICK = datetime.timedelta(milliseconds=1)
+
+class VirtualClock(object):
+  """A clock that only moves when the Moderator sleeps.
+
+  Give one to a Moderator (as clock=) to run a game as fast as the CPU
+  allows: sleeping until the next deadline just moves the clock forward.
+  """
+
+  def __init__(self, start, *, until=None):
+    self.time  = start
+    self.until = until  # When to stop the game, if it hasn't ended by then.
+
+  def now(self, time_zone):
+    return self.time.astimezone(time_zone)
+
+  def sleep(self, seconds):
+    """Skip ahead <seconds>, and return whether the game should continue."""
+    self.time += max(datetime.timedelta(seconds=seconds), TICK)
+    return self.until is None or self.time < self.until
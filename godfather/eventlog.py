@@ -0,0 +1,162 @@
+import json
+import os
+
+import mafia
+
+class EventLog(object):
+  """An append-only copy of the game log that can be read without unpickling.
+
+  Each line is a JSON record of one event: its index in the game log, its
+  phase, type, recipients and colored text, so readers can filter events
+  without building any game objects. A second file indexes the byte offset
+  at which each phase starts.
+
+  Events are written by index, so replaying the journal after a restart
+  doesn't write them twice, and any missing earlier events are filled in.
+
+  Layout:
+    game.events        One JSON record per line.
+    game.events.index  One {"phase", "offset"} JSON record per phase.
+  """
+
+  def __init__(self, path):
+    self.path       = path
+    self.file       = None
+    self.count      = None  # Number of events in the file, found on first append.
+    self.last_phase = None
+
+  def __getstate__(self):
+    return {"path": self.path, "file": None, "count": None, "last_phase": None}
+
+  @property
+  def index_path(self):
+    return self.path + ".index"
+
+  def append(self, log, event):
+    """Write <event>, which is about to be appended to <log>."""
+    if self.file is None:
+      self._open()
+    index = len(log)
+    for i in range(self.count, index):
+      self._write(i, log[i])
+    if index >= self.count:
+      self._write(index, event)
+    self.file.flush()
+
+  def rewind(self, count):
+    """Drop every event after the first <count>, as when a backup is restored."""
+    self.close()
+    if not os.path.isfile(self.path):
+      return
+    offset = 0
+    with open(self.path, "rb") as f:
+      for line in f:
+        if json.loads(line.decode())["index"] >= count:
+          break
+        offset += len(line)
+    with open(self.path, "r+b") as f:
+      f.truncate(offset)
+    if os.path.isfile(self.index_path):
+      phases = [p for p in read_index(self.index_path) if p["offset"] < offset]
+      with open(self.index_path, "w") as f:
+        f.writelines(json.dumps(p) + "\n" for p in phases)
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    self.count = None
+
+  def _open(self):
+    """Find where the file left off, dropping any torn last line."""
+    self.count, self.last_phase = 0, None
+    if os.path.isfile(self.path):
+      with open(self.path, "r+b") as f:
+        start = max(f.seek(0, os.SEEK_END) - 64 * 1024, 0)
+        f.seek(start)
+        tail = f.read()
+        complete = tail.rfind(b"\n") + 1
+        if complete < len(tail):
+          f.truncate(start + complete)
+        lines = tail[:complete].splitlines()
+        if lines:
+          last = json.loads(lines[-1].decode())
+          self.count, self.last_phase = last["index"] + 1, last["phase"]
+    self.file = open(self.path, "ab")
+
+  def _write(self, index, event):
+    phase = str(event.phase)
+    if phase != self.last_phase:
+      with open(self.index_path, "a") as f:
+        f.write(json.dumps({"phase": phase, "offset": self.file.tell()}) + "\n")
+      self.last_phase = phase
+    self.file.write((json.dumps(event_record(index, event)) + "\n").encode())
+    self.count = index + 1
+
+def event_record(index, event):
+  """Return the JSON record for the <index>th event in the game log."""
+  if event.to == mafia.events.PUBLIC:
+    to = "public"
+  elif event.to:
+    to = [p.unique_name for p in event.to]
+  else:
+    to = None
+  return {
+    "index": index,
+    "phase": str(event.phase),
+    "type":  type(event).__name__,
+    "to":    to,
+    "text":  event.colored_str(),
+  }
+
+def read_index(index_path):
+  """Return the {"phase", "offset"} records of a phase index."""
+  with open(index_path) as f:
+    return [json.loads(line) for line in f if line.endswith("\n")]
+
+def normalize(name):
+  return name.replace(" ", "").lower()
+
+def matches(record, *, phase=None, player=None, type=None):
+  """Return whether an event record passes the given filters."""
+  if phase and normalize(record["phase"]) != normalize(phase):
+    return False
+  if type and normalize(record["type"]) != normalize(type):
+    return False
+  if player and record["to"] != "public" and normalize(player) not in (record["to"] or []):
+    return False
+  return True
+
+def read_events(path, *, phase=None, player=None, type=None, sleep=None, poll_interval=0.5):
+  """Yield the event records in an event log that pass the given filters.
+
+  Records are read one line at a time, so memory use doesn't grow with the
+  log. With --phase, reading starts at the phase's offset in the index. If
+  <sleep> is given, keep waiting for new events (calling sleep(poll_interval)
+  between checks) until it returns False.
+  """
+  offset, indexed = 0, False
+  if phase and os.path.isfile(path + ".index"):
+    offsets = [p["offset"] for p in read_index(path + ".index")
+               if normalize(p["phase"]) == normalize(phase)]
+    if offsets:
+      offset, indexed = offsets[0], True
+    elif not sleep:
+      return
+
+  with open(path, "rb") as f:
+    f.seek(offset)
+    while True:
+      line = f.readline()
+      if line.endswith(b"\n"):
+        record = json.loads(line.decode())
+        if matches(record, phase=phase, player=player, type=type):
+          yield record
+        elif indexed and not sleep and normalize(record["phase"]) != normalize(phase):
+          return  # Past the end of the phase.
+        continue
+
+      # Wait for the rest of a partly written line, or for a new one.
+      f.seek(-len(line), os.SEEK_CUR)
+      if not sleep or not sleep(poll_interval):
+        return
@@ -0,0 +1,114 @@
+import collections
+import datetime
+import flask
+import logging
+import threading
+import werkzeug.middleware.dispatcher
+
+from godfather.api.forum import ForumError
+from godfather.api.forums.mailgun import Mailgun, MailgunPoller
+from godfather.moderator import POLL_INTERVAL, scheduler
+from godfather.server import Server, make_server
+
+class Host(object):
+  """Runs many games in one process.
+
+  The games share one MailgunPoller per Mailgun domain, one web server (with
+  each game's pages under /NAME/), and the scheduler, which sleeps until the
+  earliest deadline of any game.
+  """
+
+  def __init__(self, moderators, *, host="127.0.0.1", port=5000):
+    self.moderators = moderators  # name -> Moderator
+    self.pollers    = make_pollers(moderators.values())
+    self.next_poll  = None
+    self.server     = make_server(self.app(), host=host, port=port)
+
+  def app(self):
+    """Return a WSGI app serving each game's Server under its name."""
+    index = flask.Flask(__name__)
+
+    @index.route("/")
+    def games():
+      return "\n".join(sorted(self.moderators))
+
+    mounts = {"/%s" % name: Server(moderator) for name, moderator in self.moderators.items()}
+    return werkzeug.middleware.dispatcher.DispatcherMiddleware(index, mounts)
+
+  def run(self):
+    """Run every game until they all finish or an interrupt is received."""
+    running = {}
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    try:
+      for name, moderator in self.moderators.items():
+        if self.open(name, moderator):
+          running[name] = moderator
+
+      while running:
+        self.poll()
+        for name, moderator in list(running.items()):
+          if not self.step(name, moderator):
+            del running[name]
+            moderator.close()
+        if running and not self.sleep(running.values()):
+          break
+    finally:
+      self.server.shutdown()
+      for moderator in running.values():
+        moderator.close()
+
+  def poll(self):
+    """Poll the shared pollers, if it's time."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if self.next_poll is not None and now < self.next_poll:
+      return
+    for poller in self.pollers:
+      try:
+        poller.poll(now)
+      except ForumError as e:
+        logging.warning("Failed to fetch messages, will retry: %s" % e.message)
+    self.next_poll = now + POLL_INTERVAL
+
+  def open(self, name, moderator):
+    """Open one game, and return whether it started.
+
+    Like step(), a game that fails to open is stopped on its own.
+    """
+    try:
+      moderator.open()
+      return True
+    except Exception:
+      logging.exception("Stopping %s after an unexpected error." % name)
+    try:
+      moderator.close()
+    except Exception:
+      logging.exception("Failed to close %s." % name)
+    return False
+
+  def step(self, name, moderator):
+    """Step one game, and return whether it's still going.
+
+    A game that crashes is stopped without taking the others down with it.
+    """
+    try:
+      return moderator.step()
+    except Exception:
+      logging.exception("Stopping %s after an unexpected error." % name)
+      return False
+
+  def sleep(self, moderators):
+    """Sleep until any game has work to do, and return whether to continue."""
+    wakeup = min(moderator.next_wakeup() for moderator in moderators)
+    if self.pollers:
+      wakeup = min(wakeup, self.next_poll)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return scheduler.sleep((wakeup - now).total_seconds())
+
+def make_pollers(moderators):
+  """Return a MailgunPoller for each Mailgun domain the games use."""
+  domains = collections.defaultdict(list)
+  for moderator in moderators:
+    forum = moderator.forum
+    if isinstance(forum, Mailgun):
+      domains[(forum.api_url, forum.domain, forum.api_key)].append(forum)
+  return [MailgunPoller(forums) for forums in domains.values()]
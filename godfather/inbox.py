@@ -0,0 +1,46 @@
+import collections
+import threading
+
+class Inbox(object):
+  """A thread-safe queue of emails pushed to us, waiting for the Moderator.
+
+  The web server puts emails here as they arrive, calling on_put to wake the
+  Moderator loop. Waiting emails aren't pickled: the forum still has them, so
+  the reconciliation poll after a restart picks them up.
+  """
+
+  def __init__(self):
+    self._init_runtime_state()
+
+  def _init_runtime_state(self):
+    self.lock      = threading.Lock()
+    self.emails    = collections.deque()
+    self.on_put    = None
+
+  def __getstate__(self):
+    return {}
+
+  def __setstate__(self, state):
+    self._init_runtime_state()
+
+  def __len__(self):
+    return len(self.emails)
+
+  def put(self, email):
+    """Add a pushed email, and let the Moderator know."""
+    with self.lock:
+      self.emails.append(email)
+    if self.on_put:
+      self.on_put()
+
+  def take(self):
+    """Remove and return every waiting email."""
+    with self.lock:
+      emails = list(self.emails)
+      self.emails.clear()
+      return emails
+
+  def put_back(self, emails):
+    """Return taken emails to the front of the queue, without waking anyone."""
+    with self.lock:
+      self.emails.extendleft(reversed(emails))
@@ -0,0 +1,108 @@
+import logging
+import os
+import pickle
+import threading
+
+class Journal(object):
+  """An append-only log of the changes made since the last full snapshot.
+
+  Each record is a (sequence number, kind, data) tuple pickled onto the end of
+  the journal file. Records are written before the change they describe is
+  applied, so a Moderator can be rebuilt from its last snapshot plus every
+  record with a higher sequence number.
+  """
+
+  def __init__(self, path):
+    self.path         = path
+    self.seq          = 0  # Sequence number of the last record written.
+    self.snapshot_seq = 0  # Sequence number of the last record in the snapshot.
+    self.file         = None
+    self.unsynced     = False
+    self.lock         = threading.Lock()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["file"] = None
+    state["unsynced"] = False
+    del state["lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  @property
+  def pending(self):
+    """Return the number of records not yet covered by a snapshot."""
+    return self.seq - self.snapshot_seq
+
+  def append(self, kind, **data):
+    """Write a record to the end of the journal."""
+    with self.lock:
+      if self.file is None:
+        self.file = open(self.path, "ab")
+      self.seq += 1
+      pickle.dump((self.seq, kind, data), self.file, protocol=pickle.HIGHEST_PROTOCOL)
+      self.file.flush()
+      self.unsynced = True
+
+  def sync(self):
+    """Force written records to disk, if there are any."""
+    with self.lock:
+      if self.unsynced:
+        os.fsync(self.file.fileno())
+        self.unsynced = False
+
+  def read(self):
+    """Return the (kind, data) of every record not covered by the snapshot.
+
+    A record torn by a crash mid-write is discarded, along with anything after
+    it, so that new records are never appended after garbage.
+    """
+    records = []
+    if not os.path.isfile(self.path):
+      return records
+
+    torn_at = None
+    size = os.path.getsize(self.path)
+    with open(self.path, "rb") as f:
+      while f.tell() < size:
+        offset = f.tell()
+        try:
+          seq, kind, data = pickle.load(f)
+        except Exception:
+          logging.warning("Discarding torn journal record at byte %d." % offset)
+          torn_at = offset
+          break
+        if seq > self.snapshot_seq:
+          records.append((kind, data))
+        self.seq = max(self.seq, seq)
+
+    if torn_at is not None:
+      with open(self.path, "r+b") as f:
+        f.truncate(torn_at)
+
+    return records
+
+  def snapshot(self, write):
+    """Call <write> to save a snapshot, then discard the records it covers.
+
+    No records can be appended in between, so none are lost if another thread
+    is writing to the journal.
+    """
+    with self.lock:
+      self.snapshot_seq = self.seq
+      write()
+      self._close()
+      open(self.path, "wb").close()
+
+  def close(self):
+    with self.lock:
+      self._close()
+
+  def _close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    self.unsynced = False
+
@@ -0,0 +1,97 @@
+import click
+import fcntl
+import logging
+import os
+import time
+
+class Lock(object):
+  """An OS-level lock on a game directory.
+
+  Exclusive holders (anything that changes the game, like 'run', 'restore'
+  and patch.py) lock game.lock, and write their PID to it so whoever is kept
+  out can see who has it. Shared holders (read-only tools like 'log') lock
+  game.readers.lock instead: game files are always replaced atomically, so
+  readers never wait for writers, and never keep one from starting. Only a
+  writer that rewrites history out from under readers (like 'restore', which
+  truncates game.events) passes exclude_readers to wait for them to finish.
+
+  The locks are flock()s, so the OS releases them when the holder exits,
+  however it exits. A lock file left by a process that has since died is
+  simply taken over.
+  """
+
+  def __init__(self, directory=".", *, shared=False, exclude_readers=False, timeout=0,
+               poll_interval=0.1):
+    self.path          = os.path.join(directory, "game.lock")
+    self.readers_path  = os.path.join(directory, "game.readers.lock")
+    self.shared        = shared
+    self.timeout       = timeout  # Seconds to wait for the lock before giving up.
+    self.poll_interval = poll_interval
+    self.files         = []
+
+    if shared:
+      self.locks = [(self.readers_path, fcntl.LOCK_SH)]
+    else:
+      self.locks = [(self.path, fcntl.LOCK_EX)]
+      if exclude_readers:
+        self.locks.append((self.readers_path, fcntl.LOCK_EX))
+
+  def __enter__(self):
+    """Lock the game directory."""
+    deadline = time.monotonic() + self.timeout
+    try:
+      for path, operation in self.locks:
+        self.files.append(self._acquire(path, operation, deadline))
+    except BaseException:
+      self._release()
+      raise
+
+    if not self.shared:
+      f = self.files[0]
+      stale = read_pid(f)
+      if stale:
+        logging.info("Taking over the game lock left by process %d." % stale)
+      f.truncate(0)
+      f.write("%d\n" % os.getpid())
+      f.flush()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    """Unlock the game directory."""
+    if not self.shared:
+      self.files[0].truncate(0)
+    self._release()
+
+  def _acquire(self, path, operation, deadline):
+    """Open and lock <path>, waiting until <deadline> for it to be free."""
+    f = open(path, "a+")
+    while True:
+      try:
+        fcntl.flock(f, operation | fcntl.LOCK_NB)
+        return f
+      except BlockingIOError:
+        if time.monotonic() < deadline:
+          time.sleep(self.poll_interval)
+          continue
+        holder = read_pid(f)
+        f.close()
+        if self.shared:
+          raise click.ClickException("The game is being restored by another process.")
+        if path == self.readers_path:
+          raise click.ClickException("The game is being read by another process.")
+        raise click.ClickException(
+          "Game lock is already held%s." % (" by process %d" % holder if holder else ""))
+
+  def _release(self):
+    for f in self.files:
+      fcntl.flock(f, fcntl.LOCK_UN)
+      f.close()
+    self.files = []
+
+def read_pid(f):
+  """Return the PID written in an open lock file, if any."""
+  f.seek(0)
+  try:
+    return int(f.read().strip() or 0) or None
+  except ValueError:
+    return None
@@ -1,22 +1,26 @@
 import click
+import contextlib
+import datetime
 import functools
-import jinja2
 import logging
-import mafia
 import os
 import pickle
-import pluginbase
-import pytz
 import random
 import shutil
 import threading
+import time
 
-from .moderator import *
-from .server import *
+from .lock import Lock
+from .storage import load_pickle, save_pickle
 
-BACKUP_PATH = "backups/"
-GAME_PATH   = "game.pickle"
-SETUP_PATH  = "setup.py"
+# Commands import the modules they need themselves, so that a quick command
+# like 'log' doesn't have to import Flask, requests, Jinja and the resolver.
+
+BACKUP_PATH    = "backups/"
+EVENTS_PATH    = "game.events"
+GAME_PATH      = "game.pickle"
+RECORDING_PATH = "game.recording"
+SETUP_PATH     = "setup.py"
 
 def relative_path(path):
   """Create a path relative to this file."""
@@ -26,30 +30,14 @@ def relative_path(path):
 def main():
   pass
 
-class Lock(object):
-  def __init__(self):
-    self.lock_file = "game.lock"
-
-  def __enter__(self):
-    """Lock the game directory."""
-    if os.path.isfile(self.lock_file):
-      raise click.ClickException(
-        "Game lock is already held. " \
-        "Delete %s if you're sure nothing else is using it." % self.lock_file
-      )
-    else:
-      open(self.lock_file, "a").close()
-
-  def __exit__(self, type, value, traceback):
-    """Unlock game directory."""
-    os.remove(self.lock_file)
+def standard_options(*, lock_required=True, shared=False, exclude_readers=False):
+  """Make a godfather command, which holds the game lock if <lock_required>.
 
-def standard_options(*, lock_required=True):
+  Read-only commands take a <shared> lock, which never blocks a writer.
+  """
   def decorator(f):
-    @main.command()
-    @click.option("-v", "--verbose", is_flag=True)
     @functools.wraps(f)
-    def wrapper(verbose, *args, **kwargs):
+    def wrapper(verbose, *args, wait=0, **kwargs):
       # Configure logging.
       level = logging.DEBUG if verbose else logging.INFO
       logging.basicConfig(level=level,
@@ -58,28 +46,54 @@ def standard_options(*, lock_required=True):
 
       # Run the actual command.
       if lock_required:
-        with Lock():
+        with Lock(shared=shared, exclude_readers=exclude_readers, timeout=wait):
           f(*args, **kwargs)
       else:
         f(*args, **kwargs)
 
-    return wrapper
+    if lock_required:
+      wrapper = click.option("--wait", type=float, default=0,
+                             help="Seconds to wait for the game lock if it's held.")(wrapper)
+    wrapper = click.option("-v", "--verbose", is_flag=True)(wrapper)
+    return main.command()(wrapper)
   return decorator
 
 def load_game(game_path, load_from=None):
+  from .moderator import Moderator
+
   # Load game.pickle and check that it's valid.
   try:
-    moderator = pickle.load(open(load_from or game_path, "rb"))
+    if load_from and not os.path.isfile(load_from):
+      moderator = load_checkpoint(load_from)
+    else:
+      moderator = load_pickle(load_from or game_path)
     if not isinstance(moderator, Moderator):
       raise click.ClickException("'%s is not a Moderator object." % game_path)
-    moderator.path = game_path
+    moderator.relocate(game_path)
+    if not load_from:
+      moderator.recover()
+    moderator.publish()
     return moderator
   except pickle.UnpicklingError:
     raise click.ClickException("%s is not a valid game file." % game_path)
 
+def load_checkpoint(name):
+  """Load a Moderator from the checkpoint store by name."""
+  from .checkpoints import CheckpointStore
+
+  store = CheckpointStore(BACKUP_PATH)
+  name = os.path.basename(name)
+  if name.endswith(".json"):
+    name = name[:-len(".json")]
+  if name not in store:
+    raise click.ClickException("No such backup file or checkpoint: %s" % name)
+  return store.load(name)
+
 @standard_options(lock_required=False)
 def init():
   """Initialize the game directory."""
+  import jinja2
+  from .messages import precompile_templates
 
   # Create setup.py file if it doesn't exist.
   logging.info("Checking for %s..." % SETUP_PATH)
@@ -104,40 +118,231 @@ def init():
     patch_template_path = relative_path("templates/patch.py")
     shutil.copyfile(patch_template_path, patch_path)
 
+  # Compile message templates now so the first emails don't have to.
+  precompile_templates()
+
 @standard_options()
 @click.option("--setup_only", is_flag=True,
               help="Create the game.pickle file without running anything.")
-def run(setup_only):
+@click.option("--host", default="127.0.0.1",
+              help="The address to serve web pages on (0.0.0.0 for every interface).")
+@click.option("--port", type=int, default=5000, help="The port to serve web pages on.")
+def run(setup_only, host, port):
   """Run the game to completion or ctrl-c, saving checkpoints regularly."""
-  run_game(setup_only=setup_only)
+  run_game(setup_only=setup_only, host=host, port=port)
+
+@standard_options(lock_required=False)
+@click.argument("game_dirs", nargs=-1, required=True,
+                type=click.Path(exists=True, file_okay=False))
+@click.option("--host", default="127.0.0.1",
+              help="The address to serve web pages on (0.0.0.0 for every interface).")
+@click.option("--port", type=int, default=5000, help="The port to serve web pages on.")
+def serve(game_dirs, host, port):
+  """Run the games in several game directories in one process."""
+  from .host import Host
+  from .messages import precompile_templates
+  from .moderator import handle_interrupts
+
+  precompile_templates()
+
+  with contextlib.ExitStack() as locks:
+    moderators = {}
+    for game_dir in game_dirs:
+      name = os.path.basename(os.path.abspath(game_dir))
+      game_path = os.path.join(game_dir, GAME_PATH)
+      if name in moderators:
+        raise click.ClickException("Two game directories are named %s." % name)
+      if not os.path.isfile(game_path):
+        raise click.ClickException(
+          "%s missing. Run 'godfather run --setup_only' in %s first." % (game_path, game_dir))
+      locks.enter_context(Lock(game_dir))
+      moderators[name] = load_game(os.path.abspath(game_path))
+
+    handle_interrupts()
+    Host(moderators, host=host, port=port).run()
 
 @standard_options()
 def resolve():
   """Resolve the current stage and exit."""
   run_game(resolve_one_phase=True)
 
-@standard_options(lock_required=False)
-def log():
+@standard_options(shared=True)
+@click.option("--phase", help="Only show events from this phase, e.g. 'Day 1'.")
+@click.option("--player", help="Only show events sent to this player (or to everyone).")
+@click.option("--type", "event_type", help="Only show events of this type, e.g. Died.")
+@click.option("--follow", is_flag=True, help="Keep showing new events as they happen.")
+def log(phase, player, event_type, follow):
   """Show the game log so far."""
+  from .eventlog import read_events
+
+  # Stream the event log if there is one.
+  if os.path.isfile(EVENTS_PATH):
+    sleep = (lambda seconds: time.sleep(seconds) or True) if follow else None
+    try:
+      for record in read_events(EVENTS_PATH, phase=phase, player=player, type=event_type,
+                                sleep=sleep):
+        print(record["text"], flush=True)
+    except KeyboardInterrupt:
+      pass  # The way to stop --follow.
+    return
 
-  # Print the log if there is one.
+  # Otherwise, fall back to reading the log from the game file.
+  if phase or player or event_type or follow:
+    raise click.ClickException("Filtering needs %s, which this game doesn't have." % EVENTS_PATH)
   if not os.path.isfile(GAME_PATH):
     logging.info("%s missing, aborting." % GAME_PATH)
     return
   logging.info("Reading log from %s..." % GAME_PATH)
-  moderator = pickle.load(open(GAME_PATH, "rb"))
+  moderator = load_pickle(GAME_PATH)
   if len(moderator.game.log) > 0:
     print(moderator.game.log)
 
-@standard_options()
-@click.option("--backup", type=str, required=True, help="The game file to restore.")
+@standard_options(exclude_readers=True)
+@click.option("--backup", type=str, required=True,
+              help="The game file or checkpoint name to restore.")
 def restore(backup):
   """Overwrite the game.pickle file with the given backup."""
 
   moderator = load_game(GAME_PATH, load_from=backup)
-  moderator.save()
+  moderator.event_log.rewind(len(moderator.game.log))
+  moderator.save(force=True)
+
+@standard_options(shared=True)
+@click.option("--keep", type=int, help="Delete all but the newest KEEP checkpoints.")
+def backups(keep):
+  """List checkpoints, optionally deleting old ones."""
+  from .checkpoints import CheckpointStore
+
+  store = CheckpointStore(BACKUP_PATH)
+  if keep is not None:
+    # Deleting chunks could break a checkpoint the game is saving.
+    with Lock():
+      for name in store.prune(keep):
+        logging.info("Deleted %s." % name)
+      logging.info("Freed %d bytes." % store.compact())
+  for name in store.names():
+    print(name)
+
+@standard_options(lock_required=False)
+@click.option("--players", type=int, default=50, help="How many synthetic players to play.")
+@click.option("--setup", "setup_path", type=click.Path(exists=True, dir_okay=False),
+              help="Play the game in this setup.py instead of a synthetic one.")
+@click.option("--messages", type=int,
+              help="Messages sent per phase (default: ten per living player).")
+@click.option("--days", type=int, help="Stop after this many (virtual) days.")
+@click.option("--seed", type=int, default=0, help="Seed for the game and the players.")
+@click.option("--directory", type=click.Path(file_okay=False),
+              help="Where to save the game (default: a temporary directory).")
+def simulate(players, setup_path, messages, days, seed, directory):
+  """Play a whole game against simulated players, and report how long things took."""
+  import tempfile
+  from .api.forums.simulated import Simulated
+  from .clock import VirtualClock
+  from .messages import precompile_templates
+  from .simulate import START, report, simulate, synthetic_game
+
+  precompile_templates()
+
+  # Keep the per-event log lines out of the report.
+  logging.getLogger().setLevel(logging.WARNING)
+
+  options = {}
+  if setup_path:
+    setup = load_setup(setup_path)
+    game = setup.game
+    options = setup_options(setup)
+  else:
+    game = synthetic_game(players, seed=seed)
+  forum = Simulated(seed=seed, messages_per_phase=messages)
+  clock = VirtualClock(START, until=days and START + datetime.timedelta(days=days))
+
+  with contextlib.ExitStack() as stack:
+    if not directory:
+      directory = stack.enter_context(tempfile.TemporaryDirectory())
+    moderator, elapsed = simulate(directory, game=game, forum=forum, clock=clock, **options)
+    print(report(moderator, elapsed))
+
+@standard_options(lock_required=False)
+@click.option("--recording", default=RECORDING_PATH, type=click.Path(exists=True, dir_okay=False),
+              help="The messages recorded by a Recording forum.")
+@click.option("--setup", "setup_path", default=SETUP_PATH,
+              type=click.Path(exists=True, dir_okay=False), help="The recorded game's setup.py.")
+@click.option("--directory", type=click.Path(file_okay=False),
+              help="Where to save the game (default: a temporary directory).")
+def replay(recording, setup_path, directory):
+  """Play a recorded game again, as fast as possible, and check it went the same way."""
+  import tempfile
+  from .api.forums.recording import Replay
+  from .messages import precompile_templates
+  from .simulate import report, simulate
+
+  precompile_templates()
+  logging.getLogger().setLevel(logging.WARNING)
+
+  setup = load_setup(setup_path)
+  forum = Replay(recording)
+  # Every message comes from the recording, so nothing is pushed.
+  options = dict(setup_options(setup), push=False)
+
+  with contextlib.ExitStack() as stack:
+    if not directory:
+      directory = stack.enter_context(tempfile.TemporaryDirectory())
+    moderator, elapsed = simulate(directory, game=setup.game, forum=forum, clock=forum.clock,
+                                  **options)
+  print(report(moderator, elapsed))
+
+  missing, extra = forum.differences()
+  for to, subject, digest in missing:
+    print("Not sent in the replay: '%s' to %s (%s)" % (subject, to, digest))
+  for to, subject, digest in extra:
+    print("Only sent in the replay: '%s' to %s (%s)" % (subject, to, digest))
+  if missing or extra or forum.waiting:
+    raise click.ClickException("The replay differs from the recording.")
+  print("The replay sent the same messages as the recording.")
+
+_setups = {}  # setup.py path -> (modification time, PluginSource, module)
+
+def load_setup(path=SETUP_PATH):
+  """Load a game's setup.py, reusing it if it was already loaded and hasn't changed.
+
+  The PluginSource is kept too: pluginbase clears a plugin's globals once its
+  source is garbage collected.
+  """
+  import pluginbase
+
+  path = os.path.abspath(path)
+  modified = os.stat(path).st_mtime_ns
+  cached = _setups.get(path)
+  if cached and cached[0] == modified:
+    return cached[2]
+
+  plugin_base = pluginbase.PluginBase(package="godfather.plugins")
+  plugin_source = plugin_base.make_plugin_source(searchpath=[os.path.dirname(path)],
+                                                 identifier="%s@%d" % (path, modified))
+  setup = plugin_source.load_plugin(os.path.splitext(os.path.basename(path))[0])
+  _setups[path] = (modified, plugin_source, setup)
+  return setup
+
+def setup_options(setup):
+  """Return the Moderator options set in a loaded setup.py."""
+  return dict(game_name=setup.game_name,
+              time_zone=setup.time_zone,
+              night_end=setup.night_end,
+              day_end=setup.day_end,
+              journal=getattr(setup, "journal", False),
+              push=getattr(setup, "push", False),
+              coalesce_votes=getattr(setup, "coalesce_votes", False),
+              max_latency=getattr(setup, "max_latency", None))
+
+def run_game(setup_only=False, resolve_one_phase=False, host="127.0.0.1", port=5000):
+  import mafia
+  from .messages import precompile_templates
+  from .moderator import Moderator, handle_interrupts, set_cancelled
+  from .server import Server, serve
+
+  # Compile message templates before any are needed.
+  precompile_templates()
 
-def run_game(setup_only=False, resolve_one_phase=False):
   # Create backup directory if it doesn't exist.
   logging.info("Creating %s..." % BACKUP_PATH)
   os.makedirs(BACKUP_PATH, exist_ok=True)
@@ -148,21 +353,14 @@ def run_game(setup_only=False, resolve_one_phase=False):
     logging.info("%s already exists." % GAME_PATH)
   else:
     logging.info("Loading %s..." % SETUP_PATH)
-    plugin_base = pluginbase.PluginBase(package="plugins")
-    plugin_source = plugin_base.make_plugin_source(searchpath=["."])
-    setup = plugin_source.load_plugin("setup")
+    setup = load_setup()
     if not isinstance(setup.game, mafia.Game):
       raise click.ClickException("'game' in %s is not a mafia.Game object." % SETUP_PATH)
 
     logging.info("Creating %s..." % GAME_PATH)
-    moderator = Moderator(path=GAME_PATH,
-                          game=setup.game,
-                          game_name=setup.game_name,
-                          time_zone=setup.time_zone,
-                          night_end=setup.night_end,
-                          day_end=setup.day_end,
-                          forum=setup.forum)
-    pickle.dump(moderator, open(GAME_PATH, "wb"))
+    moderator = Moderator(path=GAME_PATH, game=setup.game, forum=setup.forum,
+                          **setup_options(setup))
+    save_pickle(moderator, GAME_PATH)
 
   # Load the moderator.
   moderator = load_game(GAME_PATH)
@@ -176,9 +374,10 @@ def run_game(setup_only=False, resolve_one_phase=False):
     set_cancelled(True)
   else:
     # Start the server.
-    server = Server(moderator)
-    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread = threading.Thread(target=serve, args=(Server(moderator),),
+                                     kwargs={"host": host, "port": port}, daemon=True)
     server_thread.start()
 
   # Run the Moderator (runs until interrupted).
+  handle_interrupts()
   moderator.run()
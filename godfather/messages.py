@@ -1,12 +1,41 @@
 import functools
 import jinja2
+import logging
 import mafia
 import os
 
+# Where compiled templates are cached between runs.
+BYTECODE_CACHE_PATH = os.path.expanduser("~/.cache/godfather/templates")
+
+_environment = None
+
+def get_environment():
+  """Return the shared message template environment, creating it on first use."""
+  global _environment
+  if _environment is None:
+    _environment = jinja2.Environment(loader=jinja2.PackageLoader("godfather", "messages"),
+                                      bytecode_cache=make_bytecode_cache(),
+                                      auto_reload=False,
+                                      trim_blocks=True, lstrip_blocks=True)
+  return _environment
+
+def make_bytecode_cache():
+  """Return an on-disk bytecode cache, or None if the cache directory is unusable."""
+  try:
+    os.makedirs(BYTECODE_CACHE_PATH, exist_ok=True)
+  except OSError as e:
+    logging.debug("Not caching compiled templates: %s" % e)
+    return None
+  return jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_PATH)
+
+def precompile_templates():
+  """Compile and load every message template ahead of time."""
+  env = get_environment()
+  for template in env.list_templates():
+    env.get_template(template)
+
 def render_message(template, **kwargs):
-  env = jinja2.Environment(loader=jinja2.PackageLoader("godfather", "messages"),
-                           trim_blocks=True, lstrip_blocks=True)
-  template = env.get_template(template)
+  template = get_environment().get_template(template)
   return template.render(**kwargs).strip()
 
 @functools.singledispatch
@@ -0,0 +1,126 @@
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+# Histogram bucket bounds, in seconds or messages.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+COUNT_BUCKETS    = (0, 1, 2, 5, 10, 50, 100, 500)
+
+# name -> (type, buckets, help)
+DEFINITIONS = collections.OrderedDict([
+  ("poll_seconds",         ("histogram", DURATION_BUCKETS, "Time spent on each poll of the forum.")),
+  ("poll_messages",        ("histogram", COUNT_BUCKETS, "Messages received per poll of the forum.")),
+  ("poll_errors_total",    ("counter", None, "Polls of the forum that failed.")),
+  ("duplicates_total",     ("counter", None, "Messages dropped because they were already handled.")),
+  ("message_seconds",      ("histogram", DURATION_BUCKETS, "Time spent handling each message from a player.")),
+  ("render_seconds",       ("histogram", DURATION_BUCKETS, "Time spent rendering each email.")),
+  ("last_poll_timestamp",  ("gauge", None, "Unix time of the last successful poll of the forum.")),
+  ("send_seconds",         ("histogram", DURATION_BUCKETS, "Time spent sending each batch of messages.")),
+  ("send_latency_seconds", ("histogram", DURATION_BUCKETS, "Time from a message being queued to being sent.")),
+  ("messages_sent_total",  ("counter", None, "Messages accepted by the forum.")),
+  ("send_retries_total",   ("counter", None, "Messages that failed to send and will be retried.")),
+  ("forum_retries_total",  ("counter", None, "Forum requests retried after a temporary error.")),
+  ("outbox_pending",       ("gauge", None, "Messages waiting to be sent.")),
+  ("save_seconds",         ("histogram", DURATION_BUCKETS, "Time spent saving the game state.")),
+  ("resolve_seconds",      ("histogram", DURATION_BUCKETS, "Time spent resolving each phase.")),
+])
+
+class Histogram(object):
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts  = [0] * (len(buckets) + 1)  # The last bucket is +Inf.
+    self.sum     = 0
+    self.count   = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+class Metrics(object):
+  """Thread-safe counters, gauges and histograms describing a running game.
+
+  Every metric is declared in DEFINITIONS. Metrics describe this run of the
+  process only, so they aren't pickled.
+  """
+
+  def __init__(self):
+    self._init_runtime_state()
+
+  def _init_runtime_state(self):
+    self.lock   = threading.Lock()
+    self.values = {name: Histogram(buckets) if kind == "histogram" else 0
+                   for name, (kind, buckets, help) in DEFINITIONS.items()}
+
+  def __getstate__(self):
+    return {}
+
+  def __setstate__(self, state):
+    self._init_runtime_state()
+
+  def __getitem__(self, name):
+    return self.values[name]
+
+  def increment(self, name, amount=1):
+    with self.lock:
+      self.values[name] += amount
+
+  def set(self, name, value):
+    with self.lock:
+      self.values[name] = value
+
+  def observe(self, name, value):
+    with self.lock:
+      self.values[name].observe(value)
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    """Observe how long the body of a with statement takes."""
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(name, time.monotonic() - start)
+
+  def snapshot(self):
+    """Return each metric's current value, as (count, sum) for histograms."""
+    with self.lock:
+      return {name: (value.count, value.sum) if isinstance(value, Histogram) else value
+              for name, value in self.values.items()}
+
+  def summary(self):
+    """Return a line describing each metric, for the status page."""
+    lines = []
+    with self.lock:
+      for name, value in self.values.items():
+        if isinstance(value, Histogram):
+          mean = value.sum / value.count if value.count else 0
+          lines.append("%s: %d, mean %.3f" % (name, value.count, mean))
+        else:
+          lines.append("%s: %s" % (name, format_value(value)))
+    return lines
+
+  def render(self, prefix="godfather_"):
+    """Return the metrics in the Prometheus text format."""
+    lines = []
+    with self.lock:
+      for name, (kind, buckets, help) in DEFINITIONS.items():
+        full_name = prefix + name
+        value = self.values[name]
+        lines.append("# HELP %s %s" % (full_name, help))
+        lines.append("# TYPE %s %s" % (full_name, kind))
+        if kind != "histogram":
+          lines.append("%s %s" % (full_name, format_value(value)))
+          continue
+        total = 0
+        for bound, count in zip(buckets + ("+Inf",), value.counts):
+          total += count
+          lines.append('%s_bucket{le="%s"} %d' % (full_name, bound, total))
+        lines.append("%s_sum %s" % (full_name, format_value(value.sum)))
+        lines.append("%s_count %d" % (full_name, value.count))
+    return "\n".join(lines) + "\n"
+
+def format_value(value):
+  return "%d" % value if value == int(value) else "%.6f" % value
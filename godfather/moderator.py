@@ -1,32 +1,53 @@
 import click
-import copy
 import datetime
 import json
 import logging
 import mafia
 import os
 import pickle
-import requests
 import termcolor
 import signal
 import sys
 import time
 import uuid
 
+from godfather.api.forum import ForumError
 from godfather.api.message import Message
+from godfather.checkpoints import CheckpointStore
+from godfather.eventlog import EventLog
+from godfather.inbox import Inbox
+from godfather.journal import Journal
+from godfather.metrics import Metrics
 from godfather.messages import *
+from godfather.outbox import Outbox
+from godfather.roster import Roster
+from godfather.scheduler import Scheduler
+from godfather.seen import SeenIndex
+from godfather.snapshot import Snapshot
+from godfather.storage import save_pickle
+from godfather.votes import VoteTally
 
-cancelled = False
+# How often to poll the forum, unless it pushes messages to us.
+POLL_INTERVAL = datetime.timedelta(seconds=10)
+
+# The default maximum acceptable amount of time since the last email check.
+MAX_LATENCY = datetime.timedelta(minutes=1)
+
+scheduler = Scheduler()
 
 def set_cancelled(c):
-  global cancelled
-  cancelled = c
+  if c:
+    scheduler.stop()
+  else:
+    scheduler.reset()
 
 def signal_handler(signal, frame):
   logging.info("Shutting down...")
   set_cancelled(True)
 
-signal.signal(signal.SIGINT, signal_handler)
+def handle_interrupts():
+  """Shut down cleanly on ctrl-c, rather than raising KeyboardInterrupt."""
+  signal.signal(signal.SIGINT, signal_handler)
 
 class Moderator(object):
   def __init__(self, *,
@@ -36,13 +57,21 @@ class Moderator(object):
                time_zone,
                night_end,
                day_end,
-               forum):
+               forum,
+               journal=False,
+               snapshot_interval=100,
+               push=False,
+               reconcile_interval=datetime.timedelta(minutes=5),
+               coalesce_votes=False,
+               max_latency=None,
+               clock=None):
     assert day_end.tzinfo == time_zone
     assert night_end.tzinfo == time_zone
 
     self.path        = path
     self.game        = game
     self.name        = game_name
+    self.clock       = clock  # A VirtualClock, or None for the wall clock.
 
     self.time_zone   = time_zone
     self.night_end   = night_end
@@ -54,7 +83,103 @@ class Moderator(object):
     self.forum       = forum
     self.parser      = mafia.Parser(self.game)
 
+    self.journal           = Journal(self.journal_path) if journal else None
+    self.snapshot_interval = snapshot_interval
+    self.snapshot_due      = False
+    self.replaying         = False
+    self.forum_cursor      = None
+    self.dirty             = True
+    self.last_save         = None
+    self.outbox            = Outbox()
+    self.event_log         = EventLog(self.event_log_path)
+
+    self.push               = push  # Whether the forum pushes messages to our server.
+    self.reconcile_interval = reconcile_interval
+    self.next_poll          = None
+    self.seen_ids           = SeenIndex()  # Forum IDs of the messages handled lately.
+    self.inbox              = Inbox()
+
+    self.tally             = None   # The current day's VoteTally.
+    self.coalesce_votes    = coalesce_votes
+    self.vote_update_at    = None   # When a coalesced vote update is due, if one is.
+    self.last_vote_update  = None
+
+    self.role_announcements = {}  # unique name -> log index of their latest RoleAnnouncement
+    self.role_emails        = {}  # unique name -> (log index, rendered email); not pickled
+
+    self.metrics     = Metrics()
+    self.roster      = Roster(game)
+    self.checked_log = None  # Length of the game log when the game last wasn't over.
+    self.last_fetch  = None         # When the forum was last polled successfully.
+    self.max_latency = max_latency  # How long since then before /status reports an error.
+
     self.game.log.on_append(self.event_logged)
+    self.publish()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["role_emails"] = {}
+    state["snapshot"] = None  # Published again once loaded.
+    return state
+
+  def __setstate__(self, state):
+    """Load a saved Moderator, filling in anything added since it was saved.
+
+    Games saved by older versions lack newer attributes, so they get the
+    defaults a new game would have. The game may not be fully unpickled yet,
+    so anything worked out from it (the vote tally and role announcements)
+    is left as None and rebuilt when first needed.
+    """
+    self.__dict__.update(state)
+    defaults = {
+      "clock":              lambda: None,
+      "journal":            lambda: None,
+      "snapshot_interval":  lambda: 100,
+      "snapshot_due":       lambda: False,
+      "replaying":          lambda: False,
+      "forum_cursor":       lambda: None,
+      "dirty":              lambda: True,
+      "last_save":          lambda: None,
+      "outbox":             lambda: Outbox(),
+      "event_log":          lambda: EventLog(self.event_log_path),
+      "push":               lambda: False,
+      "reconcile_interval": lambda: datetime.timedelta(minutes=5),
+      "next_poll":          lambda: None,
+      "seen_ids":           lambda: SeenIndex(),
+      "inbox":              lambda: Inbox(),
+      "tally":              lambda: None,
+      "coalesce_votes":     lambda: False,
+      "vote_update_at":     lambda: None,
+      "last_vote_update":   lambda: None,
+      "role_announcements": lambda: None,
+      "role_emails":        lambda: {},
+      "metrics":            lambda: Metrics(),
+      "roster":             lambda: Roster(self.game),
+      "checked_log":        lambda: None,
+      "last_fetch":         lambda: None,
+      "max_latency":        lambda: None,
+      "snapshot":           lambda: None,
+    }
+    for name, default in defaults.items():
+      if name not in self.__dict__:
+        setattr(self, name, default())
+
+  @property
+  def journal_path(self):
+    """Return the path of the journal file that goes with the game file."""
+    return os.path.splitext(self.path)[0] + ".journal"
+
+  @property
+  def event_log_path(self):
+    """Return the path of the event log that goes with the game file."""
+    return os.path.splitext(self.path)[0] + ".events"
+
+  def relocate(self, path):
+    """Use <path> as the game file, along with the files that go with it."""
+    self.path = path
+    if self.journal:
+      self.journal.path = self.journal_path
+    self.event_log.path = self.event_log_path
 
   def get_phase_end(self, start):
     """Return the end of the current phase that started at <start>."""
@@ -74,65 +199,268 @@ class Moderator(object):
 
   def get_time(self):
     """Return the current time."""
+    if self.clock:
+      return self.clock.now(self.time_zone)
     return datetime.datetime.now(self.time_zone)
 
   def run(self):
     """Run the game until it finishes or an interrupt is received."""
+    try:
+      self.open()
+      while self.step() and self.sleep():
+        pass
+    finally:
+      self.close()
+
+  def open(self):
+    """Start sending messages, and start the game if it hasn't been started."""
     logging.info("Running %s..." % self.name)
-
+    self.inbox.on_put = scheduler.wake
+    self.checked_log = None
+    self.forum.metrics = self.metrics
+    self.forum.roster = self.roster
+    self.forum.watch(scheduler.wake)
+    self.outbox.start(self.forum, self.game, on_sent=self.messages_sent, metrics=self.metrics)
     if not self.started:
       self.start()
+      self.flush_messages()
       self.save()
+    self.publish()
+
+  def step(self):
+    """Do whatever is due now, and return whether the game is still going."""
+    self.receive_pushed()
+    if self.poll_due():
+      self.poll()
+
+    if self.get_time() > self.phase_end + self.forum.receipt_lag:
+      if self.push:
+        self.poll()  # Catch anything that wasn't pushed before resolving.
+      self.advance_phase()
+      self.receive_pushed()
+
+    self.flush_messages()
+    self.metrics.set("outbox_pending", len(self.outbox))
+    if self.dirty:
+      self.publish()
+    self.save()
+
+    if self.is_game_over():
+      self.end()
+      return False
+    return True
 
-    while True:
+  def is_game_over(self):
+    """Return whether the game is over.
+
+    Checking every player's fate is slow in big games, and nothing but new
+    events (like deaths) can end the game, so it's only done when the log
+    has grown.
+    """
+    if len(self.game.log) == self.checked_log:
+      return False
+    if self.game.is_game_over():
+      return True
+    self.checked_log = len(self.game.log)
+    return False
+
+  def close(self):
+    """Send what messages can be sent, and save."""
+    self.forum.unwatch()
+    self.outbox.stop()
+    if len(self.outbox) > 0:
+      logging.warning("%d message(s) could not be sent yet." % len(self.outbox))
+    self.save()
+    self.event_log.close()
+
+  def poll(self):
+    """Fetch and handle any new messages from the forum."""
+    start = time.monotonic()
+    count = 0
+    try:
       for message in self.forum.get_messages(self.game, self.phase_end):
-        self.message_received(message)
-
-      if self.get_time() > self.phase_end + self.forum.receipt_lag:
-        self.advance_phase()
-
-      self.save()
+        self.receive(message)
+        self.record_cursor()
+        count += 1
+    except ForumError as e:
+      logging.warning("Failed to fetch messages, will retry: %s" % e.message)
+      self.metrics.increment("poll_errors_total")
+    else:
+      self.last_fetch = self.get_time()
+      self.metrics.set("last_poll_timestamp", time.time())
+    self.metrics.observe("poll_seconds", time.monotonic() - start)
+    self.metrics.observe("poll_messages", count)
+    self.record_cursor()
+    self.next_poll = self.get_time() + self.poll_interval
 
-      if self.game.is_game_over():
-        self.end()
-        return
+  @property
+  def poll_interval(self):
+    """Return how long to wait between polls of the forum."""
+    return self.reconcile_interval if self.push else POLL_INTERVAL
 
-      if not self.sleep():
-        return
+  @property
+  def latency_limit(self):
+    """Return how long since the last poll before the game counts as unhealthy."""
+    return self.max_latency or max(MAX_LATENCY, 2 * self.poll_interval)
+
+  def poll_due(self):
+    """Return whether to poll the forum now.
+
+    Without push, the forum is polled every time round the loop, which wakes
+    every POLL_INTERVAL. With push, polling is only a sweep for messages that
+    weren't pushed to us (say while the server was down), so it's done every
+    reconcile_interval.
+    """
+    return not self.push or self.next_poll is None or self.get_time() >= self.next_poll
+
+  def receive_pushed(self):
+    """Handle the emails pushed to us for the current phase."""
+    emails = self.inbox.take()
+    # Emails pushed after the phase ended belong to the next phase, so they
+    # wait until it starts, just as poll() would leave them for the next check.
+    if self.get_time() > self.phase_end:
+      self.inbox.put_back(emails)
+      return
+    for email in emails:
+      message = self.forum.parse_push(self.game, email)
+      if message:
+        self.receive(message)
+
+  def receive(self, message):
+    """Handle a message from the forum, unless it was already handled."""
+    message_id = message.get("id")
+    if message_id in self.seen_ids:
+      logging.debug("Ignoring duplicate message %s." % message_id)
+      self.metrics.increment("duplicates_total")
+      return
+    self.record("message", id=message_id, sender=message.sender.unique_name,
+                subject=message.subject, body=message.body)
+    if message_id:
+      self.seen_ids.add(message_id)
+    with self.metrics.timer("message_seconds"):
+      self.message_received(message)
+
+  def record_cursor(self):
+    """Note how far the forum has read, if that changed.
+
+    The cursor is journaled, but without a journal it isn't worth rewriting
+    game.pickle for: it's saved along with the next real change, and
+    messages read again after a restart are dropped as repeats.
+    """
+    cursor = self.forum.cursor
+    if cursor != self.forum_cursor:
+      self.forum_cursor = cursor
+      if self.journal:
+        self.record("cursor", cursor=cursor)
+
+  def save(self, force=False):
+    """Save the current Moderator state to disk if it has changed.
+
+    In journal mode every change is already in the journal, so the full
+    snapshot is only rewritten every snapshot_interval records or when a phase
+    boundary asks for one.
+    """
+    if not (self.dirty or force):
+      return
+
+    with self.metrics.timer("save_seconds"):
+      if self.journal:
+        if not (self.snapshot_due or force) and self.journal.pending < self.snapshot_interval:
+          self.journal.sync()
+          self.dirty = False
+          return
+        self.snapshot_due = False
+        self.dirty = False
+        self.journal.snapshot(self._write_snapshot)
+      else:
+        self.dirty = False
+        self._write_snapshot()
+
+  def _write_snapshot(self):
+    self.last_save = save_pickle(self, self.path)
+
+  def publish(self):
+    """Publish a Snapshot of the current state for the web server."""
+    self.snapshot = Snapshot(self)
+
+  def record(self, kind, **data):
+    """Note a change to the game state, journaling it if enabled."""
+    self.dirty = True
+    if self.journal and not self.replaying:
+      self.journal.append(kind, **data)
+
+  def recover(self):
+    """Replay journal records written after the last snapshot."""
+    if not self.journal:
+      return
+    records = self.journal.read()
+    if len(records) == 0:
+      return
+
+    logging.info("Replaying %d journal records..." % len(records))
+    self.replaying = True
+    try:
+      for kind, data in records:
+        if kind == "message":
+          sender = self.game.player_named(data["sender"])
+          self.receive(Message(sender=sender, subject=data["subject"], body=data["body"],
+                               id=data.get("id")))
+        elif kind == "advance_phase":
+          self.advance_phase(now=data["time"])
+        elif kind == "sent":
+          self.outbox.discard(data["ids"])
+        elif kind == "cursor":
+          self.forum.cursor = data["cursor"]
+        elif kind == "vote_update":
+          self.send_vote_update()
+    finally:
+      self.replaying = False
+    self.snapshot_due = True
 
-  def save(self):
-    """Save the current Moderator state to disk."""
-    pickle.dump(self, open(self.path, "wb"))
+  @property
+  def checkpoints(self):
+    """Return the checkpoint store in the game's backup directory."""
+    return CheckpointStore(os.path.join(os.path.dirname(self.path), "backups"))
 
   def save_checkpoint(self, name):
-    """Save the current Moderator state to a checkpoint file."""
+    """Save the current Moderator state to the checkpoint store."""
     timestamp = datetime.datetime.now(self.time_zone).strftime("%Y-%m-%d_%H:%M:%S")
-    backup_dir = os.path.join(os.path.dirname(self.path), "backups")
-    checkpoint_path = os.path.join(backup_dir, "%s_%s.pickle" % (timestamp, name))
-    pickle.dump(self, open(checkpoint_path, "wb"))
+    self.checkpoints.save("%s_%s" % (timestamp, name), self)
+
+  def next_wakeup(self):
+    """Return when the loop next has something to do, barring pushed messages."""
+    wakeup = self.phase_end + self.forum.receipt_lag
+    if self.next_poll is not None:
+      wakeup = min(wakeup, self.next_poll)
+    if self.vote_update_at is not None:
+      wakeup = min(wakeup, self.vote_update_at)
+    return wakeup
 
   def sleep(self):
-    """Pause for a few seconds, and return whether execution should continue."""
-    for i in range(10):
-      if cancelled: return False
-      time.sleep(1)
-    return True
+    """Pause until there's work to do, and return whether execution should continue."""
+    seconds = (self.next_wakeup() - self.get_time()).total_seconds()
+    logging.debug("Sleeping for %.3fs." % seconds)
+    if self.clock:
+      return self.clock.sleep(seconds)
+    return scheduler.sleep(seconds)
 
   def start(self):
     """Start the game and send out role messages."""
     self.save_checkpoint("setup")
 
     logging.info("Starting game...")
-    body = render_message(
-             "welcome.html",
-             game_name=self.name,
-             night_end=self.night_end.strftime("%I:%M %p"),
-             day_end=self.day_end.strftime("%I:%M %p"),
-             players=self.game.players,
-           )
+    with self.metrics.timer("render_seconds"):
+      body = render_message(
+               "welcome.html",
+               game_name=self.name,
+               night_end=self.night_end.strftime("%I:%M %p"),
+               day_end=self.day_end.strftime("%I:%M %p"),
+               players=self.roster.alive,
+             )
     self.send_message(mafia.events.PUBLIC, "%s: Start" % self.name, body)
     self.game.begin()
     self.started = True
+    self.snapshot_due = True
 
     self.save_checkpoint("start")
 
@@ -146,36 +474,132 @@ class Moderator(object):
            "(or poorly; I can't tell) played game!" % winners
     self.send_message(mafia.events.PUBLIC, subject, body)
 
-  def advance_phase(self):
+  def advance_phase(self, now=None):
     """Resolve the current phase and start the next one."""
-    self.game.resolve(self.phase)
+    now = now or self.get_time()
+    self.record("advance_phase", time=now)
+
+    with self.metrics.timer("resolve_seconds"):
+      self.game.resolve(self.phase)
+    self.roster.changed()
     last_phase = self.phase
     self.phase = self.phase.next_phase()
-    self.phase_end = self.get_phase_end(start=self.get_time())
+    self.phase_end = self.get_phase_end(start=now)
+    self.snapshot_due = True
+    self.tally = self.new_tally()
+    self.vote_update_at = None
+    self.seen_ids.advance()
+    self.role_emails = {}  # Resolving can change what players can do.
 
     if not self.game.is_game_over():
-      body = render_message(
-               "end_of_phase.html",
-               last_phase=last_phase,
-               next_phase=self.phase,
-               phase_end=self.phase_end.time().strftime("%I:%M %p"),
-               players=self.game.players,
-             )
+      with self.metrics.timer("render_seconds"):
+        body = render_message(
+                 "end_of_phase.html",
+                 last_phase=last_phase,
+                 next_phase=self.phase,
+                 phase_end=self.phase_end.time().strftime("%I:%M %p"),
+                 players=self.roster.alive,
+               )
       self.send_message(mafia.events.PUBLIC, self.current_subject, body)
 
-    self.save_checkpoint(str(self.phase).lower().replace(' ', '_'))
+    if not self.replaying:
+      self.save_checkpoint(str(self.phase).lower().replace(' ', '_'))
 
   def send_message(self, to, subject, body):
     """Send a message to a player, list of players, or everyone."""
-    self.forum.send_message(self.game, Message(to=to, subject=subject, body=body))
+    self.outbox.put(Message(to=to, subject=subject, body=body))
+    self.dirty = True
+
+  def flush_messages(self):
+    """Let the outbox send the messages generated since the last flush."""
+    if self.vote_update_at is not None and self.get_time() >= self.vote_update_at:
+      self.record("vote_update")
+      self.send_vote_update()
+    self.outbox.release()
+
+  def vote_changed(self, voter, candidate):
+    """Called when a player changes their vote.
+
+    The public vote update goes out straight away, or with coalesce_votes, at
+    most once per POLL_INTERVAL, covering every change since the last one.
+    """
+    if self.tally is None:  # Saved by a version without tallies.
+      self.tally = self.new_tally()
+    change = self.tally.update(voter, candidate)
+    logging.info("%s now votes for %s (%d votes%s)." %
+                 (voter, candidate, change.count, ", a majority" if change.majority else ""))
+    if not self.coalesce_votes:
+      self.send_vote_update()
+    elif self.vote_update_at is None:
+      now = self.get_time()
+      last = self.last_vote_update
+      self.vote_update_at = max(now, last + POLL_INTERVAL) if last else now
+
+  def new_tally(self):
+    """Return a VoteTally of the votes cast so far in the current phase, or None at night."""
+    if not isinstance(self.phase, mafia.Day):
+      return None
+    tally = VoteTally(self.roster.alive)
+    for voter, candidate in self.phase.votes.items():
+      tally.update(voter, candidate)
+    return tally
+
+  def send_vote_update(self):
+    """Send everyone the current votes."""
+    self.vote_update_at = None
+    self.last_vote_update = self.get_time()
+    self.send_message(mafia.events.PUBLIC, self.current_subject, self.tally.summary())
+
+  def messages_sent(self, ids):
+    """Called (from an outbox worker) when messages have been sent."""
+    self.record("sent", ids=ids)
 
   def event_logged(self, event):
     """Called when an event is added to the game log."""
     prefix = termcolor.colored(">>>", "yellow")
     logging.info("%s %s" % (prefix, event.colored_str()))
+    self.record("event", phase=str(event.phase), type=type(event).__name__, text=str(event))
+    self.event_log.append(self.game.log, event)
+    self.roster.event_logged(event)
+
+    if event.to:
+      with self.metrics.timer("render_seconds"):
+        body = event_email(event, parser=self.parser)
+    if isinstance(event, mafia.events.RoleAnnouncement):
+      announcements = self.latest_role_announcements()
+      for player in event.to:
+        announcements[player.unique_name] = len(self.game.log)
+        self.role_emails[player.unique_name] = (len(self.game.log), body)
+
     if event.to:
       subject = "%s: %s" % (self.name, event.phase)
-      self.send_message(event.to, subject, event_email(event, parser=self.parser))
+      self.send_message(event.to, subject, body)
+
+  def latest_role_announcements(self):
+    """Return unique name -> log index of each player's latest RoleAnnouncement.
+
+    Games saved by a version that didn't keep the index have it rebuilt from the log.
+    """
+    if self.role_announcements is None:
+      self.role_announcements = {}
+      for index, event in enumerate(self.game.log):
+        if isinstance(event, mafia.events.RoleAnnouncement):
+          for player in event.to:
+            self.role_announcements[player.unique_name] = index
+    return self.role_announcements
+
+  def role_email(self, player):
+    """Return the email from <player>'s latest RoleAnnouncement, or None."""
+    index = self.latest_role_announcements().get(player.unique_name)
+    if index is None:
+      return None
+    cached = self.role_emails.get(player.unique_name)
+    if cached and cached[0] == index:
+      return cached[1]
+    with self.metrics.timer("render_seconds"):
+      body = event_email(self.game.log[index], parser=self.parser)
+    self.role_emails[player.unique_name] = (index, body)
+    return body
 
   def message_received(self, email):
     """Called when an email is received from a player."""
@@ -183,29 +607,27 @@ class Moderator(object):
     logging.info("%s %s" % (prefix, email))
 
     try:
-      if isinstance(self.phase, mafia.Day):
-        old_votes = copy.copy(self.phase.votes)
+      # A message can only change its sender's own vote.
+      voting = isinstance(self.phase, mafia.Day)
+      if voting:
+        old_vote = self.phase.votes.get(email.sender)
 
       self.parser.parse(self.phase, email.sender, email.body)
       body = "Confirmed.\n\n> %s" % email.body
       self.send_message(email.sender, email.subject, body)
 
-      if isinstance(self.phase, mafia.Day) and self.phase.votes != old_votes:
-        voters = sorted([p for p in self.phase.votes.keys() if p and p.alive])
-        votes = "\n".join(["  %s votes for %s." % (p, self.phase.votes[p]) for p in voters])
-        body = "Current votes:\n%s" % votes
-        self.send_message(mafia.events.PUBLIC, self.current_subject, body)
+      if voting and self.phase.votes.get(email.sender) != old_vote:
+        self.vote_changed(email.sender, self.phase.votes.get(email.sender))
 
     except mafia.InvalidAction as e:
       body = "%s\n\n> %s" % (str(e), email.body)
       self.send_message(email.sender, email.subject, body)
 
     except mafia.HelpRequested:
-      roles = self.game.log.to(email.sender).type(mafia.events.RoleAnnouncement)
-      if len(roles) == 0:
+      body = self.role_email(email.sender)
+      if body is None:
         logging.warning("Could not find role announcement for player: %s" % email.sender)
       else:
-        body = event_email(roles[-1], parser=self.parser)
         self.send_message(email.sender, email.subject, body)
 
   @property
@@ -0,0 +1,183 @@
+import collections
+import logging
+import threading
+import time
+
+class Outbox(object):
+  """A persistent queue of outgoing messages, sent by background workers.
+
+  Messages are put in the outbox as they're generated and released in bulk
+  (once per Moderator loop iteration) so that the forum can batch them.
+  Workers send released messages, retry failures with exponential backoff,
+  and only remove a message once the forum has accepted it. Pending messages
+  are pickled with the outbox, so they survive a restart.
+  """
+
+  def __init__(self, *, workers=2, batch_size=500, backoff=1.0, max_backoff=300):
+    self.pending     = collections.OrderedDict()  # id -> Message
+    self.next_id     = 0
+    self.released    = 0     # Messages with lower ids may be sent.
+    self.workers     = workers
+    self.batch_size  = batch_size
+    self.backoff     = backoff
+    self.max_backoff = max_backoff
+    self._init_runtime_state()
+
+  def _init_runtime_state(self):
+    self.condition = threading.Condition()
+    self.threads   = []
+    self.stopping  = False
+    self.in_flight = set()
+    self.attempts  = collections.Counter()
+    self.retry_at  = {}
+    self.queued_at = dict.fromkeys(self.pending, time.monotonic())  # Restored ones count from now.
+    self.metrics   = None
+
+  def __getstate__(self):
+    with self.condition:
+      return {
+        "pending":     collections.OrderedDict(self.pending),
+        "next_id":     self.next_id,
+        "workers":     self.workers,
+        "batch_size":  self.batch_size,
+        "backoff":     self.backoff,
+        "max_backoff": self.max_backoff,
+      }
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.released = self.next_id
+    self._init_runtime_state()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def put(self, message):
+    """Add a message to the outbox and return its id."""
+    with self.condition:
+      message_id = self.next_id
+      self.next_id += 1
+      self.pending[message_id] = message
+      self.queued_at[message_id] = time.monotonic()
+      return message_id
+
+  def release(self):
+    """Allow every message put so far to be sent."""
+    with self.condition:
+      self.released = self.next_id
+      self.condition.notify_all()
+
+  def discard(self, ids):
+    """Remove messages that are known to have been sent."""
+    with self.condition:
+      for message_id in ids:
+        self.pending.pop(message_id, None)
+        self.queued_at.pop(message_id, None)
+
+  def oldest_age(self):
+    """Return how many seconds the oldest unsent message has waited, or None."""
+    with self.condition:
+      if not self.queued_at:
+        return None
+      return time.monotonic() - min(self.queued_at.values())
+
+  def start(self, forum, game, *, on_sent=None, metrics=None):
+    """Start sending messages to <forum> in the background."""
+    self.stopping = False
+    self.metrics = metrics
+    for i in range(self.workers):
+      thread = threading.Thread(target=self._work, args=(forum, game, on_sent),
+                                name="outbox-%d" % i, daemon=True)
+      thread.start()
+      self.threads.append(thread)
+
+  def stop(self, timeout=10):
+    """Send what can be sent within <timeout> seconds, then stop the workers."""
+    self.release()
+    deadline = time.monotonic() + timeout
+    with self.condition:
+      while self._sendable() and self.threads and time.monotonic() < deadline:
+        self.condition.wait(timeout=max(deadline - time.monotonic(), 0))
+      self.stopping = True
+      self.condition.notify_all()
+    for thread in self.threads:
+      thread.join(timeout=max(deadline - time.monotonic(), 0))
+    self.threads = []
+
+  def send(self, forum, game, *, on_sent=None):
+    """Send all released messages in the calling thread."""
+    while True:
+      with self.condition:
+        batch = self._take()
+      if not batch:
+        return
+      self._send(forum, game, batch, on_sent)
+
+  def _sendable(self):
+    """Return whether any released message is waiting or being sent."""
+    return bool(self.in_flight) or any(i < self.released for i in self.pending)
+
+  def _take(self):
+    """Claim up to batch_size messages that are ready to send."""
+    now = time.monotonic()
+    batch = []
+    for message_id, message in self.pending.items():
+      if message_id >= self.released or len(batch) >= self.batch_size:
+        break
+      if message_id not in self.in_flight and self.retry_at.get(message_id, 0) <= now:
+        batch.append((message_id, message))
+    self.in_flight.update(message_id for message_id, message in batch)
+    return batch
+
+  def _next_retry(self):
+    """Return the seconds until the next message is due for a retry."""
+    times = [self.retry_at[i] for i in self.pending
+             if i in self.retry_at and i < self.released and i not in self.in_flight]
+    return max(min(times) - time.monotonic(), 0) if times else None
+
+  def _work(self, forum, game, on_sent):
+    while True:
+      with self.condition:
+        batch = self._take()
+        while not batch and not self.stopping:
+          self.condition.wait(timeout=self._next_retry())
+          batch = self._take()
+        if not batch:
+          return
+      self._send(forum, game, batch, on_sent)
+
+  def _send(self, forum, game, batch, on_sent):
+    ids = {id(message): message_id for message_id, message in batch}
+    start = time.monotonic()
+    try:
+      failures = forum.send_messages(game, [message for message_id, message in batch])
+    except Exception as e:
+      logging.exception("Unexpected error sending messages.")
+      failures = [(message, e) for message_id, message in batch]
+    if self.metrics:
+      self.metrics.observe("send_seconds", time.monotonic() - start)
+    failed = set(ids[id(message)] for message, error in failures)
+    sent = [message_id for message_id, message in batch if message_id not in failed]
+
+    with self.condition:
+      now = time.monotonic()
+      for message_id in sent:
+        self.pending.pop(message_id, None)
+        self.attempts.pop(message_id, None)
+        self.retry_at.pop(message_id, None)
+        queued_at = self.queued_at.pop(message_id, None)
+        if self.metrics and queued_at is not None:
+          self.metrics.observe("send_latency_seconds", now - queued_at)
+      if self.metrics:
+        self.metrics.increment("messages_sent_total", len(sent))
+        self.metrics.increment("send_retries_total", len(failed))
+      for message_id in failed:
+        self.attempts[message_id] += 1
+        delay = min(self.backoff * 2 ** (self.attempts[message_id] - 1), self.max_backoff)
+        self.retry_at[message_id] = now + delay
+        logging.warning("Will retry message %d in %.1fs." % (message_id, delay))
+      self.in_flight.difference_update(ids.values())
+      self.condition.notify_all()
+
+    if sent and on_sent:
+      on_sent(sent)
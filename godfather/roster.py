@@ -0,0 +1,108 @@
+import mafia
+import threading
+
+class Roster(object):
+  """An index of a game's players, for finding and addressing them quickly.
+
+  Asking the resolver whether a player is alive, or what their faction is,
+  works it out afresh each time, so rather than scanning every player per
+  message, forums and the web server look players up here. The index is
+  built when first needed, and the Moderator invalidates it when an event
+  could change it (a death or a new role) and after resolving each phase.
+  version goes up with each change, for caches built from the roster.
+
+  Forums read the roster from their sending threads, so it's thread-safe. It
+  isn't pickled beyond the game it indexes.
+  """
+
+  def __init__(self, game):
+    self.game    = game
+    self.version = 0
+    self._init_runtime_state()
+
+  def _init_runtime_state(self):
+    self.lock      = threading.RLock()
+    self.index     = None  # Built on first use.
+    self.audiences = {}    # audience -> ([(name, email)], ["name <email>"])
+    self.summary   = None  # [{name, alive}] for the web server
+
+  def __getstate__(self):
+    return {"game": self.game, "version": self.version}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_runtime_state()
+
+  def changed(self):
+    """Note that players may have died or changed roles."""
+    with self.lock:
+      self.index = None
+      self.audiences = {}
+      self.summary = None
+      self.version += 1
+
+  def event_logged(self, event):
+    """Update the roster for an event added to the game log."""
+    if isinstance(event, (mafia.events.Died, mafia.events.RoleAnnouncement,
+                          mafia.events.FactionAnnouncement)):
+      self.changed()
+
+  def _index(self):
+    with self.lock:
+      if self.index is None:
+        players = self.game.all_players
+        alive = [p for p in players if p.alive]
+        self.index = {
+          "email":  {p.info["email"]: p for p in players if p.info and "email" in p.info},
+          "alive":  alive,
+          "living": set(alive),
+        }
+      return self.index
+
+  def with_email(self, email):
+    """Return the player with the email address <email>, or None."""
+    return self._index()["email"].get(email)
+
+  @property
+  def alive(self):
+    """The living players, in the game's order."""
+    return self._index()["alive"]
+
+  def is_alive(self, player):
+    return player in self._index()["living"]
+
+  def players_summary(self):
+    """Return the name and whether they're alive of every player, for the web server.
+
+    The list is shared until the roster changes, so it mustn't be modified.
+    """
+    with self.lock:
+      if self.summary is None:
+        self.summary = [{"name": p.name, "alive": self.is_alive(p)}
+                        for p in self.game.all_players]
+      return self.summary
+
+  def members(self, audience):
+    """Return the players in <audience>: "all", "alive", or a faction's living members."""
+    if audience == "all":
+      return self.game.all_players
+    if audience == "alive":
+      return self.alive
+    return [p for p in self.alive if p.faction == audience]
+
+  def recipients(self, audience):
+    """Return (name, email) of each player in <audience>."""
+    return self._audience(audience)[0]
+
+  def addresses(self, audience):
+    """Return 'name <email>' for each player in <audience>."""
+    return self._audience(audience)[1]
+
+  def _audience(self, audience):
+    with self.lock:
+      cached = self.audiences.get(audience)
+      if cached is None:
+        recipients = [(p.name, p.info["email"]) for p in self.members(audience)]
+        cached = (recipients, ["%s <%s>" % recipient for recipient in recipients])
+        self.audiences[audience] = cached
+      return cached
@@ -0,0 +1,40 @@
+import threading
+
+class Scheduler(object):
+  """Puts the Moderator loop to sleep until it next has something to do.
+
+  The loop sleeps until its next deadline, and anything that gives it work
+  sooner (a pushed message, a shutdown request) wakes it early. The lock is
+  reentrant so that stop() can be called from a signal handler, which may
+  interrupt the sleeping thread while it holds the lock.
+  """
+
+  def __init__(self):
+    self.condition = threading.Condition(threading.RLock())
+    self.woken     = False
+    self.stopped   = False
+
+  def wake(self):
+    """Wake the loop so that it runs again now."""
+    with self.condition:
+      self.woken = True
+      self.condition.notify_all()
+
+  def stop(self):
+    """Wake the loop and ask it to exit."""
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+
+  def reset(self):
+    """Forget any earlier stop() or wake()."""
+    with self.condition:
+      self.woken   = False
+      self.stopped = False
+
+  def sleep(self, seconds):
+    """Sleep for up to <seconds>, and return whether the loop should continue."""
+    with self.condition:
+      self.condition.wait_for(lambda: self.woken or self.stopped, timeout=max(seconds, 0))
+      self.woken = False
+      return not self.stopped
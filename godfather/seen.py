@@ -0,0 +1,27 @@
+import collections
+
+class SeenIndex(object):
+  """The forum IDs of recently handled messages, so repeats can be dropped.
+
+  Forums may hand out a message more than once: polls overlap so that late
+  arrivals aren't missed, and polling sweeps up messages that were already
+  pushed. A repeat can only come within a poll window of the original, so
+  IDs are kept for the current and previous <phases>, and older ones
+  forgotten, which keeps the index (and game.pickle) from growing all game.
+  """
+
+  def __init__(self, phases=2):
+    self.phases = collections.deque([set()], maxlen=phases)  # Oldest phase first.
+
+  def __contains__(self, message_id):
+    return any(message_id in ids for ids in self.phases)
+
+  def __len__(self):
+    return sum(len(ids) for ids in self.phases)
+
+  def add(self, message_id):
+    self.phases[-1].add(message_id)
+
+  def advance(self):
+    """Start a new phase, forgetting the IDs from phases before the last few."""
+    self.phases.append(set())
@@ -1,13 +1,37 @@
 import datetime
 import flask
+import json
+import logging
 import pytz
+import werkzeug.serving
 
-# The maximum acceptable amount of time since the last email check.
-MAX_LATENCY = datetime.timedelta(minutes=1)
+from godfather.api.forum import ForumError
 
 def Server(moderator):
+  """Return the web app for a game.
+
+  Pages are rendered from the moderator's published Snapshot, never from the
+  live game, and each is rendered once per snapshot. Responses carry an ETag
+  and Last-Modified from the snapshot, so unchanged pages get a 304.
+  """
   app = flask.Flask(__name__)
-  game = moderator.game
+  rendered = {}  # page -> (snapshot version, body)
+
+  def from_snapshot(page, render, mimetype="text/html"):
+    snapshot = moderator.snapshot
+    if snapshot is None:
+      return "The game is still loading.", 503
+    cached = rendered.get(page)
+    if cached is None or cached[0] != snapshot.version:
+      cached = (snapshot.version, render(snapshot))
+      rendered[page] = cached
+    response = flask.Response(cached[1], mimetype=mimetype)
+    response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.published
+    return response.make_conditional(flask.request)
+
+  def from_json(page, summarize):
+    return from_snapshot(page, lambda s: json.dumps(summarize(s)), "application/json")
 
   @app.route("/")
   def index():
@@ -15,27 +39,93 @@ def Server(moderator):
 
   @app.route("/players")
   def players():
-    return flask.render_template(
-      "players.html",
-      players=game.players,
-      all_players=game.all_players,
-    )
+    return from_snapshot("players", lambda s: flask.render_template("players.html",
+                                                                    players=s.players))
+
+  @app.route("/api/players")
+  def api_players():
+    return from_json("api/players", lambda s: s.players)
+
+  @app.route("/api/phase")
+  def api_phase():
+    return from_json("api/phase", lambda s: s.phase_summary())
+
+  @app.route("/api/votes")
+  def api_votes():
+    return from_json("api/votes", lambda s: s.votes)
 
   @app.route("/secret")
   def secret():
     return "Ooooooh!"
 
+  @app.route("/inbound", methods=["POST"])
+  def inbound():
+    try:
+      email = moderator.forum.verify_push(flask.request.form.to_dict())
+    except ForumError as e:
+      logging.warning("Rejected pushed message: %s" % e.message)
+      # 406 tells Mailgun not to retry.
+      return "Rejected", 406
+    moderator.inbox.put(email)
+    return "OK"
+
   @app.route("/status")
   def status():
     errors = []
+    limit = moderator.latency_limit
     fetched = moderator.last_fetch
-    if fetched < datetime.datetime.now(moderator.time_zone) - MAX_LATENCY:
+    if fetched is None:
+      errors.append("No email check yet.")
+    elif fetched < moderator.get_time() - limit:
       errors.append("Last email check: %s" % fetched.strftime("%I:%M %p"))
+    waiting = moderator.outbox.oldest_age()
+    if waiting is not None and waiting > limit.total_seconds():
+      errors.append("Oldest unsent message: %d seconds old" % waiting)
     status = 200 if len(errors) == 0 else 500
     return flask.render_template(
       "status.html",
       errors=errors,
       status=status,
+      metrics=moderator.metrics.summary(),
     ), status
 
+  @app.route("/metrics")
+  def metrics():
+    return flask.Response(moderator.metrics.render(), mimetype="text/plain; version=0.0.4")
+
   return app
+
+def make_server(app, *, host="127.0.0.1", port=5000, threads=8):
+  """Return a threaded WSGI server for <app>.
+
+  Uses waitress if it's installed (pip install godfather[serve]), and
+  otherwise falls back to werkzeug's threaded server. Either way the server
+  has werkzeug's serve_forever(), shutdown() and server_port.
+  """
+  try:
+    import waitress
+  except ImportError:
+    return werkzeug.serving.make_server(host, port, app, threaded=True)
+  return WaitressServer(waitress.create_server(app, host=host, port=port, threads=threads))
+
+def serve(app, **kwargs):
+  """Serve <app> until the process exits, or log why the server couldn't start."""
+  try:
+    server = make_server(app, **kwargs)
+  except (OSError, SystemExit):  # Werkzeug exits if the port is taken.
+    logging.warning("Could not start the web server; continuing without it.")
+    return
+  server.serve_forever()
+
+class WaitressServer(object):
+  """A waitress server with the interface of werkzeug's."""
+
+  def __init__(self, server):
+    self.server      = server
+    self.server_port = server.effective_port
+
+  def serve_forever(self):
+    self.server.run()
+
+  def shutdown(self):
+    self.server.close()
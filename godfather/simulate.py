@@ -0,0 +1,104 @@
+import datetime
+import os
+import pytz
+import time
+
+import mafia
+
+from godfather.moderator import Moderator
+
+# When simulated games start, so that runs are repeatable.
+START = datetime.datetime(2001, 1, 1, 12, tzinfo=pytz.utc)
+
+def synthetic_game(players, *, seed=0):
+  """Return a game of <players> synthetic players.
+
+  A quarter of them are Mafia, led by a Godfather. The rest are Town: mostly
+  Villagers, with a Cop and a Doctor in every ten.
+  """
+  game = mafia.Game(seed=seed)
+  town = game.add_faction(mafia.Town())
+  mob  = game.add_faction(mafia.Mafia("The Mafia"))
+  for i in range(players):
+    if i == 0:
+      role = mafia.Godfather(mob)
+    elif i % 4 == 0:
+      role = mafia.Goon(mob)
+    elif i % 10 == 1:
+      role = mafia.Cop(town)
+    elif i % 10 == 2:
+      role = mafia.Doctor(town)
+    else:
+      role = mafia.Villager(town)
+    name = "Player%d" % i
+    game.add_player(name, role, info={"email": "%s@example.com" % name.lower()})
+  return game
+
+# Moderator options for simulated games, unless a setup.py gives its own.
+PACIFIC = pytz.timezone("US/Pacific")
+OPTIONS = dict(game_name="Simulated Mafia",
+               time_zone=PACIFIC,
+               night_end=datetime.time(hour=10, tzinfo=PACIFIC),
+               day_end=datetime.time(hour=22, tzinfo=PACIFIC),
+               journal=True)
+
+def simulate(directory, *, game, forum, clock, **options):
+  """Run <game> on <forum> until it ends or <clock> runs out.
+
+  The game is saved in <directory> as usual, so saves cost what they would in
+  a real game. <options> are passed on to the Moderator. Returns the
+  Moderator and the wall clock seconds taken.
+  """
+  moderator = Moderator(path=os.path.join(directory, "game.pickle"),
+                        game=game,
+                        forum=forum,
+                        clock=clock,
+                        **dict(OPTIONS, **options))
+  os.makedirs(os.path.join(directory, "backups"), exist_ok=True)
+
+  start = time.perf_counter()
+  moderator.run()
+  return moderator, time.perf_counter() - start
+
+def phase_stats(forum, final):
+  """Return the metrics for each phase of a Measured forum's game.
+
+  Each phase's stats run from the start of the phase to the start of the
+  next, so they include resolving it and announcing the results.
+  """
+  stats = []
+  snapshots = forum.phases + [("End", final)]
+  for (phase, before), (next_phase, after) in zip(snapshots, snapshots[1:]):
+    def delta(name):
+      if isinstance(after[name], tuple):
+        return tuple(a - b for a, b in zip(after[name], before[name]))
+      return after[name] - before[name]
+    stats.append((phase, {name: delta(name) for name in after}))
+  return stats
+
+def report(moderator, elapsed):
+  """Return a table of a simulated or replayed game's throughput and costs per phase."""
+  forum = moderator.forum
+  header = "%-9s %9s %10s %9s %8s %9s %8s %9s %6s %9s" % (
+    "Phase", "Messages", "Handled/s", "Resolve", "Renders", "Render s",
+    "Sends", "Send s", "Saves", "Save s")
+  lines = [header, "-" * len(header)]
+  for phase, stats in phase_stats(forum, moderator.metrics.snapshot()):
+    handled, handle_time = stats["message_seconds"]
+    lines.append("%-9s %9d %10.0f %9.4f %8d %9.4f %8d %9.4f %6d %9.4f" % (
+      phase, handled, handled / handle_time if handle_time else 0,
+      stats["resolve_seconds"][1],
+      stats["render_seconds"][0], stats["render_seconds"][1],
+      stats["messages_sent_total"], stats["send_seconds"][1],
+      stats["save_seconds"][0], stats["save_seconds"][1]))
+
+  handled = moderator.metrics["message_seconds"].count
+  lines.append("")
+  lines.append("%d players, %d phases, %d messages handled in %.2fs (%.0f/s). "
+               "%d messages sent." % (len(moderator.game.all_players), len(forum.phases),
+                                      handled, elapsed, handled / elapsed, forum.sent))
+  if moderator.game.is_game_over():
+    lines.append("Winners: %s" % mafia.str_player_list(moderator.game.winners()))
+  else:
+    lines.append("The game was stopped before it ended.")
+  return "\n".join(lines)
@@ -0,0 +1,44 @@
+import datetime
+import itertools
+import os
+import time
+
+# Sets this run's versions apart from an earlier run's in ETags.
+RUN_ID = "%x.%x" % (int(time.time()), os.getpid())
+
+_versions = itertools.count(1)
+
+class Snapshot(object):
+  """A read-only copy of the game state shown by the web server.
+
+  The moderator publishes a new Snapshot from its own thread after each change
+  to the game, so request handlers never read the live game objects. Each
+  snapshot has a new version, which the server uses for ETags and caching.
+  """
+
+  def __init__(self, moderator):
+    self.version   = next(_versions)
+    self.etag      = "%s-%d" % (RUN_ID, self.version)
+    self.published = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    self.name      = moderator.name
+    self.started   = moderator.started
+    self.phase     = str(moderator.phase)
+    self.phase_end = moderator.phase_end.isoformat()
+    self.players   = moderator.roster.players_summary()
+    self.votes     = votes_summary(moderator.tally)
+
+  def phase_summary(self):
+    return {"name": self.name, "started": self.started,
+            "phase": self.phase, "phase_end": self.phase_end}
+
+def votes_summary(tally):
+  """Return the JSON summary of a day's VoteTally (empty outside the day)."""
+  if tally is None:
+    return {"votes": {}, "counts": {}, "majority": None, "leader": None}
+  return {
+    "votes":    {voter.name: candidate.name for voter, candidate in tally.votes.items()},
+    "counts":   {candidate.name: count for candidate, count in tally.counts.items()},
+    "majority": tally.majority,
+    "leader":   tally.leader and tally.leader.name,
+  }
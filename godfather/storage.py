@@ -0,0 +1,44 @@
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+def atomic_write(path, data):
+  """Replace the file at <path> with <data> without ever leaving it partial.
+
+  The data is written to a temporary file in the same directory, fsynced, and
+  renamed over the original, so readers see either the old or the new file.
+  """
+  directory = os.path.dirname(path) or "."
+  fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".%s." % os.path.basename(path))
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp_path, path)
+  except BaseException:
+    os.remove(temp_path)
+    raise
+
+  # Make the rename itself durable.
+  dir_fd = os.open(directory, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+
+def save_pickle(obj, path):
+  """Atomically pickle <obj> to <path> and return (size in bytes, seconds)."""
+  start = time.perf_counter()
+  data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+  atomic_write(path, data)
+  duration = time.perf_counter() - start
+  logging.debug("Saved %s (%d bytes) in %.3fs." % (path, len(data), duration))
+  return len(data), duration
+
+def load_pickle(path):
+  """Load a pickled object from <path>."""
+  with open(path, "rb") as f:
+    return pickle.load(f)
@@ -1,19 +1,19 @@
 """A template for making emergency modifications to the game state."""
 
-import godfather
 import mafia
 import os
-import pickle
 
-os.chdir(os.path.dirname(__file__))
+from godfather.lock import Lock
+from godfather.main import GAME_PATH, load_game
 
-with godfather.Lock():
-  # Load the game state.
-  game_file = "game.pickle"
-  moderator = pickle.load(open(game_file, "rb"))
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+with Lock(timeout=10):
+  # Load the game state, including any changes still in the journal.
+  moderator = load_game(GAME_PATH)
   game = moderator.game
 
   # DO MANIPULATION HERE
 
   # Save the modified game state.
-  pickle.dump(moderator, open(game_file, "wb"))
+  moderator.save(force=True)
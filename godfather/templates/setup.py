@@ -8,6 +8,16 @@ It will be imported and the following variables read:
   night_end:      When night actions are resolved.
   day_end:        When lynch votes are resolved.
 
+  journal:        Whether to record changes in an append-only journal and
+                  only occasionally rewrite game.pickle.
+  push:           Whether the forum pushes incoming messages to the server's
+                  /inbound endpoint, so that it only needs polling
+                  occasionally to catch any that were missed.
+  coalesce_votes: Whether to send public vote updates at most every ten
+                  seconds, rather than after every vote.
+  max_latency:    Optional. How long since the last email check before the
+                  server's /status page reports an error (a timedelta).
+
   game:           A mafia.Game object with the desired setup.
 
 For a complete list of roles, see
@@ -44,6 +54,18 @@ forum = Mailgun(
   private_cc=[],
 )
 
+# To run the game on your own mail server instead, deliver the game's address
+# to a Maildir and send through a local SMTP relay:
+#   from godfather.api.forums.maildir import Maildir
+#   forum = Maildir(path=os.path.expanduser("~/Maildir/.mafia"),
+#                   sender="The Godfather", address="mafia@example.com",
+#                   smtp_host="localhost", smtp_port=25)
+
+# To record the game's messages, so that 'godfather replay' can play it again
+# offline, wrap the forum:
+#   from godfather.api.forums.recording import Recording
+#   forum = Recording(forum, "game.recording")
+
 # Random seeds
 setup_seed = {{ setup_seed }}
 game_seed  = {{ game_seed }}
@@ -53,6 +75,9 @@ game_name      = "Crypto Mafia"
 time_zone      = pytz.timezone("US/Pacific")
 night_end      = datetime.time(hour=10, minute=00, tzinfo=time_zone)
 day_end        = datetime.time(hour=12, minute=15, tzinfo=time_zone)
+journal        = True
+push           = False
+coalesce_votes = False
 
 # Player list
 players = [
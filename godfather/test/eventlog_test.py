@@ -0,0 +1,118 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from mafia import *
+
+from ..eventlog import *
+
+class EventLogTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.dir   = tempfile.TemporaryDirectory()
+    self.path  = os.path.join(self.dir.name, "game.events")
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.mafia = self.game.add_faction(Mafia("The Mafia"))
+    self.alice = self.game.add_player("Alice", Cop(self.town))
+    self.bob   = self.game.add_player("Bob", Doctor(self.town))
+    self.eve   = self.game.add_player("Eve", Goon(self.mafia))
+    self.event_log = EventLog(self.path)
+    self.game.log.on_append(lambda event: self.event_log.append(self.game.log, event))
+    self.game.begin()
+
+  def tearDown(self):
+    self.event_log.close()
+    self.dir.cleanup()
+    super().tearDown()
+
+  def add_day(self, day):
+    self.game.log.current_phase = Day(day)
+    self.game.log.append(events.Died(self.bob))
+    self.game.log.append(events.Lynched(self.eve))
+
+  def records(self, **filters):
+    return list(read_events(self.path, **filters))
+
+  def test_matches_game_log(self):
+    self.add_day(1)
+    records = self.records()
+    assert_equal([r["text"] for r in records], [e.colored_str() for e in self.game.log])
+    assert_equal([r["index"] for r in records], list(range(len(self.game.log))))
+    assert_equal(records[-1]["type"], "Lynched")
+    assert_equal(records[0]["to"], ["alice"])
+
+  def test_filters(self):
+    self.add_day(1)
+    self.add_day(2)
+    assert_equal(len(self.records(phase="day 2")), 2)
+    assert_equal([r["type"] for r in self.records(type="died")], ["Died", "Died"])
+    assert_equal(len(self.records(phase="Day 3")), 0)
+
+    # Alice sees her own role, and public events.
+    texts = [r["text"] for r in self.records(player="Alice")]
+    assert "Start: Alice: You are the Town Cop." in texts[0]
+    assert_equal(len(texts), 5)
+
+  def test_phase_index(self):
+    self.add_day(1)
+    phases = [p["phase"] for p in read_index(self.path + ".index")]
+    assert_equal(phases, ["Start", "Day 1"])
+
+  def test_no_duplicates_after_restart(self):
+    self.event_log.close()
+    event_log = EventLog(self.path)
+    for i, event in enumerate(self.game.log):
+      event_log.append(self.game.log[:i], event)
+    event_log.close()
+    assert_equal(len(self.records()), len(self.game.log))
+
+  def test_fills_in_missing_events(self):
+    self.event_log.close()
+    os.remove(self.path)
+    os.remove(self.path + ".index")
+    self.add_day(1)
+    assert_equal([r["index"] for r in self.records()], list(range(len(self.game.log))))
+
+  def test_torn_line(self):
+    self.event_log.close()
+    with open(self.path, "ab") as f:
+      f.write(b'{"index": 99, "pha')
+    assert_equal(len(self.records()), len(self.game.log))
+
+    self.add_day(1)
+    assert_equal([r["index"] for r in self.records()], list(range(len(self.game.log))))
+
+  def test_rewind(self):
+    count = len(self.game.log)
+    self.add_day(1)
+    del self.game.log[count:]  # As a restored backup's log would be.
+    self.event_log.rewind(count)
+    assert_equal(len(self.records()), count)
+    assert_equal([p["phase"] for p in read_index(self.path + ".index")], ["Start"])
+
+    self.add_day(1)
+    assert_equal(len(self.records()), count + 2)
+
+  def test_follow(self):
+    stop = threading.Event()
+    def sleep(seconds):
+      time.sleep(seconds)
+      return not stop.is_set()
+
+    seen = []
+    def follow():
+      for record in read_events(self.path, type="Died", sleep=sleep, poll_interval=0.01):
+        seen.append(record)
+    thread = threading.Thread(target=follow)
+    thread.start()
+
+    self.add_day(1)
+    deadline = time.monotonic() + 5
+    while not seen and time.monotonic() < deadline:
+      time.sleep(0.01)
+    stop.set()
+    thread.join()
+    assert_equal([r["type"] for r in seen], ["Died"])
@@ -0,0 +1,151 @@
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+
+class FakeMailgun(object):
+  """A local stand-in for the parts of the Mailgun HTTP API we use.
+
+  Usage:
+    server = FakeMailgun("example.com")
+    server.start()
+    forum = Mailgun(api_key="key", sender="Godfather", address="game",
+                    domain="example.com", api_url=server.url)
+    ...
+    server.stop()
+  """
+
+  def __init__(self, domain):
+    self.domain      = domain
+    self.sent        = []    # Form data of each message sent.
+    self.stored      = []    # (event, message) of each message received.
+    self.failures    = []    # Status codes to return for the next requests.
+    self.requests    = []    # (method, path) of each request.
+    self.connections = 0     # Number of TCP connections accepted.
+    self.delay       = 0     # Seconds to wait before answering storage requests.
+    self.in_flight   = 0     # Number of storage requests being answered.
+    self.max_flight  = 0     # Most storage requests answered at once.
+    self.page_size   = 100   # Maximum number of events per page.
+    self.lock        = threading.Lock()
+
+    fake = self
+    class Handler(FakeMailgunHandler):
+      server_state = fake
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.server.daemon_threads = True
+
+  @property
+  def base_url(self):
+    return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+  @property
+  def url(self):
+    return "%s/v3" % self.base_url
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                     daemon=True).start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def store(self, *, sender, recipient, subject="Subject", body="", timestamp=None,
+            message_id=None):
+    """Add a received message, as though it had been emailed to <recipient>."""
+    with self.lock:
+      key = len(self.stored)
+      message_id = message_id or "<%s@%s>" % (uuid.uuid4(), self.domain)
+      event = {
+        "id":        str(uuid.uuid4()),
+        "event":     "stored",
+        "timestamp": timestamp or time.time(),
+        "message":   {"recipients": [recipient], "headers": {"message-id": message_id[1:-1]}},
+        "storage":   {"url": "%s/storage/%d" % (self.base_url, key), "key": str(key)},
+      }
+      message = {
+        "sender":        sender,
+        "subject":       subject,
+        "stripped-text": body,
+        "Message-Id":    message_id,
+      }
+      self.stored.append((event, message))
+      return event
+
+class FakeMailgunHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  wbufsize = 64 * 1024  # Send headers and body together.
+  server_state = None
+
+  def setup(self):
+    super().setup()
+    with self.server_state.lock:
+      self.server_state.connections += 1
+
+  def log_message(self, format, *args):
+    pass
+
+  def reply(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def injected_failure(self):
+    """Return a status code to fail this request with, if one is queued."""
+    with self.server_state.lock:
+      self.server_state.requests.append((self.command, self.path))
+      if self.server_state.failures:
+        return self.server_state.failures.pop(0)
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+    status = self.injected_failure()
+    if status:
+      return self.reply(status, {"message": "Injected failure"})
+
+    url = urllib.parse.urlparse(self.path)
+    if url.path == "/v3/%s/messages" % self.server_state.domain:
+      with self.server_state.lock:
+        self.server_state.sent.append(form)
+      return self.reply(200, {"id": "<%s>" % uuid.uuid4(), "message": "Queued. Thank you."})
+    self.reply(404, {"message": "Not found"})
+
+  def do_GET(self):
+    status = self.injected_failure()
+    if status:
+      return self.reply(status, {"message": "Injected failure"})
+
+    url = urllib.parse.urlparse(self.path)
+    params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+    if url.path == "/v3/%s/events" % self.server_state.domain:
+      return self.reply(200, self.events_page(url.path, params))
+    if url.path.startswith("/storage/"):
+      state = self.server_state
+      with state.lock:
+        state.in_flight += 1
+        state.max_flight = max(state.max_flight, state.in_flight)
+      time.sleep(state.delay)
+      with state.lock:
+        state.in_flight -= 1
+      event, message = state.stored[int(url.path.split("/")[-1])]
+      return self.reply(200, message)
+    self.reply(404, {"message": "Not found"})
+
+  def events_page(self, path, params):
+    begin = float(params.get("begin", 0))
+    end = float(params.get("end", float("inf")))
+    offset = int(params.get("page", 0))
+    with self.server_state.lock:
+      events = [e for e, m in self.server_state.stored if begin <= e["timestamp"] <= end]
+    events.sort(key=lambda e: e["timestamp"])
+    items = events[offset:offset + self.server_state.page_size]
+
+    next_params = dict(params, page=offset + len(items))
+    next_url = "%s%s?%s" % (self.server_state.base_url, path, urllib.parse.urlencode(next_params))
+    return {"items": items, "paging": {"next": next_url}}
@@ -0,0 +1,98 @@
+import email.parser
+import email.policy
+import socketserver
+import threading
+
+class FakeSMTP(object):
+  """A local stand-in for an SMTP relay, which keeps what it's sent.
+
+  Usage:
+    server = FakeSMTP()
+    server.start()
+    forum = Maildir(path=..., sender="Godfather", address="game@example.com",
+                    smtp_host="127.0.0.1", smtp_port=server.port)
+    ...
+    server.stop()
+  """
+
+  def __init__(self):
+    self.sent          = []    # (sender, recipients, email) of each message sent.
+    self.connections   = 0     # Number of TCP connections accepted.
+    self.refuse        = []    # Addresses to refuse as recipients.
+    self.hang_up_after = None  # Close the connection after this many more messages.
+    self.lock          = threading.Lock()
+
+    fake = self
+    class Handler(FakeSMTPHandler):
+      server_state = fake
+    self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    self.server.daemon_threads = True
+
+  @property
+  def port(self):
+    return self.server.server_address[1]
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                     daemon=True).start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def to(self, address):
+    """Return the emails sent to <address>."""
+    return [mail for sender, recipients, mail in self.sent if address in recipients]
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+  server_state = None
+
+  def reply(self, line):
+    self.wfile.write(("%s\r\n" % line).encode())
+
+  def handle(self):
+    state = self.server_state
+    with state.lock:
+      state.connections += 1
+    self.reply("220 localhost Fake SMTP")
+    sender, recipients = None, []
+    for line in self.rfile:
+      command = line.decode().strip()
+      verb = command[:4].upper()
+      if verb == "EHLO":
+        self.reply("250 localhost")
+      elif verb == "HELO":
+        self.reply("250 localhost")
+      elif verb == "MAIL":
+        sender, recipients = command.partition(":")[2].strip("<> "), []
+        self.reply("250 OK")
+      elif verb == "RCPT":
+        recipient = command.partition(":")[2].strip("<> ")
+        if recipient in state.refuse:
+          self.reply("550 No such user")
+        else:
+          recipients.append(recipient)
+          self.reply("250 OK")
+      elif verb == "DATA":
+        self.reply("354 End data with <CR><LF>.<CR><LF>")
+        data = []
+        for line in self.rfile:
+          if line == b".\r\n":
+            break
+          data.append(line[1:] if line.startswith(b"..") else line)
+        mail = email.parser.BytesParser(policy=email.policy.default).parsebytes(b"".join(data))
+        with state.lock:
+          state.sent.append((sender, recipients, mail))
+          hang_up = state.hang_up_after is not None and state.hang_up_after <= 1
+          if state.hang_up_after is not None:
+            state.hang_up_after = None if hang_up else state.hang_up_after - 1
+        self.reply("250 OK")
+        if hang_up:
+          return
+      elif verb in ("RSET", "NOOP"):
+        self.reply("250 OK")
+      elif verb == "QUIT":
+        self.reply("221 Bye")
+        return
+      else:
+        self.reply("502 Command not implemented")
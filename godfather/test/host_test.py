@@ -0,0 +1,148 @@
+import datetime
+import os
+import pytz
+import requests
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mafia import *
+
+from ..api.forums.mailgun import *
+from ..host import Host
+from ..moderator import *
+from .fake_mailgun import FakeMailgun
+from .moderator_test import ListForum
+from .push_test import signed
+
+class HostTest(unittest.TestCase):
+  """Tests of running several games in one process."""
+
+  def setUp(self):
+    super().setUp()
+    self.dir = tempfile.mkdtemp()
+    self.mailgun_server = FakeMailgun("example.com")
+    self.mailgun_server.start()
+    self.time_zone = pytz.timezone("US/Pacific")
+
+  def tearDown(self):
+    set_cancelled(False)
+    self.mailgun_server.stop()
+    shutil.rmtree(self.dir)
+    super().tearDown()
+
+  def make_moderator(self, name, forum):
+    game  = Game()
+    town  = game.add_faction(Town())
+    mafia = game.add_faction(Mafia("The Mafia"))
+    game.add_player("Alice", Cop(town), info={"email": "alice@example.com"})
+    game.add_player("Bob", Doctor(town), info={"email": "bob@example.com"})
+    game.add_player("Eve", Goon(mafia), info={"email": "eve@example.com"})
+
+    os.makedirs(os.path.join(self.dir, name, "backups"))
+    later = (datetime.datetime.now(self.time_zone) + datetime.timedelta(hours=1)).time()
+    return Moderator(path=os.path.join(self.dir, name, "game.pickle"),
+                     game=game,
+                     game_name=name,
+                     time_zone=self.time_zone,
+                     night_end=later.replace(tzinfo=self.time_zone),
+                     day_end=later.replace(tzinfo=self.time_zone),
+                     forum=forum)
+
+  def make_mailgun(self, address):
+    mailgun = Mailgun(api_key="key",
+                      sender="The Godfather",
+                      address=address,
+                      domain="example.com",
+                      api_url=self.mailgun_server.url,
+                      backoff=0.01)
+    mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    return mailgun
+
+  def confirmations(self, moderator):
+    return [m for m in moderator.outbox.pending.values() if m.body.startswith("Confirmed.")]
+
+  def test_shared_poller(self):
+    moderators = {name: self.make_moderator(name, self.make_mailgun(name))
+                  for name in ["alpha", "beta"]}
+    host = Host(moderators, port=0)
+    for name in ["alpha", "beta", "gamma"]:
+      self.mailgun_server.store(sender="alice@example.com", recipient="%s@example.com" % name,
+                                subject=name, body="investigate Bob",
+                                timestamp=time.time() - 60)
+
+    host.poll()
+    events = [path for method, path in self.mailgun_server.requests if "/events" in path]
+    fetches = [path for method, path in self.mailgun_server.requests if "/storage/" in path]
+    assert_equal(len(events), 2)  # One page of events, then an empty one.
+    assert_equal(len(fetches), 2)  # Nobody plays gamma.
+
+    for name, moderator in moderators.items():
+      moderator.start()
+      moderator.poll()
+      confirmations = self.confirmations(moderator)
+      assert_equal(len(confirmations), 1)
+      assert_equal(confirmations[0].subject, name)
+
+  def test_routes_by_game(self):
+    moderators = {name: self.make_moderator(name, self.make_mailgun(name))
+                  for name in ["alpha", "beta"]}
+    host = Host(moderators, port=0)
+    threading.Thread(target=host.server.serve_forever, daemon=True).start()
+    try:
+      url = "http://127.0.0.1:%d" % host.server.server_port
+      assert_equal(requests.get(url + "/").text, "alpha\nbeta")
+      assert_equal(requests.get(url + "/alpha/players").status_code, 200)
+
+      email = {"recipient": "beta@example.com", "sender": "alice@example.com",
+               "subject": "Action", "stripped-text": "investigate Bob", "Message-Id": "<1@x>"}
+      assert_equal(requests.post(url + "/beta/inbound", data=signed(email)).status_code, 200)
+      assert_equal(len(moderators["alpha"].inbox), 0)
+      assert_equal(len(moderators["beta"].inbox), 1)
+    finally:
+      host.server.shutdown()
+
+  def test_shared_scheduler(self):
+    moderators = {name: self.make_moderator(name, ListForum()) for name in ["alpha", "beta"]}
+    soon = moderators["alpha"].get_time() + datetime.timedelta(seconds=0.3)
+    moderators["alpha"].phase_end = soon
+    host = Host(moderators, port=0)
+
+    thread = threading.Thread(target=host.run)
+    thread.start()
+    try:
+      deadline = time.monotonic() + 5
+      while moderators["alpha"].phase == Night(0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+      resolved = moderators["alpha"].get_time()
+    finally:
+      set_cancelled(True)
+      thread.join(timeout=10)
+
+    assert_equal(moderators["alpha"].phase, Day(1))
+    assert_equal(moderators["beta"].phase, Night(0))
+    assert resolved - soon < datetime.timedelta(milliseconds=100), resolved - soon
+    assert os.path.isfile(moderators["beta"].path)
+
+  def test_open_failure(self):
+    moderators = {name: self.make_moderator(name, ListForum()) for name in ["alpha", "beta"]}
+    def fail():
+      raise RuntimeError("Welcome message failed")
+    moderators["alpha"].start = fail
+    moderators["beta"].phase_end = moderators["beta"].get_time() + datetime.timedelta(seconds=0.3)
+    host = Host(moderators, port=0)
+
+    thread = threading.Thread(target=host.run)
+    thread.start()
+    try:
+      deadline = time.monotonic() + 5
+      while moderators["beta"].phase == Night(0) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    finally:
+      set_cancelled(True)
+      thread.join(timeout=10)
+
+    assert not moderators["alpha"].started
+    assert_equal(moderators["beta"].phase, Day(1))
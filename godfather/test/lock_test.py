@@ -0,0 +1,73 @@
+import click
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+from mafia import assert_equal
+
+from .cli_test import *
+from ..lock import Lock
+
+class LockTest(CliTest):
+  def test_exclusive(self):
+    with Lock():
+      assert_equal(open("game.lock").read(), "%d\n" % os.getpid())
+      with self.assertRaisesRegex(click.ClickException, "held by process %d" % os.getpid()):
+        with Lock():
+          pass
+    with Lock():
+      pass
+
+  def test_readers_never_block_writers(self):
+    with Lock(shared=True), Lock(shared=True):
+      with Lock():
+        pass
+      with self.assertRaisesRegex(click.ClickException, "being read"):
+        with Lock(exclude_readers=True):
+          pass
+      assert_equal(open("game.lock").read(), "")  # Gave up the write lock too.
+    with Lock(exclude_readers=True):
+      with self.assertRaisesRegex(click.ClickException, "being restored"):
+        with Lock(shared=True):
+          pass
+    with Lock(shared=True):
+      pass
+
+  def test_stale_lock(self):
+    with open("game.lock", "w") as f:
+      f.write("999999999\n")  # Left by a process that crashed.
+    with Lock():
+      assert_equal(open("game.lock").read(), "%d\n" % os.getpid())
+
+  def test_wait(self):
+    holder = subprocess.Popen(
+      [sys.executable, "-c", "import time; from godfather.lock import Lock\n"
+                             "with Lock(): time.sleep(0.5)"],
+      env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    try:
+      deadline = time.monotonic() + 5
+      while not (os.path.isfile("game.lock") and open("game.lock").read()) and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+      with self.assertRaises(click.ClickException):
+        with Lock():
+          pass
+      with Lock(timeout=5):
+        pass
+    finally:
+      holder.wait()
+
+  def test_patch_template(self):
+    exec_godfather(["init"])
+    exec_godfather(["run", "--setup_only"])
+    with open("patch.py") as f:
+      patch = f.read().replace("# DO MANIPULATION HERE", "moderator.test_value = 123")
+    with open("patch.py", "w") as f:
+      f.write(patch)
+
+    subprocess.run([sys.executable, "patch.py"], check=True,
+                   env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    moderator = pickle.load(open(self.game_path, "rb"))
+    assert_equal(moderator.test_value, 123)
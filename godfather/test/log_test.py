@@ -1,5 +1,8 @@
 import pickle
 
+from mafia import assert_equal
+
+from ..eventlog import EventLog
 from .cli_test import *
 
 class LogTest(CliTest):
@@ -15,3 +18,25 @@ class LogTest(CliTest):
 
     result = exec_godfather(["log"])
     self.assertEqual("Bananas\n", result)
+
+  def test_log_events(self):
+    """Test that 'log' streams game.events, with filters."""
+    game  = mafia.Game()
+    town  = game.add_faction(mafia.Town())
+    alice = game.add_player("Alice", mafia.Cop(town))
+    bob   = game.add_player("Bob", mafia.Villager(town))
+    event_log = EventLog("game.events")
+    game.log.on_append(lambda event: event_log.append(game.log, event))
+    game.begin()
+    game.log.current_phase = mafia.Day(1)
+    game.log.append(mafia.events.Died(bob))
+    event_log.close()
+
+    lines = exec_godfather(["log"]).splitlines()
+    assert_equal(len(lines), 3)
+    assert_equal(exec_godfather(["log", "--player", "bob"]).splitlines(), lines[1:])
+    assert_equal(exec_godfather(["log", "--phase", "Day 1", "--type", "died"]), lines[2] + "\n")
+
+  def test_log_filters_need_events(self):
+    with self.assertRaises(SystemExit):
+      exec_godfather(["log", "--phase", "Day 1"])
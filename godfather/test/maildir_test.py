@@ -0,0 +1,215 @@
+import datetime
+import os
+import pickle
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from mafia import *
+
+from godfather.api.forum import ForumError
+from godfather.api.forums.maildir import *
+from godfather.watch import DirectoryWatcher
+from .fake_smtp import FakeSMTP
+
+class MaildirTest(unittest.TestCase):
+  """Tests of the Maildir forum against a temporary Maildir and a local fake SMTP relay."""
+
+  def setUp(self):
+    super().setUp()
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, "Maildir")
+    self.server = FakeSMTP()
+    self.server.start()
+    self.maildir = Maildir(path=self.path,
+                           sender="The Godfather",
+                           address="game@example.com",
+                           smtp_host="127.0.0.1",
+                           smtp_port=self.server.port,
+                           timeout=5)
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.alice = self.game.add_player("Alice", Cop(self.town),
+                                      info={"email": "alice@example.com"})
+    self.bob   = self.game.add_player("Bob", Doctor(self.town),
+                                      info={"email": "bob@example.com"})
+    self.delivered = 0
+
+  def tearDown(self):
+    self.maildir.unwatch()
+    self.server.stop()
+    self.directory.cleanup()
+    super().tearDown()
+
+  def deliver(self, *, sender, subject="Subject", body="", age=60, headers=""):
+    """Deliver an email to the Maildir as an MTA would: written to tmp/, then moved to new/."""
+    self.delivered += 1
+    name = "%d.%d.localhost" % (time.time(), self.delivered)
+    tmp = os.path.join(self.path, "tmp", name)
+    with open(tmp, "w") as f:
+      f.write("From: %s\nTo: game@example.com\nSubject: %s\n%s\n%s" %
+              (sender, subject, headers, body))
+    modified = time.time() - age
+    os.utime(tmp, (modified, modified))
+    os.rename(tmp, os.path.join(self.path, "new", name))
+    return name
+
+  def get_messages(self, cutoff=None):
+    cutoff = cutoff or datetime.datetime.now(datetime.timezone.utc)
+    return list(self.maildir.get_messages(self.game, cutoff))
+
+  def send(self, to=events.PUBLIC, subject="Subject", body="<b>Body</b>"):
+    self.maildir.send_message(self.game, Message(to=to, subject=subject, body=body))
+
+  def test_get_messages(self):
+    first = self.deliver(sender="Alice <alice@example.com>", subject="Vote", body="vote bob",
+                         age=120, headers="Message-ID: <1@example.com>\n")
+    second = self.deliver(sender="bob@example.com", subject="Vote",
+                          body="vote alice\n\nOn Monday, Alice wrote:\n> vote bob\n")
+
+    messages = self.get_messages()
+    assert_equal([(m.sender, m.subject, m.body, m.id) for m in messages],
+                 [(self.alice, "Vote", "vote bob", "<1@example.com>"),
+                  (self.bob, "Vote", "vote alice", second)])
+    assert_equal(os.listdir(os.path.join(self.path, "new")), [])
+    assert_equal(sorted(os.listdir(os.path.join(self.path, "cur"))),
+                 sorted([first + ":2,S", second + ":2,S"]))
+    assert_equal(self.get_messages(), [])
+
+  def test_html_body(self):
+    self.deliver(sender="alice@example.com", body="<p>vote&nbsp;bob</p>",
+                 headers="Content-Type: text/html\n")
+    assert_equal([m.body for m in self.get_messages()], ["vote\xa0bob"])
+
+  def test_cutoff(self):
+    self.deliver(sender="alice@example.com", body="early", age=120)
+    self.deliver(sender="alice@example.com", body="late", age=0)
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=60)
+    assert_equal([m.body for m in self.get_messages(cutoff)], ["early"])
+    assert_equal(len(os.listdir(os.path.join(self.path, "new"))), 1)
+    assert_equal([m.body for m in self.get_messages()], ["late"])
+
+  def test_interrupted_check(self):
+    self.deliver(sender="alice@example.com", body="vote bob", age=120)
+    self.deliver(sender="bob@example.com", body="vote alice")
+
+    # The Moderator stops (say it crashed) while handling the first message.
+    messages = self.maildir.get_messages(self.game, datetime.datetime.now(datetime.timezone.utc))
+    assert_equal(next(messages).body, "vote bob")
+    messages.close()
+    assert_equal(os.listdir(os.path.join(self.path, "new")), [])
+
+    # Both messages were claimed but neither was seen, so both come again.
+    assert_equal([m.body for m in self.get_messages()], ["vote bob", "vote alice"])
+    assert_equal(self.get_messages(), [])
+
+  def test_claimed_by_another_reader(self):
+    name = self.deliver(sender="alice@example.com", body="vote bob")
+    rename = os.rename
+    def claim_first(source, destination):
+      if source.endswith(name):
+        os.remove(source)  # Someone else got there first.
+      return rename(source, destination)
+    with unittest.mock.patch("os.rename", claim_first):
+      assert_equal(self.get_messages(), [])
+
+  def test_reply_to_non_player(self):
+    self.deliver(sender="mallory@example.com", subject="Let me play", body="vote bob")
+    assert_equal(self.get_messages(), [])
+    assert_equal(len(self.server.sent), 1)
+    sender, recipients, mail = self.server.sent[0]
+    assert_equal(recipients, ["mallory@example.com"])
+    assert_equal(mail["Subject"], "Let me play")
+    assert_equal(mail.get_body(("plain",)).get_content().strip(),
+                 "Unrecognized player: 'mallory@example.com'.")
+
+  def test_send(self):
+    self.maildir.public_cc = ["archive@example.com"]
+    self.send(subject="Day 1", body="<b>Hello</b> &amp; welcome")
+    self.send(to=self.alice, subject="Role", body="You are a cop.")
+
+    public, private = self.server.sent
+    assert_equal(public[0], "game@example.com")
+    assert_equal(public[1], ["alice@example.com", "bob@example.com", "archive@example.com"])
+    assert_equal(public[2]["To"], "The Godfather <game@example.com>")
+    assert_equal(public[2]["Cc"], "archive@example.com")
+    assert_equal(public[2].get_body(("plain",)).get_content().strip(), "Hello & welcome")
+    assert_equal(public[2].get_body(("html",)).get_content().strip(),
+                 "<b>Hello</b> &amp; welcome")
+    assert_equal(private[1], ["alice@example.com"])
+    assert_equal(private[2]["To"], "Alice <alice@example.com>")
+
+  def test_send_reuses_connection(self):
+    for i in range(20):
+      self.send(body="Message %d" % i)
+    assert_equal(len(self.server.sent), 20)
+    assert_equal(self.server.connections, 1)
+
+  def test_send_reconnects(self):
+    self.send()
+    self.server.hang_up_after = 1  # The relay drops the connection after the next message.
+    self.send()
+    self.send()
+    assert_equal(len(self.server.sent), 3)
+    assert_equal(self.server.connections, 2)
+
+  def test_send_failures(self):
+    self.server.refuse = ["bob@example.com"]
+    failures = self.maildir.send_messages(self.game, [
+      Message(to=self.alice, subject="Role", body="You are a cop."),
+      Message(to=self.bob, subject="Role", body="You are a doctor."),
+    ])
+    assert_equal(len(self.server.sent), 1)
+    assert_equal(len(failures), 1)
+    assert_equal(failures[0][0].to, self.bob)
+    assert isinstance(failures[0][1], ForumError)
+
+    # The connection is still usable after a refusal.
+    self.server.refuse = []
+    self.send(to=self.bob)
+    assert_equal(self.server.connections, 1)
+
+  def test_not_pickled(self):
+    self.send()
+    maildir = pickle.loads(pickle.dumps(self.maildir))
+    assert maildir.smtp is None
+    maildir.send_message(self.game, Message(to=self.alice, subject="Hi", body="Hi"))
+    assert_equal(len(self.server.sent), 2)
+
+  def test_watch(self):
+    woken = threading.Event()
+    self.maildir.watch(woken.set)
+    self.deliver(sender="alice@example.com", body="vote bob")
+    assert woken.wait(5)
+    self.maildir.unwatch()
+    assert self.maildir.watcher is None
+
+class DirectoryWatcherTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.directory = tempfile.TemporaryDirectory()
+    self.woken = threading.Event()
+
+  def tearDown(self):
+    self.directory.cleanup()
+    super().tearDown()
+
+  def check_wakes(self, watcher):
+    watcher.start()
+    try:
+      time.sleep(0.05)
+      with open(os.path.join(self.directory.name, "message"), "w") as f:
+        f.write("Hello")
+      assert self.woken.wait(5)
+    finally:
+      watcher.stop()
+
+  def test_wakes(self):
+    self.check_wakes(DirectoryWatcher(self.directory.name, self.woken.set))
+
+  def test_wakes_without_inotify(self):
+    watcher = DirectoryWatcher(self.directory.name, self.woken.set, interval=0.01)
+    with unittest.mock.patch("godfather.watch.load_inotify", return_value=None):
+      self.check_wakes(watcher)
@@ -0,0 +1,270 @@
+import datetime
+import json
+import logging
+import pickle
+import time
+import unittest
+
+from unittest.mock import patch
+
+from mafia import *
+
+from godfather.api.forum import ForumError
+from godfather.api.forums.mailgun import *
+from godfather.metrics import Metrics
+from godfather.roster import Roster
+from .fake_mailgun import FakeMailgun
+
+class MailgunLocalTest(unittest.TestCase):
+  """Tests of the Mailgun forum against a local fake Mailgun server."""
+
+  def setUp(self):
+    super().setUp()
+    self.server = FakeMailgun("example.com")
+    self.server.start()
+    self.mailgun = Mailgun(api_key="key",
+                           sender="The Godfather",
+                           address="game",
+                           domain="example.com",
+                           api_url=self.server.url,
+                           backoff=0.01)
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.alice = self.game.add_player("Alice", Cop(self.town),
+                                      info={"email": "alice@example.com"})
+    self.bob   = self.game.add_player("Bob", Doctor(self.town),
+                                      info={"email": "bob@example.com"})
+
+  def tearDown(self):
+    self.server.stop()
+    super().tearDown()
+
+  def send(self, to=events.PUBLIC, subject="Subject", body="<b>Body</b>"):
+    self.mailgun.send_message(self.game, Message(to=to, subject=subject, body=body))
+
+  def test_send_reuses_connection(self):
+    start = time.perf_counter()
+    for i in range(20):
+      self.send(body="Message %d" % i)
+    elapsed = time.perf_counter() - start
+    logging.info("Sent 20 messages over %d connection(s) in %.3fs." %
+                 (self.server.connections, elapsed))
+
+    assert_equal(len(self.server.sent), 20)
+    assert_equal(self.server.connections, 1)
+
+  def test_send_retries(self):
+    self.mailgun.metrics = Metrics()
+    self.server.failures = [503, 429]
+    self.send()
+    assert_equal(len(self.server.requests), 3)
+    assert_equal(len(self.server.sent), 1)
+    assert_equal(self.mailgun.metrics["forum_retries_total"], 2)
+
+  def test_send_gives_up(self):
+    self.mailgun.retries = 2
+    self.server.failures = [503, 429, 503, 503]
+    with self.assertRaises(ForumError):
+      self.send()
+    assert_equal(len(self.server.requests), 3)
+
+  def test_send_not_retried_after_server_error(self):
+    # Mailgun may have accepted the message anyway, so it isn't sent again.
+    self.server.failures = [500]
+    with self.assertRaises(ForumError):
+      self.send()
+    assert_equal(len(self.server.requests), 1)
+
+  def test_get_messages_retries(self):
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    self.server.store(sender="alice@example.com", recipient=self.mailgun.email,
+                      body="vote bob", timestamp=time.time() - 60)
+    self.server.failures = [500, 502]
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+    assert_equal([m.body for m in messages], ["vote bob"])
+
+  def test_session_not_pickled(self):
+    self.send()
+    mailgun = pickle.loads(pickle.dumps(self.mailgun))
+    assert mailgun._session is None
+    mailgun.send_message(self.game, Message(to=self.alice, subject="Hi", body="Hi"))
+    assert mailgun._session is not None
+    assert_equal(len(self.server.sent), 2)
+
+  def test_get_messages(self):
+    self.server.store(sender="alice@example.com", recipient=self.mailgun.email,
+                      subject="Vote", body="vote bob", timestamp=time.time() - 60)
+    self.server.store(sender="bob@example.com", recipient="other@example.com",
+                      subject="Vote", body="vote alice", timestamp=time.time() - 60)
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+    assert_equal([(m.sender, m.subject, m.body) for m in messages],
+                 [(self.alice, "Vote", "vote bob")])
+
+  def test_get_messages_in_parallel(self):
+    now = time.time()
+    for i in range(10):
+      sender = "alice@example.com" if i % 2 else "bob@example.com"
+      self.server.store(sender=sender, recipient=self.mailgun.email,
+                        body="message %d" % i, timestamp=now - 60 + i)
+    self.server.delay = 0.1
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+
+    assert_equal([m.body for m in messages], ["message %d" % i for i in range(10)])
+    assert self.server.max_flight > 1, "Messages were fetched one at a time."
+
+  def test_reply_to_non_player(self):
+    self.server.store(sender="mallory@example.com", recipient=self.mailgun.email,
+                      subject="Let me play", body="vote bob", timestamp=time.time() - 60)
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+
+    assert_equal(list(self.mailgun.get_messages(self.game, datetime.datetime.now())), [])
+    assert_equal(len(self.server.sent), 1)
+    assert_equal(self.server.sent[0]["to"], ["mallory@example.com"])
+    assert_equal(self.server.sent[0]["text"], ["Unrecognized player: 'mallory@example.com'."])
+
+  def test_public_recipients_from_roster(self):
+    self.mailgun.roster = Roster(self.game)
+    self.send()
+    self.game.add_player("Eve", Villager(self.town), info={"email": "eve@example.com"})
+    self.send()  # The roster hasn't been told about Eve.
+    self.mailgun.roster.changed()
+    self.send()
+    assert_equal([len(sent["to"]) for sent in self.server.sent], [2, 2, 3])
+
+  def fetches(self):
+    return [path for method, path in self.server.requests if "/storage/" in path]
+
+  def test_get_messages_overlap(self):
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    self.server.store(sender="alice@example.com", recipient=self.mailgun.email,
+                      body="vote bob", timestamp=time.time() - 1)
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+    assert_equal([m.body for m in messages], ["vote bob"])  # Without waiting for the lag.
+
+    # A message that shows up late is caught by the next check, which doesn't
+    # fetch the first again.
+    self.server.store(sender="bob@example.com", recipient=self.mailgun.email,
+                      body="vote alice", timestamp=time.time() - 10)
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+    assert_equal([m.body for m in messages], ["vote alice"])
+    assert_equal(len(self.fetches()), 2)
+
+    assert_equal(len(self.mailgun.recent), 2)
+
+    # Events are forgotten once checks start after them.
+    start = datetime.datetime.fromtimestamp(150)
+    assert_equal(forget_before({"a": 100, "b": 200}, start), {"b": 200})
+
+  def store_messages(self, count):
+    now = time.time()
+    for i in range(count):
+      self.server.store(sender="alice@example.com", recipient=self.mailgun.email,
+                        body="message %d" % i, timestamp=now - 60 + i)
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+
+  def test_get_messages_paginated(self):
+    self.store_messages(10)
+    self.server.page_size = 3
+
+    messages = list(self.mailgun.get_messages(self.game, datetime.datetime.now()))
+    assert_equal([m.body for m in messages], ["message %d" % i for i in range(10)])
+    assert self.mailgun.window is None
+
+  def test_get_messages_resumes_from_cursor(self):
+    self.store_messages(10)
+    self.server.page_size = 3
+
+    messages = self.mailgun.get_messages(self.game, datetime.datetime.now())
+    first = [next(messages).body for i in range(4)]
+    cursor = self.mailgun.cursor
+    messages.close()
+
+    # A restarted forum picks up right after the last message handed out.
+    mailgun = pickle.loads(pickle.dumps(self.mailgun))
+    mailgun.cursor = cursor
+    rest = [m.body for m in mailgun.get_messages(self.game, datetime.datetime.now())]
+    assert_equal(first + rest, ["message %d" % i for i in range(10)])
+
+  def test_send_batched(self):
+    self.game.add_player("Eve", Villager(self.town), info={"email": "eve@example.com"})
+    messages = [
+      Message(to=events.PUBLIC, subject="Night 0", body="Eve has died."),
+      Message(to=[self.alice], subject="Night 0", body="Bob is good."),
+      Message(to=[self.bob], subject="Night 0", body="You were protected."),
+      Message(to=[self.alice], subject="Confirmed", body="Confirmed."),
+    ]
+    assert_equal(self.mailgun.send_messages(self.game, messages), [])
+
+    # The public message goes to everyone, so the private results with the same
+    # subject are batched together in a second request.
+    assert_equal(len(self.server.sent), 3)
+    assert_equal(self.server.sent[0]["text"], ["Eve has died."])
+    assert_equal(len(self.server.sent[0]["to"]), 3)
+    assert_equal(self.server.sent[1]["text"], ["%recipient.text%"])
+    variables = json.loads(self.server.sent[1]["recipient-variables"][0])
+    assert_equal(variables["alice@example.com"]["text"], "Bob is good.")
+    assert_equal(variables["bob@example.com"]["text"], "You were protected.")
+    assert_equal(self.server.sent[2]["subject"], ["Confirmed"])
+
+  def test_send_public_unbatched(self):
+    self.send()
+    assert "recipient-variables" not in self.server.sent[0]
+    assert_equal(self.server.sent[0]["to"], ["Alice <alice@example.com>", "Bob <bob@example.com>"])
+
+    # Messages to several players are never merged, even with the same subject.
+    messages = [
+      Message(to=[self.alice, self.bob], subject="Mafia", body="You are the mafia."),
+      Message(to=[self.alice, self.bob], subject="Mafia", body="Choose a target."),
+      Message(to=events.PUBLIC, subject="Mafia", body="Night has fallen."),
+    ]
+    assert_equal(self.mailgun.send_messages(self.game, messages), [])
+    assert_equal(len(self.server.sent), 4)
+    for sent in self.server.sent[1:]:
+      assert "recipient-variables" not in sent
+      assert_equal(len(sent["to"]), 2)
+
+  def test_send_batched_with_cc(self):
+    self.mailgun.private_cc = ["log@example.com"]
+    messages = [
+      Message(to=self.alice, subject="Night 0", body="You were visited."),
+      Message(to=self.bob, subject="Night 0", body="You were visited."),
+    ]
+    assert_equal(self.mailgun.send_messages(self.game, messages), [])
+
+    # CC'd addresses have no recipient-variables, so get the literal body.
+    assert_equal(len(self.server.sent), 1)
+    assert_equal(self.server.sent[0]["cc"], ["log@example.com"])
+    assert_equal(self.server.sent[0]["text"], ["You were visited."])
+    assert "recipient-variables" in self.server.sent[0]
+
+  def test_send_split_at_batch_limit(self):
+    self.game.add_player("Eve", Villager(self.town), info={"email": "eve@example.com"})
+    self.mailgun.public_cc = ["archive@example.com"]
+    with patch("godfather.api.forums.mailgun.BATCH_LIMIT", 2):
+      self.send()
+    assert_equal([len(sent["to"]) for sent in self.server.sent], [2, 1])
+    assert_equal([sent.get("cc") for sent in self.server.sent], [["archive@example.com"], None])
+
+    # A message that fails in several requests is only reported once.
+    self.server.failures = [400, 400]
+    with patch("godfather.api.forums.mailgun.BATCH_LIMIT", 2):
+      failures = self.mailgun.send_messages(self.game, [Message(to=events.PUBLIC,
+                                                                subject="S", body="B")])
+    assert_equal(len(failures), 1)
+
+  def test_send_batched_failures(self):
+    self.mailgun.retries = 0
+    self.server.failures = [500]
+    messages = [
+      Message(to=self.alice, subject="A", body="A"),
+      Message(to=self.bob, subject="A", body="B"),
+      Message(to=self.bob, subject="C", body="C"),
+    ]
+
+    failures = self.mailgun.send_messages(self.game, messages)
+    assert_equal([m.body for m, e in failures], ["A", "B"])
+    assert_equal(len(self.server.sent), 1)
@@ -0,0 +1,51 @@
+import jinja2
+import logging
+import pytest
+import timeit
+import unittest
+
+from mafia import *
+
+from ..messages import *
+
+class MessagesTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.alice = self.game.add_player("Alice", Cop(self.town), info={"email": "alice@example.com"})
+    self.bob   = self.game.add_player("Bob", Villager(self.town), info={"email": "bob@example.com"})
+    self.kwargs = {
+      "last_phase": Night(0),
+      "next_phase": Day(1),
+      "phase_end":  "10:00 PM",
+      "players":    self.game.players,
+    }
+
+  def test_render_message(self):
+    body = render_message("end_of_phase.html", **self.kwargs)
+    assert body.startswith("Night 0 is over. Day 1 actions are due by 10:00 PM.")
+    assert "<li>Bob &lt;bob@example.com&gt;</li>" in body
+
+  def test_environment_is_shared(self):
+    precompile_templates()
+    assert get_environment() is get_environment()
+
+  @pytest.mark.timing
+  def test_render_benchmark(self):
+    """Rendering with the shared environment should beat building one per render."""
+    def uncached():
+      env = jinja2.Environment(loader=jinja2.PackageLoader("godfather", "messages"),
+                               trim_blocks=True, lstrip_blocks=True)
+      env.get_template("end_of_phase.html").render(**self.kwargs).strip()
+
+    def cached():
+      render_message("end_of_phase.html", **self.kwargs)
+
+    precompile_templates()
+    runs = 50
+    before = min(timeit.repeat(uncached, number=runs, repeat=3)) / runs
+    after = min(timeit.repeat(cached, number=runs, repeat=3)) / runs
+    logging.info("Render: %.1fus per message uncached, %.1fus cached." %
+                 (before * 1e6, after * 1e6))
+    assert after * 5 < before, "Cached: %.1fus, uncached: %.1fus" % (after * 1e6, before * 1e6)
@@ -0,0 +1,38 @@
+import pickle
+import unittest
+
+from mafia import assert_equal
+
+from ..metrics import *
+
+class MetricsTest(unittest.TestCase):
+  def test_render(self):
+    metrics = Metrics()
+    metrics.increment("poll_errors_total")
+    metrics.set("outbox_pending", 3)
+    metrics.observe("poll_messages", 1)
+    metrics.observe("poll_messages", 7)
+    metrics.observe("poll_messages", 1000)
+
+    lines = metrics.render().splitlines()
+    assert "# TYPE godfather_poll_errors_total counter" in lines
+    assert "godfather_poll_errors_total 1" in lines
+    assert "godfather_outbox_pending 3" in lines
+    assert 'godfather_poll_messages_bucket{le="0"} 0' in lines
+    assert 'godfather_poll_messages_bucket{le="1"} 1' in lines
+    assert 'godfather_poll_messages_bucket{le="10"} 2' in lines
+    assert 'godfather_poll_messages_bucket{le="+Inf"} 3' in lines
+    assert "godfather_poll_messages_sum 1008" in lines
+    assert "godfather_poll_messages_count 3" in lines
+
+  def test_timer(self):
+    metrics = Metrics()
+    with metrics.timer("save_seconds"):
+      pass
+    assert_equal(metrics["save_seconds"].count, 1)
+    assert "save_seconds: 1, mean 0.000" in metrics.summary()
+
+  def test_not_pickled(self):
+    metrics = Metrics()
+    metrics.increment("poll_errors_total")
+    assert_equal(pickle.loads(pickle.dumps(metrics))["poll_errors_total"], 0)
@@ -2,15 +2,23 @@ import datetime
 import os
 import pickle
 import pluginbase
+import pytest
 import pytz
+import threading
+import time
 import unittest
 
 from callee import Glob, StartsWith
 from .cli_test import *
 from mafia import *
-from unittest.mock import ANY, call, MagicMock
+from unittest.mock import ANY, call, MagicMock, patch
 
+from ..api.forums.mailgun import Mailgun
+from ..api.forums.stdout import Stdout
+from ..eventlog import read_events
+from ..journal import Journal
 from ..moderator import *
+from ..storage import load_pickle
 
 class MockForum(MagicMock):
   @property
@@ -163,9 +171,300 @@ class ModeratorUnitTest(ModeratorTest):
     next = datetime.datetime(year=2001, month=1, day=2, hour=12, tzinfo=pytz.timezone("Etc/GMT+1"))
     assert_equal(next, self.moderator.get_next_occurrence(now, time))
 
+class ListForum(Stdout):
+  """A picklable forum that returns queued messages and records sent ones."""
+
+  def __init__(self):
+    self.inbox = []
+    self.sent  = []
+
+  def send_message(self, game, message):
+    self.sent.append(message)
+
+  def get_messages(self, game, cutoff):
+    messages, self.inbox = self.inbox, []
+    return messages
+
+  def parse_push(self, game, email):
+    return email
+
+class CursorForum(ListForum):
+  """A ListForum whose cursor moves on with every check, like Mailgun's."""
+
+  cursor = 0
+
+  def get_messages(self, game, cutoff):
+    self.cursor += 1
+    return super().get_messages(game, cutoff)
+
 class ModeratorSaveTest(ModeratorTest):
   """Test save and save_checkpoint."""
 
+  def setUp(self):
+    super().setUp()
+    os.makedirs("backups")
+    del self.moderator.get_time
+    del self.moderator.sleep
+    self.moderator.forum = ListForum()
+    self.moderator.journal = Journal(self.moderator.journal_path)
+    self.moderator.start()
+    self.moderator.save()
+
+  def load(self):
+    moderator = pickle.load(open(self.game_path, "rb"))
+    moderator.recover()
+    return moderator
+
+  def test_snapshot_at_start(self):
+    moderator = pickle.load(open(self.game_path, "rb"))
+    assert moderator.started
+    assert_equal(os.path.getsize(self.moderator.journal_path), 0)
+
+  def test_save_without_journal(self):
+    self.moderator.journal = None
+    self.moderator.save(force=True)
+    mtime = os.path.getmtime(self.game_path)
+
+    # Nothing changed, so nothing is written.
+    self.moderator.poll()
+    self.moderator.save()
+    assert_equal(os.path.getmtime(self.game_path), mtime)
+
+    self.moderator.forum.inbox = [
+      Message(sender=self.sam, subject="Will", body="Set will: Po-tay-toes."),
+    ]
+    self.moderator.poll()
+    self.moderator.save()
+    moderator = pickle.load(open(self.game_path, "rb"))
+    assert_equal(moderator.game.player_named("samwise").will, "Po-tay-toes.")
+
+  def test_journal_replay(self):
+    self.moderator.forum.inbox = [
+      Message(sender=self.sauron, subject="Mafia", body="Sauron: Kill Frodo."),
+      Message(sender=self.sam, subject="Will", body="Set will: Po-tay-toes."),
+    ]
+    self.moderator.poll()
+    self.moderator.save()
+
+    # The snapshot is unchanged, but the journal holds the new messages.
+    snapshot = pickle.load(open(self.game_path, "rb"))
+    assert_equal(len(snapshot.phase.raw_actions), 0)
+
+    moderator = self.load()
+    assert_equal(len(moderator.phase.raw_actions), 1)
+    assert_equal(moderator.game.player_named("samwise").will, "Po-tay-toes.")
+    assert_equal(list(moderator.outbox.pending), list(self.moderator.outbox.pending))
+
+  def test_journal_replay_after_send(self):
+    self.moderator.forum.inbox = [
+      Message(sender=self.sam, subject="Will", body="Set will: Po-tay-toes."),
+    ]
+    self.moderator.poll()
+    self.moderator.flush_messages()
+    self.moderator.outbox.send(self.moderator.forum, self.game,
+                               on_sent=self.moderator.messages_sent)
+    assert_equal(len(self.moderator.outbox), 0)
+
+    # Replaying the journal regenerates the confirmation, but doesn't resend it.
+    moderator = self.load()
+    assert_equal(len(moderator.outbox), 0)
+
+  def test_duplicates_dropped(self):
+    will = Message(sender=self.sam, subject="Will", body="Set will: Po-tay-toes.", id="<1@a>")
+    self.moderator.forum.inbox = [will, Message(will, body="Set will: Second breakfast.")]
+    self.moderator.poll()
+    assert_equal(self.moderator.game.player_named("samwise").will, "Po-tay-toes.")
+    assert_equal(self.moderator.metrics["duplicates_total"], 1)
+
+    # The seen index is saved, and forgets a message two phases later.
+    self.moderator.advance_phase()
+    moderator = self.load()
+    assert "<1@a>" in moderator.seen_ids
+    moderator.advance_phase()
+    assert "<1@a>" not in moderator.seen_ids
+
+  def test_save_skipped_without_changes(self):
+    mtime = os.path.getmtime(self.game_path)
+    self.moderator.poll()
+    self.moderator.save()
+    assert_equal(os.path.getmtime(self.game_path), mtime)
+    assert_equal(os.path.getsize(self.moderator.journal_path), 0)
+
+  def test_save_after_failed_send(self):
+    # Nothing listens on port 1, so sending fails and the message stays in the outbox.
+    self.moderator.forum = Mailgun(api_key="key", sender="The Godfather", address="game",
+                                   domain="example.com", api_url="http://127.0.0.1:1/v3",
+                                   retries=0)
+    self.frodo.info["email"] = "frodo@bagend.shire"
+    self.moderator.send_message(self.frodo, "Subject", "<b>Hello</b>")
+    message = list(self.moderator.outbox.pending.values())[-1]
+    assert_equal(len(self.moderator.forum.send_messages(self.game, [message])), 1)
+
+    self.moderator.save(force=True)
+    moderator = load_pickle(self.game_path)
+    assert_equal(list(moderator.outbox.pending.values())[-1].text, "Hello")
+
+  def test_cursor_alone_not_saved_without_journal(self):
+    self.moderator.journal = None
+    self.moderator.forum = CursorForum()
+    self.moderator.save(force=True)
+    with patch("godfather.moderator.save_pickle") as save_pickle:
+      self.moderator.poll()
+      self.moderator.poll()
+      self.moderator.save()
+    save_pickle.assert_not_called()
+    assert_equal(self.moderator.forum_cursor, 2)
+
+    # With a journal, the cursor is journaled rather than saved.
+    self.moderator.journal = Journal(self.moderator.journal_path)
+    self.moderator.poll()
+    self.moderator.save()
+    assert_equal(self.moderator.journal.read(), [("cursor", {"cursor": 3})])
+
+  def test_snapshot_at_phase_boundary(self):
+    self.moderator.forum.inbox = [
+      Message(sender=self.sauron, subject="Mafia", body="Sauron: Kill Frodo."),
+    ]
+    self.moderator.poll()
+    self.moderator.advance_phase()
+    self.moderator.save()
+
+    assert_equal(os.path.getsize(self.moderator.journal_path), 0)
+    moderator = self.load()
+    assert_equal(moderator.phase, Day(1))
+    assert not moderator.game.player_named("frodo").alive
+
+  def test_event_log_after_replay(self):
+    self.moderator.forum.inbox = [
+      Message(sender=self.sauron, subject="Mafia", body="Sauron: Kill Frodo."),
+    ]
+    self.moderator.poll()
+    self.moderator.advance_phase()  # Journaled, but not saved.
+
+    moderator = self.load()
+    assert_equal(moderator.phase, Day(1))
+    records = list(read_events(moderator.event_log_path))
+    assert_equal([r["index"] for r in records], list(range(len(moderator.game.log))))
+
+  def test_coalesced_votes(self):
+    self.moderator.coalesce_votes = True
+    self.moderator.save(force=True)
+    self.moderator.advance_phase()
+    def vote_updates(moderator):
+      return [m for m in moderator.outbox.pending.values() if m.body.startswith("Current votes")]
+
+    self.moderator.forum.inbox = [
+      Message(sender=self.sam, subject="Vote", body="vote sauron"),
+      Message(sender=self.gandalf, subject="Vote", body="vote sauron"),
+      Message(sender=self.frodo, subject="Vote", body="vote sauron"),
+    ]
+    self.moderator.poll()
+    self.moderator.flush_messages()
+    updates = vote_updates(self.moderator)
+    assert_equal(len(updates), 1)
+    assert_equal(updates[0].body, "Current votes:\n"
+                                  "  Frodo votes for Sauron.\n"
+                                  "  Gandalf votes for Sauron.\n"
+                                  "  Samwise votes for Sauron.\n\n"
+                                  "Sauron has a majority (3 of 3 needed).")
+
+    # Later changes wait for the next window.
+    self.moderator.forum.inbox = [Message(sender=self.gandalf, subject="Vote", body="vote samwise")]
+    self.moderator.poll()
+    self.moderator.flush_messages()
+    assert_equal(len(vote_updates(self.moderator)), 1)
+    assert_equal(self.moderator.next_wakeup(), self.moderator.vote_update_at)
+
+    # Replaying the journal sends the same updates.
+    moderator = self.load()
+    assert_equal(list(moderator.outbox.pending), list(self.moderator.outbox.pending))
+    assert moderator.vote_update_at is not None
+
+  def test_help_uses_role_index(self):
+    index = self.moderator.role_announcements["sauron"]
+    assert isinstance(self.moderator.game.log[index], events.RoleAnnouncement)
+    assert_equal(self.moderator.game.log[index].to, [self.sauron])
+
+    def helps(moderator):
+      return [m.body for m in moderator.outbox.pending.values() if m.subject == "???"]
+
+    with patch("godfather.moderator.event_email") as event_email:
+      self.moderator.forum.inbox = [Message(sender=self.sauron, subject="???", body="Help me!")]
+      self.moderator.poll()
+      event_email.assert_not_called()  # Rendered when the role was announced.
+    assert "You are the <b>Mafia Godfather</b>." in helps(self.moderator)[0]
+
+    # The cache isn't pickled, so a reloaded game renders the email again.
+    moderator = self.load()
+    assert_equal(moderator.role_email(moderator.game.player_named("sauron")), helps(self.moderator)[0])
+    assert_equal(moderator.role_email(moderator.game.player_named("sauron")),
+                 moderator.role_emails["sauron"][1])
+
+  def test_checkpoints(self):
+    store = self.moderator.checkpoints
+    names = store.names()
+    assert_equal(len(names), 2)
+    assert names[0].endswith("_setup")
+    assert names[1].endswith("_start")
+
+    # Restore the start checkpoint and play it through the first night.
+    moderator = store.load(names[1])
+    assert_equal(str(moderator.game.log), str(self.moderator.game.log))
+    frodo = moderator.game.player_named("frodo")
+    masons = moderator.game.faction_named("thefellowship")
+    assert frodo.faction is masons
+    assert moderator.game.log[0].player is moderator.game.player_named(
+      moderator.game.log[0].player.unique_name)
+
+    moderator.forum.inbox = [
+      Message(sender=moderator.game.player_named("sauron"), subject="Mafia",
+              body="Sauron: Kill Frodo."),
+    ]
+    moderator.poll()
+    moderator.advance_phase()
+    assert not frodo.alive
+    assert_equal(len(moderator.game.log.type(events.Died)), 1)
+
+  def test_checkpoint_deduplication(self):
+    store = self.moderator.checkpoints
+    chunks = lambda: sum(len(files) for _, _, files in os.walk(store.chunk_dir))
+
+    with patch("godfather.checkpoints.LOG_CHUNK_SIZE", 2):
+      self.moderator.save_checkpoint("a")
+      before = chunks()
+      self.moderator.game.log.append(events.NoDeaths())
+      self.moderator.save_checkpoint("b")
+
+    # Only the last log chunk and the phase state changed.
+    assert_equal(chunks(), before + 2)
+
+  def test_checkpoint_retention(self):
+    for i in range(5):
+      self.moderator.game.log.append(events.NoDeaths())
+      self.moderator.save_checkpoint("night_%d" % i)
+
+    deleted = self.moderator.checkpoints.prune(2)
+    assert_equal(len(deleted), 3)
+    names = self.moderator.checkpoints.names()
+    assert_equal([n.split("_")[-1] for n in names], ["setup", "start", "3", "4"])
+
+    assert self.moderator.checkpoints.compact() > 0
+    for name in names:
+      self.moderator.checkpoints.load(name)
+
+  def test_torn_record(self):
+    self.moderator.forum.inbox = [
+      Message(sender=self.sam, subject="Will", body="Set will: Po-tay-toes."),
+    ]
+    self.moderator.poll()
+    self.moderator.journal.close()
+    size = os.path.getsize(self.moderator.journal_path)
+    open(self.moderator.journal_path, "ab").write(b"\x80\x05garbage")
+
+    moderator = self.load()
+    assert_equal(moderator.game.player_named("samwise").will, "Po-tay-toes.")
+    assert_equal(os.path.getsize(self.moderator.journal_path), size)
+
 class ModeratorMessageTest(ModeratorTest):
   """Test get_messages and send_messages with a mocked out forum object."""
 
@@ -176,3 +475,73 @@ class ModeratorMessageTest(ModeratorTest):
 
   def address(self, player):
     return "%s <%s>" % (player.name, player.info["message"])
+
+class ModeratorScheduleTest(ModeratorTest):
+  """Test that the run loop sleeps until its deadlines."""
+
+  def setUp(self):
+    super().setUp()
+    os.makedirs("backups")
+    del self.moderator.get_time
+    del self.moderator.sleep
+    self.moderator.forum = ListForum()
+    self.moderator.start()
+    self.moderator.save()
+
+  def run_until_phase_ends(self):
+    """Run the moderator until it resolves a phase, and return how late it was."""
+    resolved = []
+    advance_phase = Moderator.advance_phase
+    def record_advance_phase(moderator, now=None):
+      resolved.append(moderator.get_time() - moderator.phase_end)
+      advance_phase(moderator, now)
+      set_cancelled(True)
+
+    with patch.object(Moderator, "advance_phase", autospec=True,
+                      side_effect=record_advance_phase):
+      thread = threading.Thread(target=self.moderator.run)
+      thread.start()
+      thread.join(timeout=10)
+    assert_equal(len(resolved), 1)
+    return resolved[0]
+
+  def test_phase_end_not_early(self):
+    self.moderator.phase_end = self.moderator.get_time() + datetime.timedelta(seconds=0.3)
+    lateness = self.run_until_phase_ends()
+    assert lateness >= datetime.timedelta(), lateness
+
+  @pytest.mark.timing
+  def test_phase_end_on_time(self):
+    self.moderator.phase_end = self.moderator.get_time() + datetime.timedelta(seconds=0.3)
+    lateness = self.run_until_phase_ends()
+    assert datetime.timedelta() <= lateness < datetime.timedelta(milliseconds=50), lateness
+
+  def test_next_wakeup(self):
+    now = self.moderator.get_time()
+    self.moderator.phase_end = now + datetime.timedelta(hours=5)
+    self.moderator.poll()
+    assert_equal(self.moderator.next_wakeup(), self.moderator.next_poll)
+
+    self.moderator.push = True
+    self.moderator.poll()
+    assert_equal(self.moderator.next_wakeup(), self.moderator.next_poll)
+    assert self.moderator.next_poll > now + datetime.timedelta(minutes=4)
+
+    self.moderator.phase_end = now + datetime.timedelta(seconds=5)
+    assert_equal(self.moderator.next_wakeup(), self.moderator.phase_end)
+
+  def test_pushed_message_wakes_loop(self):
+    self.moderator.push = True
+    self.moderator.phase_end = self.moderator.get_time() + datetime.timedelta(hours=5)
+    received = threading.Event()
+    def message_received(message):
+      received.set()
+      set_cancelled(True)
+
+    with patch.object(Moderator, "message_received", side_effect=message_received):
+      thread = threading.Thread(target=self.moderator.run)
+      thread.start()
+      time.sleep(0.1)
+      self.moderator.inbox.put(Message(sender=self.sam, subject="Will", body="Set will: Hi."))
+      assert received.wait(timeout=1)
+      thread.join(timeout=5)
@@ -0,0 +1,101 @@
+import pickle
+import threading
+import time
+import unittest
+
+from mafia import assert_equal
+
+from godfather.api.forum import Forum, ForumError
+from godfather.api.message import Message
+from ..metrics import Metrics
+from ..outbox import Outbox
+
+class FakeForum(Forum):
+  def __init__(self, failures=0):
+    self.failures = failures
+    self.batches  = []
+    self.sent     = threading.Event()
+
+  def send_messages(self, game, messages):
+    if self.failures > 0:
+      self.failures -= 1
+      return [(m, ForumError("Nope")) for m in messages]
+    self.batches.append([m.body for m in messages])
+    self.sent.set()
+    return []
+
+class OutboxTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.outbox = Outbox(workers=1, backoff=0.01)
+    self.sent_ids = []
+
+  def tearDown(self):
+    self.outbox.stop(timeout=1)
+    super().tearDown()
+
+  def put(self, *bodies):
+    for body in bodies:
+      self.outbox.put(Message(to=None, subject="Subject", body=body))
+
+  def test_send_in_background(self):
+    forum = FakeForum()
+    self.outbox.start(forum, None, on_sent=self.sent_ids.extend)
+    self.put("a", "b", "c")
+    time.sleep(0.05)
+    assert_equal(forum.batches, [])
+
+    # Messages are sent together once released.
+    self.outbox.release()
+    assert forum.sent.wait(timeout=1)
+    self.outbox.stop()
+    assert_equal(forum.batches, [["a", "b", "c"]])
+    assert_equal(self.sent_ids, [0, 1, 2])
+    assert_equal(len(self.outbox), 0)
+
+  def test_retry(self):
+    forum = FakeForum(failures=2)
+    self.outbox.start(forum, None)
+    self.put("a")
+    self.outbox.release()
+    assert forum.sent.wait(timeout=1)
+    assert_equal(forum.batches, [["a"]])
+
+  def test_metrics(self):
+    forum = FakeForum(failures=2)
+    metrics = Metrics()
+    self.outbox.start(forum, None, metrics=metrics)
+    self.put("a")
+    assert self.outbox.oldest_age() >= 0
+    self.outbox.release()
+    assert forum.sent.wait(timeout=1)
+    self.outbox.stop()
+    assert_equal(metrics["send_retries_total"], 2)
+    assert_equal(metrics["send_seconds"].count, 3)
+    assert_equal(metrics["send_latency_seconds"].count, 1)
+    assert_equal(self.outbox.oldest_age(), None)
+
+  def test_stop_sends_pending_messages(self):
+    forum = FakeForum()
+    self.outbox.start(forum, None)
+    self.put("a", "b")
+    self.outbox.stop()
+    assert_equal(forum.batches, [["a", "b"]])
+
+  def test_unsent_messages_survive_pickling(self):
+    forum = FakeForum(failures=100)
+    self.put("a", "b")
+    self.outbox.release()
+    self.outbox.send(forum, None)
+    assert_equal(len(self.outbox), 2)
+
+    outbox = pickle.loads(pickle.dumps(self.outbox))
+    outbox.send(FakeForum(), None)
+    assert_equal(len(outbox), 0)
+
+    # Messages already sent aren't sent again.
+    outbox = pickle.loads(pickle.dumps(self.outbox))
+    outbox.discard([0])
+    forum = FakeForum()
+    outbox.send(forum, None)
+    assert_equal(forum.batches, [["b"]])
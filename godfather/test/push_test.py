@@ -0,0 +1,168 @@
+import datetime
+import hashlib
+import hmac
+import os
+import pytz
+import requests
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import werkzeug.serving
+
+from mafia import *
+
+from ..api.forums.mailgun import *
+from ..moderator import *
+from ..server import Server
+from .fake_mailgun import FakeMailgun
+
+def signed(form, key="key", timestamp=None):
+  """Return <form> with a Mailgun webhook signature added."""
+  if not isinstance(timestamp, str):
+    timestamp = str(int(timestamp or time.time()))
+  token = uuid.uuid4().hex
+  signature = hmac.new(key.encode(), (timestamp + token).encode(), hashlib.sha256).hexdigest()
+  return dict(form, timestamp=timestamp, token=token, signature=signature)
+
+class PushTest(unittest.TestCase):
+  """Tests of messages pushed to the server by a Mailgun route."""
+
+  def setUp(self):
+    super().setUp()
+    self.dir = tempfile.mkdtemp()
+    self.mailgun_server = FakeMailgun("example.com")
+    self.mailgun_server.start()
+    self.mailgun = Mailgun(api_key="key",
+                           sender="The Godfather",
+                           address="game",
+                           domain="example.com",
+                           api_url=self.mailgun_server.url,
+                           backoff=0.01)
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.alice = self.game.add_player("Alice", Cop(self.town),
+                                      info={"email": "alice@example.com"})
+    self.bob   = self.game.add_player("Bob", Doctor(self.town),
+                                      info={"email": "bob@example.com"})
+    self.mafia = self.game.add_faction(Mafia("The Mafia"))
+    self.eve   = self.game.add_player("Eve", Goon(self.mafia),
+                                      info={"email": "eve@example.com"})
+
+    time_zone = pytz.timezone("US/Pacific")
+    later = (datetime.datetime.now(time_zone) + datetime.timedelta(hours=1)).time()
+    self.moderator = Moderator(path=os.path.join(self.dir, "game.pickle"),
+                               game=self.game,
+                               game_name="Test",
+                               time_zone=time_zone,
+                               night_end=later.replace(tzinfo=time_zone),
+                               day_end=later.replace(tzinfo=time_zone),
+                               forum=self.mailgun,
+                               push=True)
+
+    self.server = werkzeug.serving.make_server("127.0.0.1", 0, Server(self.moderator),
+                                               threaded=True)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = "http://127.0.0.1:%d/inbound" % self.server.server_port
+
+  def tearDown(self):
+    set_cancelled(False)
+    self.server.shutdown()
+    self.mailgun_server.stop()
+    shutil.rmtree(self.dir)
+    super().tearDown()
+
+  def email(self, body, sender="alice@example.com", message_id=None):
+    return {
+      "recipient":     self.mailgun.email,
+      "sender":        sender,
+      "subject":       "Action",
+      "stripped-text": body,
+      "Message-Id":    message_id or "<%s@example.com>" % uuid.uuid4(),
+    }
+
+  def confirmations(self):
+    return [m for m in self.moderator.outbox.pending.values()
+            if m.body.startswith("Confirmed.")]
+
+  def test_verify_push(self):
+    email = self.email("investigate Bob")
+    assert_equal(self.mailgun.verify_push(signed(email))["stripped-text"], "investigate Bob")
+    with self.assertRaises(ForumError):
+      self.mailgun.verify_push(signed(email, key="wrong"))
+    with self.assertRaises(ForumError):
+      self.mailgun.verify_push(signed(email, timestamp=time.time() - 3600))
+    with self.assertRaises(ForumError):
+      self.mailgun.verify_push(email)
+
+  def test_inbound_endpoint(self):
+    response = requests.post(self.url, data=signed(self.email("investigate Bob")))
+    assert_equal(response.status_code, 200)
+    assert_equal(len(self.moderator.inbox), 1)
+
+    response = requests.post(self.url, data=signed(self.email("investigate Bob"), key="wrong"))
+    assert_equal(response.status_code, 406)
+    assert_equal(len(self.moderator.inbox), 1)
+
+  def test_inbound_rejects_garbage(self):
+    email = self.email("investigate Bob")
+    for form in [dict(signed(email), signature="caf\u00e9"),
+                 signed(email, timestamp="yesterday"),
+                 signed(email, timestamp="nan")]:
+      with self.assertRaises(ForumError):
+        self.mailgun.verify_push(form)
+      response = requests.post(self.url, data=form)
+      assert_equal(response.status_code, 406)
+    assert_equal(len(self.moderator.inbox), 0)
+
+  def test_push_wakes_moderator(self):
+    thread = threading.Thread(target=self.moderator.run)
+    thread.start()
+    try:
+      # Wait for the game to start and the loop to go to sleep.
+      deadline = time.monotonic() + 5
+      while len(self.mailgun_server.sent) == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+      time.sleep(0.1)
+
+      start = time.monotonic()
+      requests.post(self.url, data=signed(self.email("investigate Bob")))
+      while time.monotonic() < start + 5:
+        sent = [f for f in self.mailgun_server.sent if f["subject"] == ["Action"]]
+        if sent:
+          break
+        time.sleep(0.01)
+      latency = time.monotonic() - start
+    finally:
+      set_cancelled(True)
+      thread.join()
+
+    assert sent, "No confirmation was sent."
+    assert latency < 2, "Confirmation took %.1fs." % latency
+    assert sent[0]["text"][0].startswith("Confirmed.")
+
+  def test_reconcile_skips_pushed_messages(self):
+    self.moderator.start()
+    email = self.email("investigate Bob")
+    self.moderator.inbox.put(email)
+    self.moderator.receive_pushed()
+    assert_equal(len(self.confirmations()), 1)
+
+    # The reconciliation poll sees the same message again.
+    self.mailgun_server.store(sender=email["sender"], recipient=self.mailgun.email,
+                              subject=email["subject"], body=email["stripped-text"],
+                              timestamp=time.time() - 60, message_id=email["Message-Id"])
+    self.mailgun.last_fetch = datetime.datetime.now() - datetime.timedelta(minutes=5)
+    self.moderator.poll()
+    assert_equal(len(self.confirmations()), 1)
+    assert not self.moderator.poll_due()
+
+  def test_push_after_phase_end_waits(self):
+    self.moderator.start()
+    self.moderator.phase_end = self.moderator.get_time() - datetime.timedelta(seconds=1)
+    self.moderator.inbox.put(self.email("investigate Bob"))
+    self.moderator.receive_pushed()
+    assert_equal(len(self.confirmations()), 0)
+    assert_equal(len(self.moderator.inbox), 1)
@@ -0,0 +1,82 @@
+import json
+import tempfile
+
+from mafia import assert_equal
+
+from .cli_test import *
+from ..api.forums.recording import Recording, Replay
+from ..api.forums.simulated import Simulated
+from ..clock import VirtualClock
+from ..simulate import START, simulate, synthetic_game
+
+SETUP = """
+from godfather.api.forums.stdout import Stdout
+from godfather.simulate import OPTIONS, synthetic_game
+
+game      = synthetic_game(8)
+forum     = Stdout()
+game_name = OPTIONS["game_name"]
+time_zone = OPTIONS["time_zone"]
+night_end = OPTIONS["night_end"]
+day_end   = OPTIONS["day_end"]
+"""
+
+class RecordingTest(CliTest):
+  def record(self, players=8):
+    """Record a simulated game in game.recording, and return its Moderator."""
+    clock = VirtualClock(START)
+    forum = Recording(Simulated(messages_per_phase=40), "game.recording", clock=clock)
+    with tempfile.TemporaryDirectory() as directory:
+      moderator, elapsed = simulate(directory, game=synthetic_game(players), forum=forum,
+                                    clock=clock)
+    assert moderator.game.is_game_over()
+    return moderator
+
+  def test_replay(self):
+    recorded = self.record()
+    forum = Replay("game.recording")
+    with tempfile.TemporaryDirectory() as directory:
+      replayed, elapsed = simulate(directory, game=synthetic_game(8), forum=forum,
+                                   clock=forum.clock)
+
+    assert_equal(forum.differences(), ([], []))
+    assert_equal(len(forum.waiting), 0)
+    assert_equal(forum.sent, recorded.forum.forum.sent)
+    assert_equal(str(replayed.game.log), str(recorded.game.log))
+
+  def test_replay_finds_differences(self):
+    self.record()
+    forum = Replay("game.recording")
+    game = synthetic_game(9)  # Welcomes an extra player.
+    with tempfile.TemporaryDirectory() as directory:
+      simulate(directory, game=game, forum=forum, clock=forum.clock)
+
+    missing, extra = forum.differences()
+    assert missing and extra
+
+  def test_replay_command(self):
+    self.record()
+    with open("setup.py", "w") as f:
+      f.write(SETUP)
+    output = exec_godfather(["replay"])
+    assert "The replay sent the same messages as the recording." in output, output
+
+    # A line cut short by a crash is skipped. (Rewriting setup.py makes a
+    # fresh game, rather than reusing the one already loaded.)
+    with open("game.recording", "a") as f:
+      f.write('{"t": "2001-01')
+    with open("setup.py", "w") as f:
+      f.write(SETUP + "\n")
+    exec_godfather(["replay"])
+
+  def test_recording_format(self):
+    self.record()
+    with open("game.recording") as f:
+      records = [json.loads(line) for line in f]
+    assert_equal(records[0], {"start": START.isoformat(), "receipt_lag": 0})
+    received = [r for r in records if "sender" in r]
+    assert_equal(received[0]["phase"], "Night 0")
+    assert_equal(sorted(received[0]), ["body", "id", "phase", "sender", "subject", "t"])
+    # Sends are recorded by the outbox's threads, so may come after the first received.
+    sent = [r for r in records if "to" in r]
+    assert_equal(sent[0]["to"], "public")  # The welcome message.
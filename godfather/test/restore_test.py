@@ -1,8 +1,16 @@
+import datetime
+import mafia
 import os
 import pickle
+import pytz
 import shutil
 
+from unittest.mock import patch
+
 from .cli_test import *
+from ..api.forums.mailgun import Mailgun
+from ..api.message import Message
+from ..moderator import Moderator
 
 class RestoreTest(CliTest):
 
@@ -24,3 +32,70 @@ class RestoreTest(CliTest):
     # Check that the backup file was restored.
     moderator = pickle.load(open(self.game_path, "rb"))
     self.assertEqual("Bananas", moderator.fake_member)
+
+  def test_restore_checkpoint(self):
+    """Test that 'restore' restores a checkpoint by name."""
+    exec_godfather(["init"])
+    exec_godfather(["run", "--setup_only"])
+
+    # Save a checkpoint.
+    moderator = pickle.load(open(self.game_path, "rb"))
+    moderator.fake_member = "Bananas"
+    moderator.save_checkpoint("bananas")
+    name = moderator.checkpoints.names()[-1]
+
+    # Restore the checkpoint.
+    exec_godfather(["restore", "--backup", name])
+
+    # Check that the checkpoint was restored.
+    moderator = pickle.load(open(self.game_path, "rb"))
+    self.assertEqual("Bananas", moderator.fake_member)
+
+# The attributes a Moderator and a Mailgun forum had before the journal and
+# everything after it were added.
+BASELINE_MODERATOR = ["path", "game", "name", "time_zone", "night_end", "day_end", "started",
+                      "phase", "phase_end", "forum", "parser"]
+BASELINE_MAILGUN   = ["api_key", "sender", "address", "domain", "private_cc", "public_cc",
+                      "last_fetch"]
+
+def baseline_state(attributes):
+  return lambda self: {name: self.__dict__[name] for name in attributes}
+
+class UpgradeTest(CliTest):
+  def test_load_baseline_game(self):
+    """A game.pickle saved before the journal was added can still be loaded and played."""
+    game  = mafia.Game()
+    town  = game.add_faction(mafia.Town())
+    alice = game.add_player("Alice", mafia.Cop(town), info={"email": "alice@example.com"})
+    bob   = game.add_player("Bob", mafia.Villager(town), info={"email": "bob@example.com"})
+    eve   = game.add_player("Eve", mafia.Villager(town), info={"email": "eve@example.com"})
+    time_zone = pytz.timezone("US/Pacific")
+    moderator = Moderator(path=self.game_path,
+                          game=game,
+                          game_name="Baseline Mafia",
+                          time_zone=time_zone,
+                          night_end=datetime.time(hour=10, tzinfo=time_zone),
+                          day_end=datetime.time(hour=22, tzinfo=time_zone),
+                          forum=Mailgun(api_key="key", sender="The Godfather",
+                                        address="game", domain="example.com"))
+    moderator.start()
+    moderator.advance_phase()
+    moderator.receive(Message(sender=alice, subject="Vote", body="vote eve"))
+
+    with patch.object(Moderator, "__getstate__", baseline_state(BASELINE_MODERATOR)), \
+         patch.object(Mailgun, "__getstate__", baseline_state(BASELINE_MAILGUN)):
+      with open(self.game_path, "wb") as f:
+        pickle.dump(moderator, f)
+
+    exec_godfather(["log"])
+    moderator = godfather.main.load_game(self.game_path)
+    bob = moderator.game.player_named("bob")
+    assert moderator.role_email(bob) is not None
+    assert moderator.forum.session is not None
+    moderator.receive(Message(sender=bob, subject="Vote", body="vote eve"))
+    self.assertEqual(moderator.tally.summary(), "Current votes:\n"
+                                                "  Alice votes for Eve.\n"
+                                                "  Bob votes for Eve.\n\n"
+                                                "Eve has a majority (2 of 2 needed).")
+    moderator.advance_phase()
+    moderator.save(force=True)
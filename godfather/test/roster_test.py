@@ -0,0 +1,49 @@
+import pickle
+
+from mafia import *
+
+from .godfather_test import *
+from ..roster import Roster
+
+class RosterTest(GodfatherTest):
+  def setUp(self):
+    super().setUp()
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.mafia = self.game.add_faction(Mafia("The Mafia"))
+    self.alice = self.game.add_player("Alice", Cop(self.town), info={"email": "alice@example.com"})
+    self.bob   = self.game.add_player("Bob", Villager(self.town), info={"email": "bob@example.com"})
+    self.eve   = self.game.add_player("Eve", Goon(self.mafia), info={"email": "eve@example.com"})
+    self.roster = Roster(self.game)
+
+  def test_lookup(self):
+    assert_equal(self.roster.with_email("bob@example.com"), self.bob)
+    assert_equal(self.roster.with_email("mallory@example.com"), None)
+    assert_equal(self.roster.addresses("all"),
+                 ["Alice <alice@example.com>", "Bob <bob@example.com>", "Eve <eve@example.com>"])
+    assert_equal(self.roster.recipients(self.mafia), [("Eve", "eve@example.com")])
+
+  def test_deaths(self):
+    alive = self.roster.addresses("alive")
+    assert self.roster.addresses("alive") is alive  # Formatted once.
+    version = self.roster.version
+
+    self.game.log.on_append(self.roster.event_logged)
+    self.game.begin()
+    self.game.log.current_phase = Night(0)
+    self.bob.add_effect(effects.Dead())
+    self.game.log.append(events.Died(self.bob))
+
+    assert self.roster.version > version
+    assert not self.roster.is_alive(self.bob)
+    assert_equal(self.roster.alive, [self.alice, self.eve])
+    assert_equal(self.roster.addresses("alive"),
+                 ["Alice <alice@example.com>", "Eve <eve@example.com>"])
+    assert_equal(self.roster.players_summary()[1], {"name": "Bob", "alive": False})
+    assert_equal(self.roster.with_email("bob@example.com"), self.bob)  # Still recognized.
+
+  def test_pickle(self):
+    self.roster.addresses("all")
+    roster = pickle.loads(pickle.dumps(self.roster))
+    assert_equal(roster.index, None)
+    assert_equal(len(roster.addresses("all")), 3)
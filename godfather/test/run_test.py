@@ -2,6 +2,9 @@ import os
 import pickle
 import pluginbase
 import pytest
+import threading
+
+from unittest.mock import patch
 
 from .cli_test import *
 from ..moderator import *
@@ -47,6 +50,33 @@ class RunTest(CliTest):
     exec_godfather(["run", "--setup_only"])
     check_and_clear_global_events([])
 
+  def test_server_address(self):
+    """'run --host --port' serves web pages on that address."""
+    exec_godfather(["init"])
+    exec_godfather(["run", "--setup_only"])
+    moderator = pickle.load(open(self.game_path, "rb"))
+    moderator.run = fake_run
+    pickle.dump(moderator, open(self.game_path, "wb"))
+
+    served = threading.Event()
+    with patch("godfather.server.serve", side_effect=lambda *args, **kwargs: served.set()) as serve:
+      exec_godfather(["run", "--host", "0.0.0.0", "--port", "8080"])
+      assert served.wait(5)
+    self.assertEqual(serve.call_args.kwargs, {"host": "0.0.0.0", "port": 8080})
+    check_and_clear_global_events(["run"])
+
+  def test_setup_cached(self):
+    """setup.py is only loaded again if it changes."""
+    exec_godfather(["init"])
+    setup = godfather.main.load_setup()
+    assert godfather.main.load_setup() is setup
+    assert setup.game is not None  # Still usable once the PluginSource is out of scope.
+
+    with open(self.setup_path, "a") as f:
+      f.write("\ntest_value = 123\n")
+    os.utime(self.setup_path, ns=(0, os.stat(self.setup_path).st_mtime_ns + 1))
+    self.assertEqual(godfather.main.load_setup().test_value, 123)
+
   class RunLockTestHelper(object):
     def run(self):
       # Check that the game lock exists.
@@ -69,5 +99,6 @@ class RunTest(CliTest):
     # Call 'run' with our injected helper code.
     exec_godfather(["run"])
 
-    # Check that the game lock was deleted.
-    assert not os.path.isfile("game.lock")
+    # Check that the game lock was released.
+    self.assertEqual(open("game.lock").read(), "")
+    exec_godfather(["run", "--setup_only"])
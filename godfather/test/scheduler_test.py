@@ -0,0 +1,58 @@
+import threading
+import time
+import unittest
+
+from mafia import *
+
+from ..scheduler import Scheduler
+
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.scheduler = Scheduler()
+
+  def sleep_in_thread(self, seconds):
+    """Start sleeping in another thread, and return a list that will hold (result, duration)."""
+    result = []
+    def sleep():
+      start = time.monotonic()
+      result.append(self.scheduler.sleep(seconds))
+      result.append(time.monotonic() - start)
+    self.thread = threading.Thread(target=sleep)
+    self.thread.start()
+    time.sleep(0.05)
+    return result
+
+  def test_sleep_until_deadline(self):
+    start = time.monotonic()
+    assert self.scheduler.sleep(0.1)
+    assert 0.1 <= time.monotonic() - start < 0.15
+
+  def test_past_deadline(self):
+    start = time.monotonic()
+    assert self.scheduler.sleep(-5)
+    assert time.monotonic() - start < 0.05
+
+  def test_wake(self):
+    result = self.sleep_in_thread(60)
+    self.scheduler.wake()
+    self.thread.join(timeout=5)
+    assert_equal(result[0], True)
+    assert result[1] < 1
+
+    # Waking is used up by the sleep it ends.
+    start = time.monotonic()
+    self.scheduler.sleep(0.05)
+    assert time.monotonic() - start >= 0.05
+
+  def test_stop(self):
+    result = self.sleep_in_thread(60)
+    self.scheduler.stop()
+    self.thread.join(timeout=5)
+    assert_equal(result[0], False)
+    assert result[1] < 1
+
+    # Stopping lasts until reset.
+    assert not self.scheduler.sleep(60)
+    self.scheduler.reset()
+    assert self.scheduler.sleep(0)
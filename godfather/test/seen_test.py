@@ -0,0 +1,18 @@
+from mafia import assert_equal
+
+from .godfather_test import *
+from ..seen import SeenIndex
+
+class SeenIndexTest(GodfatherTest):
+  def test_forgets_old_phases(self):
+    seen = SeenIndex(phases=2)
+    seen.add("a")
+    seen.advance()
+    seen.add("b")
+    assert "a" in seen and "b" in seen
+    assert None not in seen
+
+    seen.advance()
+    assert "a" not in seen
+    assert "b" in seen
+    assert_equal(len(seen), 1)
@@ -0,0 +1,131 @@
+import datetime
+import os
+import pytz
+import requests
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mafia import *
+from unittest.mock import patch
+
+from ..api.message import Message
+from ..moderator import *
+from ..server import *
+from .moderator_test import ListForum
+
+class ServerTest(unittest.TestCase):
+  """Tests of the web pages served from the published Snapshot."""
+
+  def setUp(self):
+    super().setUp()
+    self.dir   = tempfile.mkdtemp()
+    self.game  = Game()
+    town       = self.game.add_faction(Town())
+    mafia      = self.game.add_faction(Mafia("The Mafia"))
+    self.alice = self.game.add_player("Alice", Cop(town))
+    self.bob   = self.game.add_player("Bob", Doctor(town))
+    self.eve   = self.game.add_player("Eve", Goon(mafia))
+
+    os.makedirs(os.path.join(self.dir, "backups"))
+    time_zone = pytz.timezone("US/Pacific")
+    later = (datetime.datetime.now(time_zone) + datetime.timedelta(hours=1)).time()
+    self.moderator = Moderator(path=os.path.join(self.dir, "game.pickle"),
+                               game=self.game,
+                               game_name="Test Mafia",
+                               time_zone=time_zone,
+                               night_end=later.replace(tzinfo=time_zone),
+                               day_end=later.replace(tzinfo=time_zone),
+                               forum=ListForum())
+    self.client = Server(self.moderator).test_client()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+    super().tearDown()
+
+  def test_api(self):
+    self.moderator.start()
+    self.moderator.advance_phase()
+    self.moderator.receive(Message(sender=self.alice, subject="Vote", body="vote eve"))
+    self.moderator.publish()
+
+    assert_equal(self.client.get("/api/players").get_json(), [
+      {"name": "Alice", "alive": True},
+      {"name": "Bob", "alive": True},
+      {"name": "Eve", "alive": True},
+    ])
+    phase = self.client.get("/api/phase").get_json()
+    assert_equal(phase["phase"], "Day 1")
+    assert_equal(phase["phase_end"], self.moderator.phase_end.isoformat())
+    assert_equal(self.client.get("/api/votes").get_json(),
+                 {"votes": {"Alice": "Eve"}, "counts": {"Eve": 1}, "majority": 2, "leader": None})
+
+  def test_reads_only_snapshot(self):
+    self.moderator.game = None
+    assert_equal(self.client.get("/api/players").status_code, 200)
+    assert "Alice" in self.client.get("/players").get_data(as_text=True)
+
+  def test_conditional_requests(self):
+    response = self.client.get("/api/phase")
+    etag, modified = response.headers["ETag"], response.headers["Last-Modified"]
+    assert_equal(self.client.get("/api/phase", headers={"If-None-Match": etag}).status_code, 304)
+    assert_equal(self.client.get("/api/phase",
+                                 headers={"If-Modified-Since": modified}).status_code, 304)
+
+    # A new snapshot gets a new ETag.
+    self.moderator.start()
+    self.moderator.publish()
+    response = self.client.get("/api/phase", headers={"If-None-Match": etag})
+    assert_equal(response.status_code, 200)
+    assert response.headers["ETag"] != etag
+
+  def test_renders_once_per_snapshot(self):
+    with patch("flask.render_template", return_value="players") as render_template:
+      self.client.get("/players")
+      self.client.get("/players")
+      assert_equal(render_template.call_count, 1)
+      self.moderator.publish()
+      self.client.get("/players")
+      assert_equal(render_template.call_count, 2)
+
+  def test_status(self):
+    response = self.client.get("/status")
+    assert_equal(response.status_code, 500)
+    assert "No email check yet." in response.get_data(as_text=True)
+
+    self.moderator.poll()
+    response = self.client.get("/status")
+    assert_equal(response.status_code, 200)
+    assert "poll_seconds: 1" in response.get_data(as_text=True)
+
+    self.moderator.last_fetch -= datetime.timedelta(minutes=2)
+    assert_equal(self.client.get("/status").status_code, 500)
+    self.moderator.max_latency = datetime.timedelta(minutes=5)
+    assert_equal(self.client.get("/status").status_code, 200)
+
+  def test_metrics(self):
+    self.moderator.forum.inbox = [Message(sender=self.alice, subject="Hi", body="help")]
+    self.moderator.poll()
+    self.moderator.advance_phase()
+    self.moderator.save()
+
+    response = self.client.get("/metrics")
+    assert_equal(response.status_code, 200)
+    lines = response.get_data(as_text=True).splitlines()
+    assert "godfather_poll_messages_count 1" in lines
+    assert "godfather_poll_messages_sum 1" in lines
+    assert "godfather_resolve_seconds_count 1" in lines
+    assert "godfather_save_seconds_count 1" in lines
+
+  def test_make_server(self):
+    server = make_server(Server(self.moderator), port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%d/api/phase" % server.server_port
+      assert_equal(requests.get(url).json()["phase"], "Night 0")
+    finally:
+      server.shutdown()
+      thread.join(timeout=10)
+    assert not thread.is_alive()
@@ -0,0 +1,30 @@
+import datetime
+import tempfile
+
+from mafia import assert_equal
+
+from .cli_test import *
+from ..api.forums.simulated import Simulated
+from ..clock import VirtualClock
+from ..simulate import START, phase_stats, simulate, synthetic_game
+
+class SimulateTest(CliTest):
+  def test_simulate(self):
+    """Test that 'simulate' plays a game to the end and reports on each phase."""
+    lines = exec_godfather(["simulate", "--players", "8"]).splitlines()
+    assert lines[2].startswith("Night 0 "), lines
+    assert any(line.startswith("Day 1 ") for line in lines), lines
+    assert lines[-1].startswith("Winners: "), lines
+
+  def test_stop_after_days(self):
+    forum = Simulated(seed=1, messages_per_phase=30)
+    with tempfile.TemporaryDirectory() as directory:
+      clock = VirtualClock(START, until=START + datetime.timedelta(days=1))
+      moderator, elapsed = simulate(directory, game=synthetic_game(12), forum=forum, clock=clock)
+    assert not moderator.game.is_game_over()
+    assert moderator.clock.time >= START + datetime.timedelta(days=1)
+
+    stats = phase_stats(forum, moderator.metrics.snapshot())
+    assert_equal([phase for phase, s in stats], ["Night 0", "Day 1", "Night 1"])
+    assert_equal([s["message_seconds"][0] for phase, s in stats], [30, 30, 30])
+    assert_equal(moderator.metrics["messages_sent_total"], forum.sent)
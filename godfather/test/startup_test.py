@@ -0,0 +1,37 @@
+import os
+import pytest
+import subprocess
+import sys
+import unittest
+
+# Modules a bare 'godfather' invocation shouldn't import.
+HEAVY_MODULES = ["flask", "jinja2", "pluginbase", "requests", "werkzeug"]
+
+# The most time importing godfather.main may take, in seconds. It's ~0.06s
+# without the modules above, and ~0.3s with them. Only checked with
+# 'pytest -m timing', since a loaded machine can take far longer.
+STARTUP_BUDGET = 0.2
+
+def import_times(module):
+  """Return the cumulative import time in seconds of each module <module> imports."""
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                          env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+  times = {}
+  for line in result.stderr.splitlines():
+    if line.startswith("import time:") and "cumulative" not in line:
+      self_us, cumulative_us, name = line[len("import time:"):].split("|")
+      times[name.strip()] = int(cumulative_us) / 1e6
+  return times
+
+class StartupTest(unittest.TestCase):
+  def test_imports_only_what_commands_use(self):
+    times = import_times("godfather.main")
+    for module in HEAVY_MODULES:
+      self.assertNotIn(module, times)
+
+  @pytest.mark.timing
+  def test_startup_time(self):
+    # Take the best of a few runs, so a busy machine doesn't fail the test.
+    best = min(import_times("godfather.main")["godfather.main"] for i in range(3))
+    self.assertLess(best, STARTUP_BUDGET)
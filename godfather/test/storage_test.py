@@ -0,0 +1,39 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from mafia import assert_equal
+from unittest.mock import patch
+
+from ..storage import *
+
+class StorageTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, "game.pickle")
+
+  def tearDown(self):
+    self.dir.cleanup()
+    super().tearDown()
+
+  def test_save_and_load(self):
+    size, duration = save_pickle({"phase": "Night 0"}, self.path)
+    assert_equal(size, os.path.getsize(self.path))
+    assert_equal(load_pickle(self.path), {"phase": "Night 0"})
+    assert_equal(os.listdir(self.dir.name), ["game.pickle"])
+
+  def test_failed_write_keeps_old_file(self):
+    save_pickle("old", self.path)
+    with patch("os.replace", side_effect=OSError("disk on fire")):
+      with self.assertRaises(OSError):
+        save_pickle("new", self.path)
+    assert_equal(load_pickle(self.path), "old")
+    assert_equal(os.listdir(self.dir.name), ["game.pickle"])
+
+  def test_highest_protocol(self):
+    atomic_write(self.path, b"")
+    save_pickle([1, 2, 3], self.path)
+    data = open(self.path, "rb").read()
+    assert_equal(data[1], pickle.HIGHEST_PROTOCOL)
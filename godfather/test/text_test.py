@@ -0,0 +1,87 @@
+import logging
+import pytest
+import re
+import timeit
+import unittest
+
+from mafia import *
+
+from ..api.message import Message
+from ..api.text import *
+from ..messages import render_message
+
+def strip_html(body):
+  """The converter html_to_text replaced, kept for comparison."""
+  body = re.sub(r"\n +", "\n", body)
+  body = re.sub(r"&lt;", "<", body)
+  body = re.sub(r"&gt;", ">", body)
+  body = re.sub(r"</h2>", ":", body)
+  body = re.sub(r"<li>", "  - ", body)
+  body = re.sub(r"\n</?ul>\n", "\n", body)
+  body = re.sub(r"<\w+?>|</\w+?>", "", body)
+  return body
+
+class TextTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.game   = Game()
+    self.town   = self.game.add_faction(Town())
+    self.mafia  = self.game.add_faction(Mafia("The Mafia"))
+    for i in range(30):
+      role = Cop(self.town) if i % 2 else Goon(self.mafia)
+      self.game.add_player("Player%d" % i, role, info={"email": "player%d@example.com" % i})
+    parser = Parser(self.game)
+    self.bodies = [
+      render_message("welcome.html", game_name="Test Game", night_end="10:00 PM",
+                     day_end="12:00 PM", players=self.game.players),
+      render_message("end_of_phase.html", last_phase=Night(0), next_phase=Day(1),
+                     phase_end="10:00 PM", players=self.game.players),
+    ]
+    for player in self.game.players[:2]:
+      self.bodies.append(render_message(
+        "role_announcement.html", initial=True, role=player.role,
+        abilities=player.role.descriptions, commands=parser.get_help(player),
+        objective=player.role.objective))
+
+  def test_matches_strip_html(self):
+    for body in self.bodies:
+      mafia.assert_equal(html_to_text(body), strip_html(body))
+
+  def test_html_to_text(self):
+    body = "<h2>Players</h2>\n<ul>\n  <li>Bob &lt;bob@example.com&gt;</li>\n</ul>\n<b>Done</b>"
+    mafia.assert_equal(html_to_text(body), "Players:\n  - Bob <bob@example.com>\nDone")
+
+  def test_entities(self):
+    mafia.assert_equal(html_to_text("Tom &amp; Jerry"), "Tom & Jerry")
+    mafia.assert_equal(html_to_text("Don&#39;t"), "Don't")
+    mafia.assert_equal(html_to_text("A &#x2014; B"), "A — B")
+    mafia.assert_equal(html_to_text("&bogus;"), "&bogus;")
+
+  def test_message_text_is_cached(self):
+    message = Message(to=None, subject="Subject", body="<b>Hi</b> &amp; bye")
+    mafia.assert_equal(message.text, "Hi & bye")
+    assert message.text is message.text
+    mafia.assert_equal(message, Message(to=None, subject="Subject", body="<b>Hi</b> &amp; bye"))
+
+  @pytest.mark.timing
+  def test_send_benchmark(self):
+    """Converting once per message should beat converting once per recipient."""
+    recipients = len(self.game.players) + 1  # Each recipient, plus the log line.
+
+    def uncached():
+      for body in self.bodies:
+        for i in range(recipients):
+          strip_html(body)
+
+    def cached():
+      for body in self.bodies:
+        message = Message(to=None, subject="Subject", body=body)
+        for i in range(recipients):
+          message.text
+
+    runs = 5
+    before = min(timeit.repeat(uncached, number=runs, repeat=3)) / runs
+    after = min(timeit.repeat(cached, number=runs, repeat=3)) / runs
+    logging.info("Convert: %.1fus per send uncached, %.1fus cached." %
+                 (before * 1e6, after * 1e6))
+    assert after * 5 < before, "Cached: %.1fus, uncached: %.1fus" % (after * 1e6, before * 1e6)
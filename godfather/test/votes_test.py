@@ -0,0 +1,52 @@
+import unittest
+
+from mafia import *
+
+from ..votes import *
+
+class VoteTallyTest(unittest.TestCase):
+  def setUp(self):
+    super().setUp()
+    self.game  = Game()
+    self.town  = self.game.add_faction(Town())
+    self.mafia = self.game.add_faction(Mafia("The Mafia"))
+    self.alice = self.game.add_player("Alice", Villager(self.town))
+    self.bob   = self.game.add_player("Bob", Villager(self.town))
+    self.carol = self.game.add_player("Carol", Villager(self.town))
+    self.eve   = self.game.add_player("Eve", Goon(self.mafia))
+    self.tally = VoteTally(self.game.players)
+
+  def test_counts(self):
+    assert_equal(self.tally.majority, 3)
+    self.tally.update(self.alice, self.eve)
+    self.tally.update(self.bob, self.eve)
+    self.tally.update(self.eve, self.alice)
+    assert_equal(self.tally.counts, {self.eve: 2, self.alice: 1})
+
+    # Changing a vote moves it between candidates.
+    change = self.tally.update(self.bob, self.alice)
+    assert_equal(change, VoteChange(self.bob, self.eve, self.alice, 2, False))
+    assert_equal(self.tally.counts, {self.eve: 1, self.alice: 2})
+
+    # Unvoting removes it.
+    change = self.tally.update(self.alice, None)
+    assert_equal(change, VoteChange(self.alice, self.eve, None, 0, False))
+    assert_equal(self.tally.counts, {self.alice: 2})
+
+  def test_majority(self):
+    self.tally.update(self.alice, self.eve)
+    self.tally.update(self.bob, self.eve)
+    assert_equal(self.tally.leader, None)
+    assert self.tally.update(self.carol, self.eve).majority
+    assert_equal(self.tally.leader, self.eve)
+    assert "Eve has a majority" in self.tally.summary()
+
+    self.tally.update(self.bob, self.alice)
+    assert_equal(self.tally.leader, None)
+    assert "majority" not in self.tally.summary()
+
+  def test_summary(self):
+    self.tally.update(self.eve, self.alice)
+    self.tally.update(self.bob, self.eve)
+    assert_equal(self.tally.summary(),
+                 "Current votes:\n  Bob votes for Eve.\n  Eve votes for Alice.")
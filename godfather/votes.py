@@ -0,0 +1,47 @@
+import collections
+
+# A change to one player's vote, and where it left their new candidate.
+VoteChange = collections.namedtuple("VoteChange", ["voter", "old", "new", "count", "majority"])
+
+class VoteTally(object):
+  """A running count of the votes cast so far in a day.
+
+  Each change only touches the two candidates involved, so nothing is copied
+  or re-sorted per vote. Counts are weighted by each voter's player.votes,
+  but don't include vote actions (like a Politician's), which are only
+  applied when the day is resolved.
+  """
+
+  def __init__(self, players):
+    self.votes    = {}                     # voter -> candidate
+    self.counts   = collections.Counter()  # candidate -> weighted votes
+    self.majority = sum(p.votes for p in players) // 2 + 1
+    self.leader   = None                   # The candidate with a majority, if any.
+
+  def update(self, voter, candidate):
+    """Record <voter>'s new vote (None to unvote), and return the VoteChange."""
+    old = self.votes.pop(voter, None)
+    if old is not None:
+      self.counts[old] -= voter.votes
+      if self.counts[old] <= 0:
+        del self.counts[old]
+      if old == self.leader and self.counts[old] < self.majority:
+        self.leader = None
+
+    if candidate is not None:
+      self.votes[voter] = candidate
+      self.counts[candidate] += voter.votes
+      if self.counts[candidate] >= self.majority:
+        self.leader = candidate
+
+    return VoteChange(voter, old, candidate, self.counts[candidate],
+                      candidate is not None and candidate == self.leader)
+
+  def summary(self):
+    """Return the public "Current votes" message."""
+    lines = ["  %s votes for %s." % (voter, self.votes[voter]) for voter in sorted(self.votes)]
+    body = "Current votes:\n%s" % "\n".join(lines)
+    if self.leader:
+      body += "\n\n%s has a majority (%d of %d needed)." % \
+              (self.leader, self.counts[self.leader], self.majority)
+    return body
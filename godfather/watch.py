@@ -0,0 +1,104 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+# inotify(7) constants.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+def load_inotify():
+  """Return libc if it has inotify (i.e. on Linux), or None."""
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1
+  except (OSError, AttributeError):
+    return None
+  return libc
+
+class DirectoryWatcher(object):
+  """Calls <on_change> from a background thread when files arrive in <path>.
+
+  On Linux, the thread blocks on inotify, so it wakes as soon as a file is
+  moved into (or finishes being written in) the directory. Elsewhere it
+  checks the directory's modification time every <interval> seconds. Either
+  way, <on_change> only says something may have arrived: it's up to the
+  caller to look.
+  """
+
+  def __init__(self, path, on_change, *, interval=1):
+    self.path      = path
+    self.on_change = on_change
+    self.interval  = interval
+    self.stopping  = threading.Event()
+    self.thread    = None
+    self.wake_pipe = None
+
+  def start(self):
+    libc = load_inotify()
+    fd = -1
+    if libc:
+      fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+      if fd < 0 or libc.inotify_add_watch(fd, os.fsencode(self.path),
+                                          IN_MOVED_TO | IN_CLOSE_WRITE) < 0:
+        logging.warning("Can't watch %s with inotify, will check it every %ss: %s" %
+                        (self.path, self.interval, os.strerror(ctypes.get_errno())))
+        if fd >= 0:
+          os.close(fd)
+        fd = -1
+
+    if fd >= 0:
+      self.wake_pipe = os.pipe()
+      target, args = self._watch_inotify, (fd,)
+    else:
+      target, args = self._watch_mtime, ()
+    self.thread = threading.Thread(target=target, args=args, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    if self.thread is None:
+      return
+    self.stopping.set()
+    if self.wake_pipe:
+      os.write(self.wake_pipe[1], b"x")
+    self.thread.join()
+    if self.wake_pipe:
+      for fd in self.wake_pipe:
+        os.close(fd)
+    self.thread = self.wake_pipe = None
+    self.stopping.clear()
+
+  def _watch_inotify(self, fd):
+    try:
+      while not self.stopping.is_set():
+        ready, _, _ = select.select([fd, self.wake_pipe[0]], [], [])
+        if fd not in ready:
+          continue
+        try:
+          os.read(fd, 64 * (EVENT_HEADER.size + 256))  # The events themselves don't matter.
+        except BlockingIOError:
+          continue
+        self.on_change()
+    finally:
+      os.close(fd)
+
+  def _watch_mtime(self):
+    last = self._modified()
+    while not self.stopping.wait(self.interval):
+      modified = self._modified()
+      if modified != last:
+        self.on_change()
+      last = modified
+
+  def _modified(self):
+    try:
+      return os.stat(self.path).st_mtime_ns
+    except OSError:
+      return None
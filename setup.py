@@ -31,7 +31,11 @@ setup(
     "pytz",
     "requests",
     "termcolor",
+    "urllib3>=2",
   ],
+  extras_require={
+    "serve": ["waitress"],
+  },
   tests_require=[
     "pytest",
   ],